@@ -0,0 +1,414 @@
+import asyncio
+import functools
+import io
+import json
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+from urllib.parse import parse_qs, unquote
+
+from app import elevator_api, metrics
+from app.cache import validator_headers
+from app.events import DROPPED_FRAME, KEEPALIVE_FRAME, RESET_FRAME, RETRY_FRAME
+
+#ASGI serving mode, no extra dependencies:  uvicorn app.asgi:application
+#Sockets live on the event loop and cost nothing while they wait. Only the database work goes to a
+#small dedicated thread pool, each of its threads keeps one pooled SQLite connection.
+#The hot routes are handled here with the same route bodies as Flask (elevator_api.*_answer).
+#Every other route, and the streaming training data formats, runs through the Flask app in a pool of its own.
+#GET /stream is served on the loop itself: an open event stream costs a task, not a thread
+
+DB_THREADS = int(os.environ.get('ELEVATOR_DB_THREADS', '8'))
+#Flask responses (every other route, ndjson / csv streams) get their own pool: a stream to a slow client
+#holds its thread until the client has read it all, and must not starve the short DB calls above
+WSGI_THREADS = int(os.environ.get('ELEVATOR_WSGI_THREADS', '64'))
+MAX_BODY_BYTES = 10 * 1024 * 1024
+STREAM_QUEUE_CHUNKS = 16  #chunks buffered per streaming response before the WSGI thread waits for the client
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class Request:
+    def __init__(self, scope: Dict, body: bytes):
+        self.scope = scope
+        self.method = scope['method']
+        self.path = scope['path']
+        self.query_string = scope.get('query_string', b'')
+        self.args = {key: values[0] for key, values in parse_qs(self.query_string.decode('latin-1')).items()}
+        self.body = body
+
+    #like request.get_json(silent=True, force=True): None when the body is not JSON
+    def json(self):
+        try:
+            return json.loads(self.body)
+        except ValueError:
+            return None
+
+    def header(self, name: str) -> str:
+        name = name.lower().encode('latin-1')
+        for key, value in self.scope.get('headers', []):
+            if key.lower() == name:
+                return value.decode('latin-1')
+        return None
+
+    #like request.args.get(name, default, type=int): bad values fall back to the default
+    def int_arg(self, name: str, default: int = None):
+        try:
+            return int(self.args[name])
+        except (KeyError, ValueError):
+            return default
+
+    def float_arg(self, name: str, default: float = None):
+        try:
+            return float(self.args[name])
+        except (KeyError, ValueError):
+            return default
+
+
+class AsyncElevatorAPI:
+    def __init__(self, wsgi_app=None, db_threads: int = DB_THREADS, wsgi_threads: int = WSGI_THREADS):
+        self.wsgi_app = wsgi_app or elevator_api.app
+        self.db_threads = db_threads
+        self.wsgi_threads = wsgi_threads
+        self.executor = None
+        self.wsgi_executor = None
+        #(method, path regex, route label for metrics, handler)
+        self.routes = [
+            ('POST', re.compile(r'^/elevators/(\d+)/demand$'), '/elevators/<int:elevator_id>/demand', self.record_demand),
+            ('POST', re.compile(r'^/elevators/(\d+)/state$'), '/elevators/<int:elevator_id>/state', self.record_state),
+            ('GET', re.compile(r'^/elevators/(\d+)/analytics$'), '/elevators/<int:elevator_id>/analytics', self.get_analytics),
+            ('GET', re.compile(r'^/elevators/(\d+)/current$'), '/elevators/<int:elevator_id>/current', self.get_current),
+            ('GET', re.compile(r'^/training-data$'), '/training-data', self.get_training_data),
+            ('GET', re.compile(r'^/health$'), '/health', self.health_check),
+        ]
+
+    #Service is looked up on every call, so tests (and reloads) that swap elevator_api.service are followed
+    @property
+    def service(self):
+        return elevator_api.service
+
+    async def run_db(self, fn, *args, **kwargs):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.db_threads, thread_name_prefix='elevator-db')
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(fn, *args, **kwargs))
+
+    async def run_wsgi(self, fn):
+        if self.wsgi_executor is None:
+            self.wsgi_executor = ThreadPoolExecutor(max_workers=self.wsgi_threads, thread_name_prefix='elevator-wsgi')
+        return await asyncio.get_running_loop().run_in_executor(self.wsgi_executor, fn)
+
+    def shutdown(self):
+        if self.wsgi_executor is not None:
+            self.wsgi_executor.shutdown(wait=True)
+            self.wsgi_executor = None
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                #schema check and pool warm up off the loop, before the first request
+                await self.run_db(elevator_api.warm_up)
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.run_db(lambda: None)  #let queued DB work finish first
+                self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _read_body(self, receive) -> bytes:
+        chunks = []
+        size = 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return None
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if size > MAX_BODY_BYTES:
+                raise HTTPError(413, f'body too large, max {MAX_BODY_BYTES} bytes')
+            chunks.append(chunk)
+            if not message.get('more_body', False):
+                return b''.join(chunks)
+
+    async def _http(self, scope, receive, send):
+        started = time.perf_counter()
+        route, method = 'unmatched', scope['method']
+        try:
+            body = await self._read_body(receive)
+        except HTTPError as e:
+            await self._send_json(send, e.status, {'error': str(e)})
+            return
+        if body is None:
+            return
+        if not elevator_api.background_started:
+            await self.run_db(elevator_api.start_background)
+        request = Request(scope, body)
+        if method == 'GET' and request.path == '/stream':
+            await self.stream(request, receive, send)
+            return
+        handler = None
+        for route_method, pattern, label, route_handler in self.routes:
+            match = pattern.match(request.path)
+            if match and route_method == method:
+                handler, args, route = route_handler, [int(value) for value in match.groups()], label
+                break
+        if handler is None:
+            #the Flask app records its own request metrics
+            await self._call_wsgi(request, receive, send)
+            return
+        try:
+            result = await handler(request, *args)
+        except HTTPError as e:
+            result = (e.status, {'error': str(e)})
+        if result is None:
+            #handler decided Flask should serve this one (streaming formats)
+            await self._call_wsgi(request, receive, send)
+            return
+        status, payload = result[:2]
+        await self._send_json(send, status, payload, result[2] if len(result) > 2 else None)
+        if metrics.ENABLED:
+            metrics.http_latency.observe(time.perf_counter() - started, route, method)
+            metrics.http_requests.inc(1, route, method, status)
+
+    async def _send_json(self, send, status: int, payload, headers: Dict = None):
+        body = json.dumps(payload, default=str).encode() if status != 304 else b''
+        extra = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in (headers or {}).items()]
+        if status != 304:
+            extra += [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]
+        await send({'type': 'http.response.start', 'status': status, 'headers': extra})
+        await send({'type': 'http.response.body', 'body': body})
+
+    #Same contract as elevator_api.cached_json: 304 and cache hits never leave the loop
+    async def _cached(self, request: Request, route: str, key: tuple, elevator_id: int, compute):
+        cache = elevator_api.response_cache
+        etag, last_modified = cache.validators(self.service.versions, key, elevator_id)
+        headers = validator_headers(etag, last_modified)
+        if cache.not_modified(etag, last_modified, request.header('If-None-Match'), request.header('If-Modified-Since'), route):
+            return 304, None, headers
+        body = cache.lookup(key, etag, route)
+        if body is None:
+            body = await self.run_db(compute)
+            cache.store(key, etag, body)
+        return 200, body, headers
+
+    #Runs the Flask app in a WSGI thread. The whole response, including a streamed body, is produced in
+    #that one thread (pooled connections are per thread) and handed to the loop through a bounded queue.
+    #A client that disconnects stops the generator at its next chunk
+    async def _call_wsgi(self, request: Request, receive, send):
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=STREAM_QUEUE_CHUNKS)
+        environ = self._environ(request)
+        gone = threading.Event()  #client went away, stop producing
+
+        def put(message):
+            asyncio.run_coroutine_threadsafe(queue.put(message), loop).result()
+
+        def produce():
+            response = {}
+
+            def start_response(status, headers, exc_info=None):
+                response['status'] = int(status.split(' ', 1)[0])
+                response['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+            try:
+                body = self.wsgi_app(environ, start_response)
+                try:
+                    started = False
+                    for chunk in body:
+                        if gone.is_set():
+                            return
+                        if not started:
+                            put(('start', response))
+                            started = True
+                        if chunk:
+                            put(('body', chunk))
+                    if not started:
+                        put(('start', response))
+                finally:
+                    if hasattr(body, 'close'):
+                        body.close()
+                put(('end', None))
+            except Exception as e:
+                put(('error', e))
+
+        producer = asyncio.ensure_future(self.run_wsgi(produce))
+        disconnect = asyncio.ensure_future(receive())
+        try:
+            while True:
+                getter = asyncio.ensure_future(queue.get())
+                done, _ = await asyncio.wait({getter, disconnect}, return_when=asyncio.FIRST_COMPLETED)
+                if getter not in done:
+                    getter.cancel()
+                    return
+                kind, value = getter.result()
+                if kind == 'start':
+                    await send({'type': 'http.response.start', 'status': value['status'], 'headers': value['headers']})
+                elif kind == 'body':
+                    await send({'type': 'http.response.body', 'body': value, 'more_body': True})
+                elif kind == 'end':
+                    await send({'type': 'http.response.body', 'body': b''})
+                    break
+                else:
+                    raise value
+        finally:
+            gone.set()
+            disconnect.cancel()
+            while not producer.done():
+                try:
+                    queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    await asyncio.sleep(0.005)
+
+    def _environ(self, request: Request) -> Dict:
+        server = request.scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': request.method,
+            'SCRIPT_NAME': request.scope.get('root_path', ''),
+            'PATH_INFO': unquote(request.path),
+            'QUERY_STRING': request.query_string.decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': 'HTTP/%s' % request.scope.get('http_version', '1.1'),
+            'CONTENT_LENGTH': str(len(request.body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': request.scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(request.body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in request.scope.get('headers', []):
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name == 'CONTENT_TYPE':
+                environ['CONTENT_TYPE'] = value
+            elif name != 'CONTENT_LENGTH':
+                key = 'HTTP_' + name
+                environ[key] = environ[key] + ',' + value if key in environ else value
+        return environ
+
+    #Routes, the bodies are the Flask ones (elevator_api.*_answer)
+    async def _answer(self, request: Request, answer):
+        if isinstance(answer, elevator_api.CachedAnswer):
+            try:
+                return await self._cached(request, *answer)
+            except Exception as e:
+                return 400, {'error': str(e)}
+        return answer
+
+    async def record_demand(self, request: Request, elevator_id: int):
+        return await self.run_db(elevator_api.demand_answer, elevator_id, request.json())
+
+    async def record_state(self, request: Request, elevator_id: int):
+        return await self.run_db(elevator_api.state_answer, elevator_id, request.json())
+
+    #?hours is answered from memory, on the loop
+    async def get_analytics(self, request: Request, elevator_id: int):
+        return await self._answer(request, elevator_api.analytics_answer(elevator_id, request.args))
+
+    async def get_current(self, request: Request, elevator_id: int):
+        return await self.run_db(elevator_api.current_answer, elevator_id, request.args)
+
+    #JSON pages are served here, ndjson / csv streams by the Flask route
+    async def get_training_data(self, request: Request):
+        try:
+            query = elevator_api.training_query(request.args)
+        except Exception as e:
+            return 400, {'error': str(e)}
+        if query['format'] != 'json':
+            return None
+        return await self._answer(request, elevator_api.training_answer(query))
+
+    #Same frames as the Flask route. The hub wakes the loop through call_soon_threadsafe, nothing polls
+    async def stream(self, request: Request, receive, send):
+        resume = request.header('Last-Event-ID') or request.args.get('resume')
+        try:
+            elevator_ids = [int(value) for value in parse_qs(request.query_string.decode('latin-1')).get('elevator_id', [])]
+            subscription, replayed, complete = await self.run_db(
+                elevator_api.stream_subscription, elevator_ids, request.int_arg('building_id'), request.args.get('types'), resume)
+        except Exception as e:
+            await self._send_json(send, 400, {'error': str(e)})
+            return
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+
+        def wake():
+            try:
+                loop.call_soon_threadsafe(ready.set)
+            except RuntimeError:  #loop already closed
+                pass
+        subscription.listener = wake
+        disconnect = asyncio.ensure_future(receive())
+
+        async def write(text: str):
+            await send({'type': 'http.response.body', 'body': text.encode(), 'more_body': True})
+        try:
+            await send({'type': 'http.response.start', 'status': 200,
+                        'headers': [(b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache'),
+                                    (b'x-accel-buffering', b'no')]})
+            await write(RETRY_FRAME + ('' if complete else RESET_FRAME) + ''.join(event.sse() for event in replayed))
+            while True:
+                ready.clear()
+                events = subscription.get(0)
+                if events:
+                    await write(''.join(event.sse() for event in events))
+                if subscription.closed:
+                    if subscription.dropped:
+                        await write(DROPPED_FRAME)
+                    break
+                if events:
+                    continue
+                waiter = asyncio.ensure_future(ready.wait())
+                done, _ = await asyncio.wait({waiter, disconnect}, timeout=elevator_api.STREAM_KEEPALIVE_SECONDS,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                waiter.cancel()
+                if disconnect in done:
+                    return
+                if not done:
+                    await write(KEEPALIVE_FRAME)
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            subscription.close()
+            disconnect.cancel()
+
+    async def health_check(self, request: Request):
+        return elevator_api.health_answer()
+
+
+application = AsyncElevatorAPI()
+
+
+#python -m app.asgi [--host 0.0.0.0] [--port 2025], needs uvicorn
+def main(argv: List[str] = None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Serve the elevator API on ASGI')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=2025)
+    args = parser.parse_args(argv)
+    try:
+        import uvicorn
+    except ImportError:
+        raise SystemExit('uvicorn is required: pip install uvicorn (or run any ASGI server on app.asgi:application)')
+    uvicorn.run(application, host=args.host, port=args.port, backlog=4096, timeout_keep_alive=30)
+
+
+if __name__ == '__main__':
+    main()
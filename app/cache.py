@@ -0,0 +1,144 @@
+import hashlib
+import math
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Callable, Dict, Tuple
+
+from app import metrics
+
+#Response cache for the read heavy routes (/elevators/<id>/analytics, /training-data).
+#Every committed write bumps its elevator's version in WriteVersions, in memory. ETags are built
+#from those versions, so a client that polls with If-None-Match gets a 304 without any DB work.
+#Cached bodies are stored under their ETag: after a write the ETag changes and the old entry is never
+#served again. The versions only count this process's writes, other writers (another worker, the importer,
+#the simulator, a standalone gateway or compactor) don't touch them, so every ETag also carries a ttl
+#sized window: results are recomputed at least once per ttl, which bounds how stale an answer gets after
+#an outside write. It covers time relative results (analytics over the last N days) too
+
+cache_requests = metrics.REGISTRY.register(metrics.Counter(
+    'elevator_cache_requests_total', 'Response cache lookups by route and result (hit, miss, not_modified)', ('route', 'result')))
+
+
+class WriteVersions:
+    def __init__(self):
+        #versions restart on every run, the epoch keeps old ETags from matching new data
+        self.epoch = uuid.uuid4().hex[:8]
+        self._lock = threading.Lock()
+        self._elevators = {}  #elevator_id -> [version, last write time]
+        self._fleet = [0, time.time()]  #any write
+        self._generation = [0, time.time()]  #bumped by rebuilds, invalidates everything
+
+    def bump(self, elevator_ids):
+        now = time.time()
+        with self._lock:
+            for elevator_id in set(elevator_ids):
+                entry = self._elevators.setdefault(elevator_id, [0, now])
+                entry[0] += 1
+                entry[1] = now
+            self._fleet[0] += 1
+            self._fleet[1] = now
+
+    def bump_all(self):
+        with self._lock:
+            self._generation[0] += 1
+            self._generation[1] = time.time()
+
+    #(version tag, last modified unix time) for one elevator, or the whole fleet when elevator_id is None
+    def tag(self, elevator_id: int = None) -> Tuple[str, float]:
+        with self._lock:
+            version, modified = self._fleet if elevator_id is None else self._elevators.get(elevator_id, (0, 0.0))
+            generation, regenerated = self._generation
+        return f'{self.epoch}.{generation}.{version}', max(modified, regenerated)
+
+
+class ResponseCache:
+    def __init__(self, max_entries: int = 1024, ttl: float = 30.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  #key -> (etag, body, expires_at)
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'not_modified': 0, 'evictions': 0}
+
+    #ETag and Last-Modified of the current result, from memory only
+    def validators(self, versions: WriteVersions, key: Tuple, elevator_id: int = None) -> Tuple[str, float]:
+        tag, modified = versions.tag(elevator_id)
+        if self.ttl:
+            window = int(time.time() // self.ttl)
+            tag += f'.{window}'
+            modified = max(modified, window * self.ttl)
+        #HTTP dates are whole seconds. Once the write's second is over, it is rounded up, so that
+        #not_modified can compare math.ceil() and still answer 304 when nothing changed
+        if math.ceil(modified) <= time.time():
+            modified = float(math.ceil(modified))
+        etag = hashlib.sha1(repr((key, tag)).encode()).hexdigest()[:20]
+        return etag, modified
+
+    #Cached body for key if it was stored under this etag and hasn't expired, else None
+    def lookup(self, key: Tuple, etag: str, route: str = None) -> Dict:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == etag and entry[2] > time.monotonic():
+                self._entries.move_to_end(key)
+                self._count('hits', 'hit', route)
+                return entry[1]
+            self._count('misses', 'miss', route)
+        return None
+
+    def store(self, key: Tuple, etag: str, body: Dict):
+        if not self.max_entries:
+            return
+        with self._lock:
+            self._entries[key] = (etag, body, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def get_or_compute(self, key: Tuple, etag: str, compute: Callable[[], Dict], route: str = None) -> Dict:
+        body = self.lookup(key, etag, route)
+        if body is None:
+            body = compute()
+            self.store(key, etag, body)
+        return body
+
+    def not_modified(self, etag: str, last_modified: float, if_none_match: str = None, if_modified_since: str = None,
+                     route: str = None) -> bool:
+        if if_none_match:
+            #If-None-Match wins over If-Modified-Since when both are sent
+            tags = [value.strip() for value in if_none_match.split(',')]
+            matched = '*' in tags or any(value.removeprefix('W/').strip('"') == etag for value in tags)
+        elif if_modified_since:
+            try:
+                #a write later in the second of the header is still a change
+                matched = math.ceil(last_modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                matched = False
+        else:
+            matched = False
+        if matched:
+            with self._lock:
+                self._count('not_modified', 'not_modified', route)
+        return matched
+
+    def _count(self, stat: str, result: str, route: str):
+        self._stats[stat] += 1
+        if metrics.ENABLED and route:
+            cache_requests.inc(1, route, result)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def metrics(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats, entries=len(self._entries), max_entries=self.max_entries, ttl=self.ttl)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+
+def validator_headers(etag: str, last_modified: float) -> Dict:
+    return {'ETag': f'"{etag}"', 'Last-Modified': formatdate(last_modified, usegmt=True), 'Cache-Control': 'no-cache'}
@@ -0,0 +1,93 @@
+import io
+import json
+import os
+import tarfile
+from typing import Dict, Iterable, List
+
+try:
+    import numpy as np
+except ImportError:  #only the columnar export needs numpy, the API runs without it
+    np = None
+
+#One typed array per training feature, small ints where the values allow it
+TRAINING_DTYPES = {
+    'elevator_id': 'int32',
+    'current_resting_floor': 'int16',
+    'rest_start_time': 'datetime64[ms]',
+    'next_demand_floor': 'int16',
+    'next_demand_time': 'datetime64[ms]',
+    'minutes_until_demand': 'float32',
+    'day_of_week': 'int8',
+    'hour_of_day': 'int8',
+    'is_peak_hour': 'bool',
+    'distance_to_demand': 'int16',
+    'recent_demand_frequency': 'int32',
+    'max_floor': 'int16',
+    'min_floor': 'int16',
+}
+
+
+def require_numpy():
+    if np is None:
+        raise RuntimeError("numpy is required for columnar exports (pip install numpy)")
+
+
+#Fills preallocated arrays chunk by chunk, so only one chunk of row tuples is alive at a time
+def build_arrays(columns: List[str], chunks: Iterable[List], total: int) -> Dict[str, 'np.ndarray']:
+    require_numpy()
+    arrays = {name: np.empty(total, dtype=TRAINING_DTYPES[name]) for name in columns}
+    filled = 0
+    for chunk in chunks:
+        if not chunk:
+            continue
+        #rows can grow between the count and the read, never write past the end
+        chunk = chunk[:total - filled]
+        end = filled + len(chunk)
+        for name, values in zip(columns, zip(*chunk)):
+            arrays[name][filled:end] = np.asarray(values, dtype=TRAINING_DTYPES[name])
+        filled = end
+        if filled == total:
+            break
+    #and rows can also disappear (rebuild), trim instead of returning garbage
+    if filled < total:
+        arrays = {name: array[:filled] for name, array in arrays.items()}
+    return arrays
+
+
+def manifest(arrays: Dict[str, 'np.ndarray'], **extra) -> Dict:
+    rows = len(next(iter(arrays.values()))) if arrays else 0
+    return dict(extra, rows=rows, columns={
+        name: {'file': f'{name}.npy', 'dtype': str(array.dtype), 'shape': list(array.shape)}
+        for name, array in arrays.items()})
+
+
+def write_npz(arrays: Dict[str, 'np.ndarray'], fileobj):
+    require_numpy()
+    np.savez(fileobj, **arrays)
+
+
+#One .npy per column plus manifest.json, each file can be opened with np.load(mmap_mode='r')
+def write_npy_dir(arrays: Dict[str, 'np.ndarray'], directory: str, **extra) -> Dict:
+    require_numpy()
+    os.makedirs(directory, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(directory, f'{name}.npy'), array)
+    info = manifest(arrays, **extra)
+    with open(os.path.join(directory, 'manifest.json'), 'w') as f:
+        json.dump(info, f, indent=2)
+    return info
+
+
+#Same layout as write_npy_dir but packed in an uncompressed tar for HTTP downloads
+def write_npy_tar(arrays: Dict[str, 'np.ndarray'], fileobj, **extra):
+    require_numpy()
+    with tarfile.open(fileobj=fileobj, mode='w') as tar:
+        def add(name, data: bytes):
+            member = tarfile.TarInfo(name)
+            member.size = len(data)
+            tar.addfile(member, io.BytesIO(data))
+        add('manifest.json', json.dumps(manifest(arrays, **extra), indent=2).encode())
+        for name, array in arrays.items():
+            buffer = io.BytesIO()
+            np.save(buffer, array)
+            add(f'{name}.npy', buffer.getvalue())
@@ -0,0 +1,322 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List
+
+from app import sketches, timestamps
+
+logger = logging.getLogger(__name__)
+
+#Retention tiers for elevator_states, oldest data is the coarsest:
+#   raw reports            newer than raw_days
+#   compacted intervals    newer than interval_days, one row per run of identical
+#                          (elevator_id, floor, state, passenger_count) reports
+#   hourly aggregates      newer than hourly_days (None keeps them forever), time spent per state and floor
+#Work is done per elevator in small transactions with a pause in between, so live writers
+#never wait on compaction for more than one chunk
+
+
+class RetentionPolicy:
+    def __init__(self, raw_days: int = 7, interval_days: int = 90, hourly_days: int = None):
+        if raw_days < 0 or interval_days < raw_days:
+            raise ValueError("Retention must be 0 <= raw_days <= interval_days")
+        if hourly_days is not None and hourly_days < interval_days:
+            raise ValueError("hourly_days must be at least interval_days")
+        self.raw_days = raw_days
+        self.interval_days = interval_days
+        self.hourly_days = hourly_days
+
+    #ELEVATOR_RETENTION_RAW_DAYS / _INTERVAL_DAYS / _HOURLY_DAYS, hourly kept forever when unset
+    @classmethod
+    def from_env(cls) -> 'RetentionPolicy':
+        hourly_days = os.environ.get('ELEVATOR_RETENTION_HOURLY_DAYS')
+        return cls(raw_days=int(os.environ.get('ELEVATOR_RETENTION_RAW_DAYS', 7)),
+                   interval_days=int(os.environ.get('ELEVATOR_RETENTION_INTERVAL_DAYS', 90)),
+                   hourly_days=int(hourly_days) if hourly_days else None)
+
+    def __repr__(self):
+        return f'RetentionPolicy(raw_days={self.raw_days}, interval_days={self.interval_days}, hourly_days={self.hourly_days})'
+
+
+class StateCompactor:
+    def __init__(self, service, policy: RetentionPolicy = None, chunk_size: int = 5000, pause: float = 0.05,
+                 interval: float = 300.0, vacuum_pages: int = 1000):
+        self.service = service
+        self.policy = policy or RetentionPolicy()
+        self.chunk_size = chunk_size
+        self.pause = pause  #seconds between chunks, lets queued writers in
+        self.interval = interval  #seconds between background passes
+        self.vacuum_pages = vacuum_pages  #freelist pages released per incremental vacuum step
+        self._stop = threading.Event()
+        self._thread = None
+        self._stats = {'passes': 0, 'raw_rows_compacted': 0, 'intervals_created': 0, 'intervals_rolled_up': 0,
+                       'hourly_rows_expired': 0, 'pages_vacuumed': 0, 'last_pass_seconds': 0.0, 'last_error': None}
+
+    #Plain and sharded services alike, every shard has its own tables
+    def _databases(self) -> List:
+        return getattr(self.service, 'shards', None) or [self.service]
+
+    def _now_ms(self, now: datetime = None) -> int:
+        return timestamps.to_ms(now or datetime.now())
+
+    def _chunk_done(self):
+        if self.pause:
+            time.sleep(self.pause)
+
+    #One pass over every tier, oldest first so each row moves at most one tier per pass
+    def run_once(self, now: datetime = None) -> Dict:
+        started = time.perf_counter()
+        result = {'hourly_rows_expired': self.expire_hourly(now),
+                  'intervals_rolled_up': self.roll_up_intervals(now)}
+        result.update(self.compact_raw(now))
+        result['seconds'] = time.perf_counter() - started
+        self._stats['passes'] += 1
+        self._stats['last_pass_seconds'] = result['seconds']
+        for key in ('raw_rows_compacted', 'intervals_created', 'intervals_rolled_up', 'hourly_rows_expired'):
+            self._stats[key] += result[key]
+        return result
+
+    #Tier 1: raw reports older than raw_days become intervals. Repeated reports of a run are dropped,
+    #and so are their training samples: the first report stays the resting state id, like a rebuild would
+    def compact_raw(self, now: datetime = None) -> Dict:
+        cutoff = self._now_ms(now) - self.policy.raw_days * timestamps.DAY_MS
+        totals = {'raw_rows_compacted': 0, 'intervals_created': 0}
+        for database in self._databases():
+            for elevator_id in self._elevator_ids(database, "SELECT DISTINCT elevator_id FROM elevator_states WHERE timestamp < ?", cutoff):
+                while True:
+                    compacted, created = self._compact_chunk(database, elevator_id, cutoff)
+                    totals['raw_rows_compacted'] += compacted
+                    totals['intervals_created'] += created
+                    if compacted < self.chunk_size:
+                        break
+                    self._chunk_done()
+        return totals
+
+    def _elevator_ids(self, database, query: str, cutoff: int) -> List[int]:
+        conn = database.get_connection()
+        try:
+            return [row[0] for row in conn.execute(query, (cutoff,)).fetchall()]
+        finally:
+            conn.close()
+
+    def _compact_chunk(self, database, elevator_id: int, cutoff: int):
+        conn = database.get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute("""
+                SELECT id, floor, state, passenger_count, previous_floor, timestamp FROM elevator_states
+                WHERE elevator_id = ? AND timestamp < ? ORDER BY timestamp, id LIMIT ?
+            """, (elevator_id, cutoff, self.chunk_size))
+            rows = cursor.fetchall()
+            if not rows:
+                conn.rollback()
+                return 0, 0
+            #the newest interval keeps growing while the same run goes on past the last pass
+            cursor.execute("""
+                SELECT id, floor, state, passenger_count, end_time, report_count FROM elevator_state_intervals
+                WHERE elevator_id = ? ORDER BY start_time DESC, id DESC LIMIT 1
+            """, (elevator_id,))
+            last = cursor.fetchone()
+            current = dict(last) if last else None
+            extended = None  #existing interval that got more reports
+            created = []
+            collapsed = []  #resting state ids folded into an earlier report
+            for row in rows:
+                key = (row['floor'], row['state'], row['passenger_count'])
+                if current is not None and key == (current['floor'], current['state'], current['passenger_count']) \
+                        and row['timestamp'] >= current['end_time']:
+                    current['end_time'] = row['timestamp']
+                    current['report_count'] += 1
+                    if current.get('id') is not None:
+                        extended = current
+                    if row['state'] == 'resting':
+                        collapsed.append(row['id'])
+                    continue
+                current = {'id': None, 'floor': row['floor'], 'state': row['state'], 'passenger_count': row['passenger_count'],
+                           'previous_floor': row['previous_floor'], 'first_state_id': row['id'],
+                           'start_time': row['timestamp'], 'end_time': row['timestamp'], 'report_count': 1}
+                created.append(current)
+            if extended is not None:
+                cursor.execute("UPDATE elevator_state_intervals SET end_time = ?, report_count = ? WHERE id = ?",
+                               (extended['end_time'], extended['report_count'], extended['id']))
+            cursor.executemany("""
+                INSERT INTO elevator_state_intervals (elevator_id, floor, state, passenger_count, previous_floor,
+                    first_state_id, start_time, end_time, report_count)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, [(elevator_id, item['floor'], item['state'], item['passenger_count'], item['previous_floor'],
+                   item['first_state_id'], item['start_time'], item['end_time'], item['report_count']) for item in created])
+            cursor.executemany("DELETE FROM elevator_states WHERE id = ?", [(row['id'],) for row in rows])
+            self._forget_samples(cursor, elevator_id, collapsed)
+            cursor.executemany("DELETE FROM ml_training_data WHERE resting_state_id = ?", [(state_id,) for state_id in collapsed])
+            cursor.executemany("DELETE FROM open_resting_periods WHERE state_id = ?", [(state_id,) for state_id in collapsed])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        if collapsed:
+            database.versions.bump([elevator_id])  #its training samples changed
+        return len(rows), len(created)
+
+    #Waits of the samples about to be deleted come out of the sketches too, they stay equal to a rebuild
+    def _forget_samples(self, cursor, elevator_id: int, state_ids: List[int]):
+        updates = {}
+        for state_id in state_ids:
+            cursor.execute("SELECT rest_start_time, minutes_until_demand FROM ml_training_data WHERE resting_state_id = ?", (state_id,))
+            row = cursor.fetchone()
+            if row is not None:
+                key = (elevator_id, timestamps.hour_bucket(row[0]), 'wait_minutes')
+                updates.setdefault(key, []).append(('remove', row[1]))
+        sketches.apply_updates(cursor, updates)
+
+    #Tier 2: intervals older than interval_days become time per (hour, state, floor). An interval lasts
+    #until the next one starts (the last known one until its last report) and is split across hours
+    def roll_up_intervals(self, now: datetime = None) -> int:
+        cutoff = self._now_ms(now) - self.policy.interval_days * timestamps.DAY_MS
+        rolled = 0
+        for database in self._databases():
+            for elevator_id in self._elevator_ids(database, "SELECT DISTINCT elevator_id FROM elevator_state_intervals WHERE start_time < ?", cutoff):
+                while True:
+                    count = self._roll_up_chunk(database, elevator_id, cutoff)
+                    rolled += count
+                    if count < self.chunk_size:
+                        break
+                    self._chunk_done()
+        return rolled
+
+    def _roll_up_chunk(self, database, elevator_id: int, cutoff: int) -> int:
+        conn = database.get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute("""
+                SELECT id, floor, state, start_time, end_time, report_count FROM elevator_state_intervals
+                WHERE elevator_id = ? AND start_time < ? ORDER BY start_time, id LIMIT ?
+            """, (elevator_id, cutoff, self.chunk_size))
+            rows = cursor.fetchall()
+            if not rows:
+                conn.rollback()
+                return 0
+            #where the last interval of the chunk ends: next interval, else next raw report
+            cursor.execute("""
+                SELECT MIN(start_time) FROM (
+                    SELECT start_time FROM elevator_state_intervals WHERE elevator_id = ? AND start_time >= ? AND id != ?
+                    UNION ALL
+                    SELECT timestamp FROM elevator_states WHERE elevator_id = ? AND timestamp >= ?)
+            """, (elevator_id, rows[-1]['start_time'], rows[-1]['id'], elevator_id, rows[-1]['start_time']))
+            following = cursor.fetchone()[0]
+            buckets = {}
+            for index, row in enumerate(rows):
+                if index + 1 < len(rows):
+                    stop = rows[index + 1]['start_time']
+                else:
+                    stop = following if following is not None else row['end_time']
+                start = row['start_time']
+                first = buckets.setdefault((timestamps.hour_bucket(start), row['state'], row['floor']), [0, 0, 0])
+                first[1] += 1
+                first[2] += row['report_count']
+                while start < stop:
+                    bucket = timestamps.hour_bucket(start)
+                    end = min(stop, bucket + timestamps.HOUR_MS)
+                    buckets.setdefault((bucket, row['state'], row['floor']), [0, 0, 0])[0] += end - start
+                    start = end
+            cursor.executemany("""
+                INSERT INTO elevator_state_hourly (elevator_id, hour_bucket, state, floor, duration_ms, interval_count, report_count)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (elevator_id, hour_bucket, state, floor) DO UPDATE SET
+                    duration_ms = duration_ms + excluded.duration_ms,
+                    interval_count = interval_count + excluded.interval_count,
+                    report_count = report_count + excluded.report_count
+            """, [(elevator_id,) + key + tuple(values) for key, values in buckets.items()])
+            cursor.executemany("DELETE FROM elevator_state_intervals WHERE id = ?", [(row['id'],) for row in rows])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        return len(rows)
+
+    #Tier 3: hourly aggregates older than hourly_days are dropped
+    def expire_hourly(self, now: datetime = None) -> int:
+        if self.policy.hourly_days is None:
+            return 0
+        cutoff = self._now_ms(now) - self.policy.hourly_days * timestamps.DAY_MS
+        expired = 0
+        for database in self._databases():
+            for elevator_id in self._elevator_ids(database, "SELECT DISTINCT elevator_id FROM elevator_state_hourly WHERE hour_bucket < ?", cutoff):
+                conn = database.get_connection()
+                try:
+                    cursor = conn.execute("DELETE FROM elevator_state_hourly WHERE elevator_id = ? AND hour_bucket < ?",
+                                          (elevator_id, cutoff))
+                    expired += cursor.rowcount
+                    conn.commit()
+                finally:
+                    conn.close()
+                self._chunk_done()
+        return expired
+
+    #Gives free pages back to the file system. Databases created with auto_vacuum=INCREMENTAL release
+    #vacuum_pages at a time; older ones need full=True once, a VACUUM that also switches them to incremental
+    def vacuum(self, full: bool = False, max_pages: int = None) -> Dict:
+        result = {'pages_freed': 0, 'full': []}
+        for database in self._databases():
+            conn = database.get_connection()
+            try:
+                mode = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+                before = conn.execute("PRAGMA page_count").fetchone()[0]
+                if full:
+                    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                    conn.execute("VACUUM")
+                    result['full'].append(database.db_path)
+                elif mode == 2:  #INCREMENTAL
+                    released = 0
+                    while max_pages is None or released < max_pages:
+                        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+                        if not free:
+                            break
+                        step = min(free, self.vacuum_pages, max_pages - released if max_pages is not None else free)
+                        conn.execute(f"PRAGMA incremental_vacuum({int(step)})").fetchall()
+                        released += step
+                        self._chunk_done()
+                result['pages_freed'] += before - conn.execute("PRAGMA page_count").fetchone()[0]
+            finally:
+                conn.close()
+        self._stats['pages_vacuumed'] += result['pages_freed']
+        return result
+
+    #Background mode: a pass every `interval` seconds, incremental vacuum after each one
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='state-compactor', daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+                self.vacuum()
+                self._stats['last_error'] = None
+            except Exception as e:
+                logger.exception("state compaction pass failed")
+                self._stats['last_error'] = str(e)
+            self._stop.wait(self.interval)
+
+    def stop(self, timeout: float = None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def metrics(self) -> Dict:
+        stats = dict(self._stats)
+        stats['running'] = self._thread is not None and self._thread.is_alive()
+        stats['policy'] = {'raw_days': self.policy.raw_days, 'interval_days': self.policy.interval_days,
+                           'hourly_days': self.policy.hourly_days}
+        return stats
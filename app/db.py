@@ -0,0 +1,119 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict
+
+from app import metrics
+
+#Pragmas every pooled connection gets once when it is opened
+DEFAULT_PRAGMAS = {
+    'auto_vacuum': 'INCREMENTAL',  #new files only, must come before WAL. Compaction frees pages a few at a time
+    'journal_mode': 'WAL',  #readers don't block the writer
+    'synchronous': 'NORMAL',  #fsync on checkpoint, not on every commit (safe with WAL)
+    'busy_timeout': 5000,  #ms to wait on a locked DB instead of failing right away
+    'cache_size': -20000,  #negative = KiB, ~20MB page cache per connection
+    'mmap_size': 268435456,  #256MB memory mapped reads
+    'temp_store': 'MEMORY',
+}
+
+
+#Connection that goes back to the pool on close(), so the existing
+#"get_connection() ... conn.close()" code keeps working unchanged
+class PooledConnection(sqlite3.Connection):
+    #Statements are timed per kind/table when metrics are on
+    def cursor(self, factory=None):
+        if factory is None:
+            factory = metrics.InstrumentedCursor if metrics.ENABLED else sqlite3.Cursor
+        return super().cursor(factory)
+
+    #sqlite3.Connection.execute doesn't go through cursor(), route it there
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, parameters):
+        return self.cursor().executemany(sql, parameters)
+
+    def close(self):
+        #never hand back a connection with a half done transaction
+        if self.in_transaction:
+            self.rollback()
+
+    def close_for_real(self):
+        sqlite3.Connection.close(self)
+
+
+#One connection per thread, opened and configured once, reused for every request
+class ConnectionPool:
+    def __init__(self, db_path: str, pragmas: Dict = None):
+        self.db_path = db_path
+        self.pragmas = dict(DEFAULT_PRAGMAS if pragmas is None else pragmas)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []  #(thread, connection) so shutdown can close all of them
+        self._pid = os.getpid()
+        self._closed = False
+
+    def _connect(self) -> PooledConnection:
+        #check_same_thread is off only so close_all can run from the shutdown thread,
+        #each connection is still used by a single thread
+        conn = sqlite3.connect(self.db_path, factory=PooledConnection, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        for name, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {name}={value}")
+        return conn
+
+    def get(self) -> PooledConnection:
+        if not metrics.ENABLED:
+            return self._get()
+        started = time.perf_counter()
+        conn = self._get()
+        metrics.connection_wait.observe(time.perf_counter() - started)
+        return conn
+
+    def _get(self) -> PooledConnection:
+        if self._closed:
+            raise RuntimeError("Connection pool is closed")
+        #sqlite connections must not cross a fork, start fresh in the child
+        if os.getpid() != self._pid:
+            self._reset_after_fork()
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            with self._lock:
+                self._prune_dead_threads()
+                self._connections.append((threading.current_thread(), conn))
+        return conn
+
+    #Connections of threads that already finished are closed here
+    def _prune_dead_threads(self):
+        alive = []
+        for thread, conn in self._connections:
+            if thread.is_alive():
+                alive.append((thread, conn))
+            else:
+                conn.close_for_real()
+        self._connections = alive
+
+    def _reset_after_fork(self):
+        self._pid = os.getpid()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+
+    @property
+    def size(self) -> int:
+        return len(self._connections)
+
+    #Clean shutdown, closes every connection the pool ever handed out
+    def close_all(self):
+        with self._lock:
+            self._closed = True
+            for _, conn in self._connections:
+                try:
+                    conn.close_for_real()
+                except sqlite3.Error:
+                    pass
+            self._connections = []
+        self._local = threading.local()
@@ -1,110 +1,984 @@
+import atexit
+import base64
+import click
+import csv
+import io
+import json
+import logging
+import os
 import sqlite3
-from flask import Flask, request, jsonify
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from flask import Flask, Response, g, request, jsonify
 from datetime import datetime, timedelta
 
 from typing import Dict, List
 
+from app import columnar, metrics, optimizer, rules, sketches, timestamps
+from app.compaction import RetentionPolicy, StateCompactor
+from app.cache import ResponseCache, WriteVersions, validator_headers
+from app.db import ConnectionPool
+from app.events import DROPPED_FRAME, KEEPALIVE_FRAME, RESET_FRAME, RETRY_FRAME, EventHub
+from app.hotstore import HotStore
+from app.ingest_queue import IngestQueue, QueueClosedError, QueueFullError
+from app.predictor import DemandPredictor
+from app.registry import ELEVATOR_COLUMNS, REGISTRY_SCHEMA, ElevatorRegistry, bump_version, check_bounds
+
 app = Flask(__name__)
+logger = logging.getLogger(__name__)
 DATABASE = 'elevator_data.db'
+VALID_STATES = ('resting', 'moving', 'occupied')
+MAX_BATCH_SIZE = 5000
+#PRAGMA user_version once the time columns hold epoch milliseconds
+EPOCH_MS_VERSION = 1
+#PRAGMA user_version once the derived tables exist (training data, change feed, compaction tiers, rollups, sketches)
+DERIVED_TABLES_VERSION = 2
+#PRAGMA user_version once the elevator registry has its change counter (see app/registry.py)
+REGISTRY_VERSION = 3
+#Schema steps in order: (user_version the step brings the file to, ElevatorDataService method).
+#A schema change is a new step at the end, applied steps are never edited
+MIGRATIONS = [(EPOCH_MS_VERSION, 'migrate_to_epoch_ms'), (DERIVED_TABLES_VERSION, 'migrate_derived_tables'),
+              (REGISTRY_VERSION, 'migrate_registry')]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+#PRAGMA user_version of the sharded mode's catalog DB: 1 CATALOG_SCHEMA and FEED_CONSUMERS_SCHEMA, 2 REGISTRY_SCHEMA
+CATALOG_VERSION = 2
+#Fields clients may set on a building, elevators take every ELEVATOR_COLUMNS but id
+BUILDING_FIELDS = {'name', 'total_floors'}
+#Seconds between checks for elevator registry changes made by other processes
+REGISTRY_RECHECK_SECONDS = float(os.environ.get('ELEVATOR_REGISTRY_RECHECK', 5))
+#Recent events kept in memory (app/hotstore.py): hours of history and bytes per elevator
+HOT_WINDOW_HOURS = float(os.environ.get('ELEVATOR_HOT_WINDOW_HOURS', 6))
+HOT_BUDGET_BYTES = int(os.environ.get('ELEVATOR_HOT_BYTES', 64 * 1024))
+#Indexes on the raw time columns, dropped and built again by the epoch ms migration
+TIME_INDEX_NAMES = ('ind_demand_events_elevator_time', 'ind_elevator_states_elevator_time')
+TIME_INDEXES = """
+CREATE INDEX IF NOT EXISTS ind_demand_events_elevator_time ON demand_events(elevator_id, request_time);
+CREATE INDEX IF NOT EXISTS ind_elevator_states_elevator_time ON elevator_states(elevator_id, timestamp);
+"""
+#Percentile analytics defaults and the allowed group_by values
+DEFAULT_QUANTILES = (0.5, 0.95, 0.99)
+PERCENTILE_GROUPS = (None, 'hour_of_day', 'day_of_week')
+#Columns returned by /training-data, in order
+TRAINING_COLUMNS = ['elevator_id', 'current_resting_floor', 'rest_start_time', 'next_demand_floor', 'next_demand_time',
+                    'minutes_until_demand', 'day_of_week', 'hour_of_day', 'is_peak_hour', 'distance_to_demand',
+                    'recent_demand_frequency', 'max_floor', 'min_floor']
+TRAINING_KEY = 'rest_start_time, elevator_id, resting_state_id'  #keyset order, cursors encode these three
+
+
+#buildings and elevators, also the whole schema of the sharded mode's catalog DB
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS buildings (
+    id INTEGER PRIMARY KEY,
+    name VARCHAR(100) NOT NULL,
+    total_floors INTEGER NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS elevators (
+    id INTEGER PRIMARY KEY,
+    building_id INTEGER NOT NULL,
+    name VARCHAR(50) NOT NULL,
+    max_capacity INTEGER NOT NULL DEFAULT 10,
+    min_floor INTEGER NOT NULL DEFAULT 1,
+    max_floor INTEGER NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (building_id) REFERENCES buildings(id)
+);
+"""
+
+#Raw event tables, the time indexes are in TIME_INDEXES
+RAW_SCHEMA = """
+CREATE TABLE IF NOT EXISTS demand_events (
+    id INTEGER PRIMARY KEY,
+    elevator_id INTEGER NOT NULL,
+    requested_floor INTEGER NOT NULL,
+    request_time INTEGER NOT NULL, --epoch ms
+    day_of_week INTEGER NOT NULL, -- 0 Sunday 6 Saturday
+    hour_of_day INTEGER NOT NULL,  -- 0 23 not 24
+    is_peak_hour BOOLEAN NOT NULL DEFAULT FALSE,
+    weather_condition VARCHAR(20), --Optioinal
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (elevator_id) REFERENCES elevators(id)
+);
+
+CREATE TABLE IF NOT EXISTS elevator_states (
+    id INTEGER PRIMARY KEY,
+    elevator_id INTEGER NOT NULL,
+    floor INTEGER NOT NULL,
+    state VARCHAR(20) NOT NULL,
+    passenger_count INTEGER DEFAULT 0,
+    timestamp INTEGER NOT NULL, --epoch ms
+    previous_floor INTEGER, --last floor before change
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (elevator_id) REFERENCES elevators(id)
+);
+
+CREATE INDEX IF NOT EXISTS ind_elevator_states_state ON elevator_states(state);
+CREATE INDEX IF NOT EXISTS ind_demand_events_peak_hour ON demand_events(is_peak_hour, hour_of_day);
+"""
+
+#Named /training-data/changes readers and the last watermark they committed.
+#Lives in the catalog DB in sharded mode
+FEED_CONSUMERS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS training_feed_consumers (
+    name TEXT PRIMARY KEY,
+    watermark TEXT NOT NULL,
+    updated_at INTEGER NOT NULL --epoch ms
+);
+"""
+
+#Keyset cursors for /training-data are opaque to clients, base64 of the last row's key
+def encode_training_cursor(rest_start_time: int, elevator_id: int, resting_state_id: int) -> str:
+    raw = json.dumps([rest_start_time, elevator_id, resting_state_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_training_cursor(value: str) -> List:
+    try:
+        raw = base64.urlsafe_b64decode(value + '=' * (-len(value) % 4))
+        rest_start_time, elevator_id, resting_state_id = json.loads(raw)
+        #cursors handed out before the epoch ms migration carry the time as text
+        rest_start_time = timestamps.to_ms(rest_start_time)
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"Invalid cursor: {value}") from e
+    return [rest_start_time, int(elevator_id), int(resting_state_id)]
+
+#Change feed watermarks are the seq of the last sample a reader has seen, '0' is the beginning
+def parse_watermark(value) -> int:
+    try:
+        seq = int(value)
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"Invalid watermark: {value}") from e
+    if seq < 0:
+        raise ValueError(f"Invalid watermark: {value}")
+    return seq
+
+#Buildings, elevators, event validation and training feed consumers: everything that only needs the
+#registry database. ElevatorDataService runs it on its own file, ShardedElevatorDataService on the catalog.
+#Subclasses provide get_connection(), registry, versions, parse_watermark() and _elevator_has_events()
+class CatalogMixin:
+    #Buildings and elevators. Elevator changes bump registry_version in the same transaction and
+    #update this process's registry, other processes see them within ELEVATOR_REGISTRY_RECHECK seconds
+    def list_buildings(self) -> List[Dict]:
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT b.id, b.name, b.total_floors, COUNT(e.id) AS elevator_count
+            FROM buildings b LEFT JOIN elevators e ON e.building_id = b.id
+            GROUP BY b.id ORDER BY b.id
+        """)
+        buildings = [dict(row) for row in cursor.fetchall()]
+        conn.close()
+        return buildings
+
+    def get_building(self, building_id: int) -> Dict:
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, name, total_floors FROM buildings WHERE id = ?", (building_id,))
+        row = cursor.fetchone()
+        conn.close()
+        if row is None:
+            return None
+        return dict(row, elevator_ids=self.get_building_elevator_ids(building_id))
+
+    def _building_values(self, fields: Dict, required: bool) -> Dict:
+        values = {}
+        if 'name' in fields or required:
+            name = fields.get('name')
+            if not isinstance(name, str) or not name.strip():
+                raise ValueError("name is required")
+            values['name'] = name.strip()
+        if 'total_floors' in fields or required:
+            values['total_floors'] = self._require_int(fields, 'total_floors')
+            if values['total_floors'] < 1:
+                raise ValueError("total_floors must be at least 1")
+        unknown = set(fields) - BUILDING_FIELDS
+        if unknown:
+            raise ValueError(f"Unknown building fields: {', '.join(sorted(unknown))}")
+        return values
+
+    def create_building(self, name: str, total_floors: int, building_id: int = None) -> Dict:
+        values = self._building_values({'name': name, 'total_floors': total_floors}, required=True)
+        conn = self.get_connection()
+        try:
+            cursor = conn.execute("INSERT INTO buildings (id, name, total_floors) VALUES (?, ?, ?)",
+                                  (building_id, values['name'], values['total_floors']))
+            conn.commit()
+        except sqlite3.IntegrityError:
+            raise ValueError(f"Building {building_id} already exists")
+        finally:
+            conn.close()
+        return self.get_building(cursor.lastrowid)
+
+    def update_building(self, building_id: int, fields: Dict) -> Dict:
+        values = self._building_values(fields, required=False)
+        if values:
+            conn = self.get_connection()
+            assignments = ', '.join(f'{column} = ?' for column in values)
+            conn.execute(f"UPDATE buildings SET {assignments} WHERE id = ?", list(values.values()) + [building_id])
+            conn.commit()
+            conn.close()
+        return self.get_building(building_id)
+
+    #Only empty buildings, elevators go first
+    def delete_building(self, building_id: int) -> bool:
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute("SELECT COUNT(*) FROM elevators WHERE building_id = ?", (building_id,))
+            if cursor.fetchone()[0]:
+                raise ValueError(f"Building {building_id} still has elevators")
+            cursor.execute("DELETE FROM buildings WHERE id = ?", (building_id,))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        return cursor.rowcount > 0
+
+    def list_elevators(self, building_id: int = None) -> List[Dict]:
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        columns = ', '.join(ELEVATOR_COLUMNS)
+        if building_id is None:
+            cursor.execute(f"SELECT {columns} FROM elevators ORDER BY id")
+        else:
+            cursor.execute(f"SELECT {columns} FROM elevators WHERE building_id = ? ORDER BY id", (building_id,))
+        elevators = [dict(row) for row in cursor.fetchall()]
+        conn.close()
+        return elevators
+
+    def get_elevator(self, elevator_id: int) -> Dict:
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT {', '.join(ELEVATOR_COLUMNS)} FROM elevators WHERE id = ?", (elevator_id,))
+        row = cursor.fetchone()
+        conn.close()
+        return dict(row) if row else None
+
+    #Checks the fields of an elevator after a create / update merged them
+    def _check_elevator(self, cursor, elevator: Dict):
+        for field in ('building_id', 'max_capacity', 'min_floor', 'max_floor'):
+            self._require_int(elevator, field)
+        if not isinstance(elevator.get('name'), str) or not elevator['name'].strip():
+            raise ValueError("name is required")
+        if elevator['min_floor'] > elevator['max_floor']:
+            raise ValueError("min_floor must not be above max_floor")
+        if elevator['max_capacity'] < 1:
+            raise ValueError("max_capacity must be at least 1")
+        cursor.execute("SELECT 1 FROM buildings WHERE id = ?", (elevator['building_id'],))
+        if cursor.fetchone() is None:
+            raise ValueError(f"Building {elevator['building_id']} not found")
+
+    #Writes an elevator row and the registry version in one transaction, then the local registry
+    def _save_elevator(self, elevator: Dict, insert: bool) -> Dict:
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            self._check_elevator(cursor, elevator)
+            if insert:
+                cursor.execute(f"INSERT INTO elevators ({', '.join(ELEVATOR_COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?)",
+                               [elevator[column] for column in ELEVATOR_COLUMNS])
+                elevator['id'] = cursor.lastrowid
+            else:
+                cursor.execute("""
+                    UPDATE elevators SET building_id = ?, name = ?, max_capacity = ?, min_floor = ?, max_floor = ?
+                    WHERE id = ?
+                """, [elevator[column] for column in ELEVATOR_COLUMNS[1:]] + [elevator['id']])
+            version = bump_version(cursor)
+            conn.commit()
+        except sqlite3.IntegrityError:
+            conn.rollback()
+            raise ValueError(f"Elevator {elevator['id']} already exists")
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        self.registry.put(elevator['id'], elevator, version)
+        self.versions.bump([elevator['id']])
+        return elevator
+
+    def create_elevator(self, building_id: int, name: str, min_floor: int, max_floor: int, max_capacity: int = 10,
+                        elevator_id: int = None) -> Dict:
+        return self._save_elevator({'id': elevator_id, 'building_id': building_id, 'name': name,
+                                    'max_capacity': max_capacity, 'min_floor': min_floor, 'max_floor': max_floor},
+                                   insert=True)
+
+    #Partial update, fields is any subset of building_id, name, max_capacity, min_floor, max_floor
+    def update_elevator(self, elevator_id: int, fields: Dict) -> Dict:
+        unknown = set(fields) - set(ELEVATOR_COLUMNS[1:])
+        if unknown:
+            raise ValueError(f"Unknown elevator fields: {', '.join(sorted(unknown))}")
+        elevator = self.get_elevator(elevator_id)
+        if elevator is None:
+            return None
+        elevator.update(fields)
+        return self._save_elevator(elevator, insert=False)
+
+    #Elevators with recorded events stay, their history references them
+    def delete_elevator(self, elevator_id: int) -> bool:
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            if self._elevator_has_events(cursor, elevator_id):
+                raise ValueError(f"Elevator {elevator_id} has recorded events")
+            cursor.execute("DELETE FROM elevators WHERE id = ?", (elevator_id,))
+            deleted = cursor.rowcount > 0
+            version = bump_version(cursor) if deleted else None
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        if deleted:
+            self.registry.put(elevator_id, None, version)
+            self.versions.bump([elevator_id])
+        return deleted
+
+    #Define peak hours based on business rules
+    def is_peak_hour(self, hour: int, day_of_week: int) -> bool:
+        return rules.is_peak_hour(hour, day_of_week)
+
+    #Batch timestamps come from JSON, so they can be ISO strings
+    def _parse_event_time(self, value) -> datetime:
+        if value is None:
+            return datetime.now()
+        if isinstance(value, datetime):
+            return timestamps.wall_clock(value)
+        return timestamps.wall_clock(datetime.fromisoformat(value))
+
+    def _require_int(self, event: Dict, field: str, required: bool = True):
+        value = event.get(field)
+        if value is None:
+            if required:
+                raise ValueError(f"{field} is required")
+            return None
+        #bool is an int in python, but not a floor
+        if isinstance(value, bool) or not isinstance(value, int):
+            raise ValueError(f"{field} must be an integer")
+        return value
 
-class ElevatorDataService:
-    def __init__(self, db_path: str):
+    def _event_elevator_ids(self, events: List[Dict]) -> set:
+        return {event.get('elevator_id') for event in events
+                if isinstance(event, dict) and isinstance(event.get('elevator_id'), int)}
+
+    #Config for the elevators referenced by a list of events, from the registry in one pass
+    def load_elevator_bounds(self, events: List[Dict]) -> Dict[int, Dict]:
+        return self.registry.bounds(self._event_elevator_ids(events))
+
+    #Validates one demand event (dict from JSON), against the elevator bounds when given, and returns
+    #the row to insert: (elevator_id, requested_floor, request_time, day_of_week, hour_of_day, is_peak)
+    def prepare_demand_event(self, event: Dict, bounds: Dict = None) -> tuple:
+        if not isinstance(event, dict):
+            raise ValueError("event must be an object")
+        elevator_id = self._require_int(event, 'elevator_id')
+        requested_floor = self._require_int(event, 'requested_floor')
+        request_time = self._parse_event_time(event.get('request_time'))
+        if bounds is not None:
+            check_bounds(bounds.get(elevator_id), elevator_id, requested_floor)
+        day_of_week = request_time.weekday()
+        hour_of_day = request_time.hour
+        return (elevator_id, requested_floor, request_time, day_of_week, hour_of_day,
+                self.is_peak_hour(hour_of_day, day_of_week))
+
+    #Validates one state event against the elevator bounds and returns the row to insert:
+    #(elevator_id, floor, state, passenger_count, timestamp, previous_floor)
+    def prepare_state_event(self, event: Dict, bounds: Dict) -> tuple:
+        if not isinstance(event, dict):
+            raise ValueError("event must be an object")
+        elevator_id = self._require_int(event, 'elevator_id')
+        floor = self._require_int(event, 'floor')
+        state = event.get('state')
+        if state is None:
+            raise ValueError("state is required")
+        passenger_count = self._require_int(event, 'passenger_count', required=False) or 0
+        previous_floor = self._require_int(event, 'previous_floor', required=False)
+        timestamp = self._parse_event_time(event.get('timestamp'))
+
+        if state not in VALID_STATES:
+            raise ValueError(f"Invalid state: {state}")
+        check_bounds(bounds.get(elevator_id), elevator_id, floor)
+        return (elevator_id, floor, state, passenger_count, timestamp, previous_floor)
+
+    #Durable read positions, so a trainer can resume the feed after a restart
+    def get_consumer_offset(self, name: str) -> Dict:
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT name, watermark, updated_at FROM training_feed_consumers WHERE name = ?", (name,))
+        row = cursor.fetchone()
+        conn.close()
+        if row is None:
+            return None
+        return {'name': row['name'], 'watermark': row['watermark'], 'updated_at': timestamps.to_iso(row['updated_at'])}
+
+    def commit_consumer_offset(self, name: str, watermark: str) -> Dict:
+        if not name:
+            raise ValueError("Consumer name is required")
+        self.parse_watermark(watermark)
+        updated_at = timestamps.to_ms(datetime.now())
+        conn = self.get_connection()
+        conn.execute("""
+            INSERT INTO training_feed_consumers (name, watermark, updated_at) VALUES (?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET watermark = excluded.watermark, updated_at = excluded.updated_at
+        """, (name, str(watermark), updated_at))
+        conn.commit()
+        conn.close()
+        return {'name': name, 'watermark': str(watermark), 'updated_at': timestamps.to_iso(updated_at)}
+
+    def list_consumers(self) -> List[Dict]:
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT name, watermark, updated_at FROM training_feed_consumers ORDER BY name")
+        consumers = [{'name': row['name'], 'watermark': row['watermark'], 'updated_at': timestamps.to_iso(row['updated_at'])}
+                     for row in cursor.fetchall()]
+        conn.close()
+        return consumers
+
+    def delete_consumer(self, name: str) -> bool:
+        conn = self.get_connection()
+        cursor = conn.execute("DELETE FROM training_feed_consumers WHERE name = ?", (name,))
+        conn.commit()
+        conn.close()
+        return cursor.rowcount > 0
+
+    def get_building_elevator_ids(self, building_id: int) -> List[int]:
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT id FROM elevators WHERE building_id = ? ORDER BY id", (building_id,))
+        elevator_ids = [row[0] for row in cursor.fetchall()]
+        conn.close()
+        return elevator_ids
+
+class ElevatorDataService(CatalogMixin):
+    def __init__(self, db_path: str, pragmas: Dict = None, hub: EventHub = None, versions: WriteVersions = None):
         self.db_path = db_path
+        #accepted events are published here after commit, for GET /stream
+        self.hub = hub
+        #per elevator write versions, ETags and the response cache are keyed on them
+        self.versions = versions or WriteVersions()
+        #Connections are opened once per thread and reused, close() just returns them
+        self.pool = ConnectionPool(db_path, pragmas)
         self.init_DB()
+        #elevator config for validation, loaded once here
+        self.registry = ElevatorRegistry(db_path, pragmas, REGISTRY_RECHECK_SECONDS)
+        self.registry.load()
+        #In-memory next floor model, updated on every demand, warmed from the rollups
+        self.predictor = DemandPredictor()
+        #Last few hours of events per elevator, for /current and short window analytics
+        self.hot = HotStore(VALID_STATES, HOT_WINDOW_HOURS, HOT_BUDGET_BYTES)
+        conn = self.get_connection()
+        self.predictor.warm(conn)
+        self.hot.warm(conn)
+        conn.close()
     
     def get_connection(self):
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        return conn
-#iNItialize the database with required tables and views    
+        return self.pool.get()
+
+    #Closes every pooled connection, call on shutdown
+    def close(self):
+        self.pool.close_all()
+        self.registry.close()
+#iNItialize the database with required tables and views. Up to date files cost one PRAGMA read:
+#no DDL, no write lock, so starting a worker doesn't stall the live writers
     def init_DB(self):
+        conn = self.get_connection()
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        conn.close()
+        if version < SCHEMA_VERSION:
+            self.migrate(version)
+
+    #Applies the pending MIGRATIONS steps in order, each one records its version when it is done,
+    #an interrupted migration carries on from the step that didn't finish. Steps are idempotent,
+    #two processes starting on the same old file at once only repeat work
+    def migrate(self, version: int) -> List[int]:
+        applied = []
+        for target, step in MIGRATIONS:
+            if version < target:
+                getattr(self, step)(version)
+                conn = self.get_connection()
+                conn.execute(f"PRAGMA user_version = {target}")
+                conn.close()
+                applied.append(target)
+        return applied
+
+    #Step 2: training data table, change feed, compaction tiers, rollups and sketches. Derived tables
+    #that are new, or were computed from datetime text (from_version 0), are rebuilt from history
+    def migrate_derived_tables(self, from_version: int):
         conn = self.get_connection()
         cursor = conn.cursor()
         schema = """
-        CREATE TABLE IF NOT EXISTS buildings (
+        --runs of identical reports past the raw retention window, see app/compaction.py
+        CREATE TABLE IF NOT EXISTS elevator_state_intervals (
             id INTEGER PRIMARY KEY,
-            name VARCHAR(100) NOT NULL,
-            total_floors INTEGER NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            elevator_id INTEGER NOT NULL,
+            floor INTEGER NOT NULL,
+            state VARCHAR(20) NOT NULL,
+            passenger_count INTEGER DEFAULT 0,
+            previous_floor INTEGER,
+            first_state_id INTEGER NOT NULL, --elevator_states id of the first report, kept as the resting state id
+            start_time INTEGER NOT NULL, --epoch ms, first report
+            end_time INTEGER NOT NULL, --epoch ms, last report
+            report_count INTEGER NOT NULL
         );
 
-        CREATE TABLE IF NOT EXISTS elevators (
-            id INTEGER PRIMARY KEY,
-            building_id INTEGER NOT NULL,
-            name VARCHAR(50) NOT NULL,
-            max_capacity INTEGER NOT NULL DEFAULT 10,
-            min_floor INTEGER NOT NULL DEFAULT 1,
+        --time spent per state and floor once intervals are past their retention window
+        CREATE TABLE IF NOT EXISTS elevator_state_hourly (
+            elevator_id INTEGER NOT NULL,
+            hour_bucket INTEGER NOT NULL, --epoch ms
+            state VARCHAR(20) NOT NULL,
+            floor INTEGER NOT NULL,
+            duration_ms INTEGER NOT NULL DEFAULT 0,
+            interval_count INTEGER NOT NULL DEFAULT 0, --intervals that started in this hour
+            report_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (elevator_id, hour_bucket, state, floor)
+        ) WITHOUT ROWID;
+
+        CREATE INDEX IF NOT EXISTS ind_elevator_state_intervals_elevator_time ON elevator_state_intervals(elevator_id, start_time);
+
+        --every resting period still known in detail, raw or compacted
+        CREATE VIEW IF NOT EXISTS resting_states AS
+            SELECT id, elevator_id, floor, timestamp FROM elevator_states WHERE state = 'resting'
+            UNION ALL
+            SELECT first_state_id, elevator_id, floor, start_time FROM elevator_state_intervals WHERE state = 'resting';
+        """
+        conn.executescript(schema)
+
+        #ml_training_data used to be a view with two correlated subqueries per resting
+        #state, now it is a real table filled in as demands arrive
+        conn.execute("DROP INDEX IF EXISTS ind_ml_training_data_time")
+        cursor.execute("SELECT type FROM sqlite_master WHERE name = 'ml_training_data'")
+        existing = cursor.fetchone()
+        if existing and existing['type'] == 'view':
+            conn.execute("DROP VIEW ml_training_data")
+        conn.executescript("""
+        CREATE TABLE IF NOT EXISTS ml_training_data (
+            resting_state_id INTEGER PRIMARY KEY, --one sample per resting state
+            elevator_id INTEGER NOT NULL,
+            current_resting_floor INTEGER NOT NULL,
+            rest_start_time INTEGER NOT NULL, --epoch ms
+            next_demand_id INTEGER NOT NULL,
+            next_demand_floor INTEGER NOT NULL,
+            next_demand_time INTEGER NOT NULL,
+            minutes_until_demand REAL NOT NULL,
+            day_of_week INTEGER NOT NULL,
+            hour_of_day INTEGER NOT NULL,
+            is_peak_hour BOOLEAN NOT NULL,
+            distance_to_demand INTEGER NOT NULL,
+            recent_demand_frequency INTEGER NOT NULL,
             max_floor INTEGER NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (building_id) REFERENCES buildings(id)
+            min_floor INTEGER NOT NULL,
+            seq INTEGER --change feed position, new on every insert or replace
         );
 
-        CREATE TABLE IF NOT EXISTS demand_events (
-            id INTEGER PRIMARY KEY,
-            elevator_id INTEGER NOT NULL,
-            requested_floor INTEGER NOT NULL,
-            request_time TIMESTAMP NOT NULL,
-            day_of_week INTEGER NOT NULL, -- 0 Sunday 6 Saturday
-            hour_of_day INTEGER NOT NULL,  -- 0 23 not 24
-            is_peak_hour BOOLEAN NOT NULL DEFAULT FALSE,
-            weather_condition VARCHAR(20), --Optioinal
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (elevator_id) REFERENCES elevators(id)
+        --monotonic counters, unlike MAX(seq) they never go back when rows are deleted
+        CREATE TABLE IF NOT EXISTS sequences (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
         );
 
-        CREATE TABLE IF NOT EXISTS elevator_states (
-            id INTEGER PRIMARY KEY,
+        --resting states still waiting for their next demand
+        CREATE TABLE IF NOT EXISTS open_resting_periods (
+            state_id INTEGER PRIMARY KEY,
             elevator_id INTEGER NOT NULL,
             floor INTEGER NOT NULL,
-            state VARCHAR(20) NOT NULL,
-            passenger_count INTEGER DEFAULT 0,
-            timestamp TIMESTAMP NOT NULL,
-            previous_floor INTEGER, --last floor before change
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (elevator_id) REFERENCES elevators(id)
+            timestamp INTEGER NOT NULL
         );
 
-        CREATE INDEX IF NOT EXISTS ind_demand_events_elevator_time ON demand_events(elevator_id, request_time);
-        CREATE INDEX IF NOT EXISTS ind_elevator_states_elevator_time ON elevator_states(elevator_id, timestamp);
-        CREATE INDEX IF NOT EXISTS ind_elevator_states_state ON elevator_states(state);
-        CREATE INDEX IF NOT EXISTS ind_demand_events_peak_hour ON demand_events(is_peak_hour, hour_of_day);
-        """
-        
-        conn.executescript(schema)
-        
-        conn.execute("DROP VIEW IF EXISTS ml_training_data")
-        cursor.execute("""
-        CREATE VIEW ml_training_data AS
-        SELECT 
-        es.elevator_id,
-        es.floor as current_resting_floor,
-        es.timestamp as rest_start_time,
-        de.requested_floor as next_demand_floor,
-        de.request_time as next_demand_time,
-        (julianday(de.request_time) - julianday(es.timestamp)) * 24 * 60 as minutes_until_demand,
-        de.day_of_week,
-        de.hour_of_day,
-        de.is_peak_hour,
-        ABS(de.requested_floor - es.floor) as distance_to_demand,
-        (SELECT COUNT(*) 
-        FROM demand_events de2 
-        WHERE de2.elevator_id = es.elevator_id 
-        AND de2.requested_floor = de.requested_floor
-        AND de2.request_time BETWEEN datetime(es.timestamp, '-7 days') AND es.timestamp
-        ) as recent_demand_frequency,
-        e.max_floor,
-        e.min_floor
-        FROM elevator_states es
-        JOIN demand_events de ON de.elevator_id = es.elevator_id
-        JOIN elevators e ON e.id = es.elevator_id
-        WHERE es.state = 'resting'
-        AND de.request_time > es.timestamp
-        AND de.id = (
-        SELECT MIN(de3.id) 
-        FROM demand_events de3 
-        WHERE de3.elevator_id = es.elevator_id 
-        AND de3.request_time > es.timestamp);
+        CREATE INDEX IF NOT EXISTS ind_ml_training_data_elevator_time ON ml_training_data(elevator_id, rest_start_time);
+        CREATE INDEX IF NOT EXISTS ind_ml_training_data_time_elevator ON ml_training_data(rest_start_time, elevator_id);
+        CREATE INDEX IF NOT EXISTS ind_open_resting_periods_elevator_time ON open_resting_periods(elevator_id, timestamp);
+        """)
+        #Tables from before the change feed: existing samples are numbered in rowid order
+        cursor.execute("PRAGMA table_info(ml_training_data)")
+        if 'seq' not in {row['name'] for row in cursor.fetchall()}:
+            conn.execute("ALTER TABLE ml_training_data ADD COLUMN seq INTEGER")
+            conn.execute("UPDATE ml_training_data SET seq = rowid")
+        conn.execute("""
+            INSERT OR IGNORE INTO sequences (name, value) 
+            SELECT 'ml_training_data', COALESCE(MAX(seq), 0) FROM ml_training_data
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS ind_ml_training_data_seq ON ml_training_data(seq)")
+        conn.executescript(FEED_CONSUMERS_SCHEMA)
+        conn.commit()
+        #Demand counts per elevator, hour, floor and peak flag. Analytics read these
+        #instead of scanning raw demand_events
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'demand_hourly_rollups'")
+        has_rollups = cursor.fetchone() is not None
+        conn.executescript("""
+        CREATE TABLE IF NOT EXISTS demand_hourly_rollups (
+            elevator_id INTEGER NOT NULL,
+            hour_bucket INTEGER NOT NULL, --request_time truncated to the hour, epoch ms
+            requested_floor INTEGER NOT NULL,
+            is_peak_hour BOOLEAN NOT NULL,
+            day_of_week INTEGER NOT NULL,
+            hour_of_day INTEGER NOT NULL,
+            demand_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (elevator_id, hour_bucket, requested_floor, is_peak_hour)
+        ) WITHOUT ROWID;
+        """)
+        #Mergeable per hour summaries for the percentile analytics (see app/sketches.py)
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'elevator_sketches'")
+        has_sketches = cursor.fetchone() is not None
+        conn.executescript("""
+        CREATE TABLE IF NOT EXISTS elevator_sketches (
+            elevator_id INTEGER NOT NULL,
+            hour_bucket INTEGER NOT NULL, --epoch ms: rest start for wait_minutes and idle_minutes, request time for floors
+            metric VARCHAR(30) NOT NULL,
+            sketch BLOB NOT NULL,
+            PRIMARY KEY (elevator_id, hour_bucket, metric)
+        ) WITHOUT ROWID;
         """)
+        conn.close()
+        converted = from_version < EPOCH_MS_VERSION
+        #First start after the view was replaced, backfill from history
+        if converted or not existing or existing['type'] == 'view':
+            self.rebuild_ml_training_data()
+        if converted or not has_rollups:
+            self.rebuild_demand_rollups()
+        if converted or not has_sketches:
+            self.rebuild_sketches()
+
+    #Step 3: registry change counter, and max_capacity for elevators tables older than the column
+    def migrate_registry(self, from_version: int):
+        conn = self.get_connection()
+        columns = {row['name'] for row in conn.execute("PRAGMA table_info(elevators)")}
+        if 'max_capacity' not in columns:
+            conn.execute("ALTER TABLE elevators ADD COLUMN max_capacity INTEGER NOT NULL DEFAULT 10")
+        conn.executescript(REGISTRY_SCHEMA)
+        conn.close()
+
+    #Step 1: raw tables. Databases from before epoch ms timestamps hold datetime text in request_time
+    #and timestamp. Converted in place in id order chunks (the declared TIMESTAMP type stores integers
+    #as is), time indexes are dropped first and built again on the integers. Derived tables are
+    #rebuilt by the next step
+    @metrics.timed
+    def migrate_to_epoch_ms(self, from_version: int = 0, chunk_size: int = 10000) -> int:
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        conn.executescript(CATALOG_SCHEMA)
+        conn.executescript(RAW_SCHEMA)
+        converted = 0
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            for index in TIME_INDEX_NAMES:
+                cursor.execute(f"DROP INDEX IF EXISTS {index}")
+            for table, column in (('demand_events', 'request_time'), ('elevator_states', 'timestamp')):
+                last_id = 0
+                while True:
+                    cursor.execute(f"""
+                        SELECT id, {column} FROM {table} WHERE id > ? AND typeof({column}) = 'text' 
+                        ORDER BY id LIMIT ?
+                    """, (last_id, chunk_size))
+                    rows = cursor.fetchall()
+                    if not rows:
+                        break
+                    try:
+                        values = [(timestamps.to_ms(row[1]), row[0]) for row in rows]
+                    except ValueError as e:
+                        raise ValueError(f"{table}: unreadable {column} ({e})") from e
+                    cursor.executemany(f"UPDATE {table} SET {column} = ? WHERE id = ?", values)
+                    converted += len(values)
+                    last_id = rows[-1][0]
+            for statement in TIME_INDEXES.split(';'):
+                if statement.strip():
+                    cursor.execute(statement)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        return converted
+
+    #Recomputes every training sample from demand_events and resting states (raw and compacted).
+    #Same rules the old view had: the next demand is the lowest id after the rest started.
+    #Rests already rolled up to elevator_state_hourly are gone, so are their samples after a rebuild.
+    #Done per elevator with a sorted merge, a correlated subquery per resting state is quadratic
+    #on simulator sized datasets
+    @metrics.timed
+    def rebuild_ml_training_data(self) -> int:
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        samples = 0
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute("DELETE FROM ml_training_data")
+            cursor.execute("DELETE FROM open_resting_periods")
+            cursor.execute("SELECT id, min_floor, max_floor FROM elevators")
+            elevators = {row['id']: row for row in cursor.fetchall()}
+            cursor.execute("SELECT DISTINCT elevator_id FROM resting_states")
+            for (elevator_id,) in cursor.fetchall():
+                cursor.execute("SELECT id, floor, timestamp FROM resting_states WHERE elevator_id = ?", (elevator_id,))
+                rests = cursor.fetchall()
+                cursor.execute("""
+                SELECT id, requested_floor, request_time, day_of_week, hour_of_day, is_peak_hour 
+                FROM demand_events WHERE elevator_id = ? ORDER BY request_time
+                """, (elevator_id,))
+                demands = cursor.fetchall()
+                rows, still_open = self._training_rows(elevator_id, rests, demands, elevators.get(elevator_id))
+                #rebuilt samples count as new for the change feed
+                first_seq = self._next_seq(cursor, 'ml_training_data', len(rows))
+                cursor.executemany("""
+                INSERT INTO ml_training_data (resting_state_id, elevator_id, current_resting_floor, rest_start_time,
+                    next_demand_id, next_demand_floor, next_demand_time, minutes_until_demand, day_of_week, hour_of_day,
+                    is_peak_hour, distance_to_demand, recent_demand_frequency, max_floor, min_floor, seq)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, [row + (first_seq + i,) for i, row in enumerate(rows)])
+                cursor.executemany("INSERT INTO open_resting_periods (state_id, elevator_id, floor, timestamp) VALUES (?, ?, ?, ?)",
+                                   still_open)
+                samples += len(rows)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        self.versions.bump_all()
+        return samples
+
+    #Training rows and still open periods of one elevator, demands are sorted by request_time (epoch ms)
+    def _training_rows(self, elevator_id: int, rests, demands, elevator):
+        times = [demand['request_time'] for demand in demands]
+        #lowest demand id from each position to the end, "MIN(id) WHERE request_time > t" is one lookup
+        suffix_min = [0] * len(demands)
+        lowest = None
+        for index in range(len(demands) - 1, -1, -1):
+            demand_id = demands[index]['id']
+            lowest = demand_id if lowest is None or demand_id < lowest else lowest
+            suffix_min[index] = lowest
+        by_id = {demand['id']: demand for demand in demands}
+        floor_times = {}
+        for demand in demands:
+            floor_times.setdefault(demand['requested_floor'], []).append(demand['request_time'])
+        rows, still_open = [], []
+        for rest in rests:
+            position = bisect_right(times, rest['timestamp'])
+            if position == len(times):
+                still_open.append((rest['id'], elevator_id, rest['floor'], rest['timestamp']))
+                continue
+            if elevator is None:
+                continue
+            demand = by_id[suffix_min[position]]
+            rest_start = rest['timestamp']
+            same_floor = floor_times[demand['requested_floor']]
+            recent_demand_frequency = (bisect_right(same_floor, rest_start)
+                                       - bisect_left(same_floor, rest_start - 7 * timestamps.DAY_MS))
+            rows.append((rest['id'], elevator_id, rest['floor'], rest_start, demand['id'],
+                         demand['requested_floor'], demand['request_time'],
+                         (demand['request_time'] - rest_start) / timestamps.MINUTE_MS,
+                         demand['day_of_week'], demand['hour_of_day'], demand['is_peak_hour'],
+                         abs(demand['requested_floor'] - rest['floor']), recent_demand_frequency,
+                         elevator['max_floor'], elevator['min_floor']))
+        return rows, still_open
+
+    #Recomputes demand_hourly_rollups from the raw demand_events
+    @metrics.timed
+    def rebuild_demand_rollups(self) -> int:
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute("DELETE FROM demand_hourly_rollups")
+            cursor.execute("""
+            INSERT INTO demand_hourly_rollups (elevator_id, hour_bucket, requested_floor, is_peak_hour, day_of_week, hour_of_day, demand_count)
+            SELECT elevator_id, request_time - request_time % 3600000, requested_floor, is_peak_hour,
+            MIN(day_of_week), MIN(hour_of_day), COUNT(*)
+            FROM demand_events
+            GROUP BY elevator_id, request_time - request_time % 3600000, requested_floor, is_peak_hour
+            """)
+            buckets = cursor.rowcount
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        self.versions.bump_all()
+        return buckets
+
+    #Recomputes elevator_sketches from the training samples, demand_events and the state history
+    #(raw and compacted). Idle intervals are resting runs: first resting report to the next other state
+    @metrics.timed
+    def rebuild_sketches(self) -> int:
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        summaries = {}
+
+        def summary(elevator_id, time_ms, metric):
+            key = (elevator_id, timestamps.hour_bucket(time_ms), metric)
+            if key not in summaries:
+                summaries[key] = sketches.METRICS[metric]()
+            return summaries[key]
+
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute("DELETE FROM elevator_sketches")
+            cursor.execute("SELECT elevator_id, rest_start_time, minutes_until_demand FROM ml_training_data")
+            for elevator_id, rest_start, minutes in cursor:
+                summary(elevator_id, rest_start, 'wait_minutes').add(minutes)
+            cursor.execute("SELECT elevator_id, requested_floor, request_time FROM demand_events")
+            for elevator_id, floor, request_time in cursor:
+                summary(elevator_id, request_time, 'floors').add(floor)
+            cursor.execute("""
+            SELECT elevator_id, state, timestamp FROM elevator_states
+            UNION ALL
+            SELECT elevator_id, state, start_time FROM elevator_state_intervals
+            ORDER BY elevator_id, timestamp
+            """)
+            current, run_start = None, None
+            for elevator_id, state, timestamp in cursor:
+                if elevator_id != current:
+                    current, run_start = elevator_id, None
+                if state == 'resting':
+                    if run_start is None:
+                        run_start = timestamp
+                elif run_start is not None:
+                    summary(elevator_id, run_start, 'idle_minutes').add((timestamp - run_start) / timestamps.MINUTE_MS)
+                    run_start = None
+            cursor.executemany("INSERT INTO elevator_sketches (elevator_id, hour_bucket, metric, sketch) VALUES (?, ?, ?, ?)",
+                               [key + (item.to_bytes(),) for key, item in summaries.items()])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        self.versions.bump_all()
+        return len(summaries)
+
+    #Adds demands to their hourly buckets, same transaction as the raw insert.
+    #rows are (elevator_id, requested_floor, request_time, day_of_week, hour_of_day, is_peak)
+    def _add_demand_rollups(self, cursor, rows: List[tuple]):
+        counts = {}
+        for elevator_id, requested_floor, request_time, day_of_week, hour_of_day, is_peak in rows:
+            key = (elevator_id, timestamps.hour_bucket(request_time), requested_floor, bool(is_peak), day_of_week, hour_of_day)
+            counts[key] = counts.get(key, 0) + 1
+        cursor.executemany("""
+            INSERT INTO demand_hourly_rollups (elevator_id, hour_bucket, requested_floor, is_peak_hour, day_of_week, hour_of_day, demand_count)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (elevator_id, hour_bucket, requested_floor, is_peak_hour) DO UPDATE SET demand_count = demand_count + excluded.demand_count
+        """, [key + (count,) for key, count in counts.items()])
+        #distinct floor sets only change for floors not seen in that hour yet
+        floors = {}
+        for elevator_id, hour, requested_floor, *_ in counts:
+            floors.setdefault((elevator_id, hour, 'floors'), []).append(('add', requested_floor))
+        sketches.apply_updates(cursor, floors)
+
+    #A resting period is only complete when the next demand shows up,
+    #so the features are computed once, here, inside the demand's transaction
+    def _close_resting_periods(self, cursor, demand_id: int, elevator_id: int, requested_floor: int,
+                               request_time: int, day_of_week: int, hour_of_day: int, is_peak: bool):
+        cursor.execute("""
+            SELECT state_id, floor, timestamp FROM open_resting_periods 
+            WHERE elevator_id = ? AND timestamp < ?
+        """, (elevator_id, request_time))
+        periods = cursor.fetchall()
+        if not periods:
+            return
+        elevator = self.registry.get(elevator_id)
+        if elevator:
+            for period in periods:
+                self._insert_training_sample(cursor, period['state_id'], elevator_id, period['floor'], period['timestamp'],
+                    demand_id, requested_floor, request_time, day_of_week, hour_of_day, is_peak, elevator)
+        cursor.executemany("DELETE FROM open_resting_periods WHERE state_id = ?",
+                           [(period['state_id'],) for period in periods])
+
+    #New resting state: normally opens a period, unless a later demand is already stored (backfills)
+    def _open_resting_period(self, cursor, state_id: int, elevator_id: int, floor: int, timestamp: int):
+        cursor.execute("""
+            SELECT id, requested_floor, request_time, day_of_week, hour_of_day, is_peak_hour 
+            FROM demand_events WHERE elevator_id = ? AND request_time > ? 
+            ORDER BY id LIMIT 1
+        """, (elevator_id, timestamp))
+        demand = cursor.fetchone()
+        if demand is None:
+            cursor.execute("INSERT INTO open_resting_periods (state_id, elevator_id, floor, timestamp) VALUES (?, ?, ?, ?)",
+                           (state_id, elevator_id, floor, timestamp))
+            return
+        elevator = self.registry.get(elevator_id)
+        if elevator:
+            self._insert_training_sample(cursor, state_id, elevator_id, floor, timestamp,
+                demand['id'], demand['requested_floor'], demand['request_time'],
+                demand['day_of_week'], demand['hour_of_day'], demand['is_peak_hour'], elevator)
+
+    #Times are epoch ms, so the features are integer arithmetic
+    def _insert_training_sample(self, cursor, state_id, elevator_id, resting_floor, rest_start,
+                                demand_id, demand_floor, demand_time, day_of_week, hour_of_day, is_peak, elevator):
+        minutes_until_demand = (demand_time - rest_start) / timestamps.MINUTE_MS
+        #a replaced sample takes its old wait out of the sketch
+        updates = {}
+        cursor.execute("SELECT rest_start_time, minutes_until_demand FROM ml_training_data WHERE resting_state_id = ?", (state_id,))
+        previous = cursor.fetchone()
+        if previous is not None:
+            updates.setdefault((elevator_id, timestamps.hour_bucket(previous[0]), 'wait_minutes'), []).append(('remove', previous[1]))
+        updates.setdefault((elevator_id, timestamps.hour_bucket(rest_start), 'wait_minutes'), []).append(('add', minutes_until_demand))
+        sketches.apply_updates(cursor, updates)
+        cursor.execute("""
+            SELECT COUNT(*) FROM demand_events 
+            WHERE elevator_id = ? AND requested_floor = ?
+            AND request_time BETWEEN ? AND ?
+        """, (elevator_id, demand_floor, rest_start - 7 * timestamps.DAY_MS, rest_start))
+        recent_demand_frequency = cursor.fetchone()[0]
+        cursor.execute("""
+            INSERT OR REPLACE INTO ml_training_data (resting_state_id, elevator_id, current_resting_floor, rest_start_time,
+                next_demand_id, next_demand_floor, next_demand_time, minutes_until_demand, day_of_week, hour_of_day,
+                is_peak_hour, distance_to_demand, recent_demand_frequency, max_floor, min_floor, seq)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (state_id, elevator_id, resting_floor, rest_start, demand_id, demand_floor, demand_time,
+              minutes_until_demand, day_of_week, hour_of_day, is_peak, abs(demand_floor - resting_floor),
+              recent_demand_frequency, elevator['max_floor'], elevator['min_floor'],
+              self._next_seq(cursor, 'ml_training_data')))
+
+    #A non resting report ends the resting run before it, if any: its length goes to the idle sketch
+    #of the hour the run started in. The run may already be compacted into intervals
+    def _close_idle_run(self, cursor, elevator_id: int, timestamp: int):
+        previous = self._previous_state(cursor, elevator_id, timestamp)
+        if previous is None or previous[0] != 'resting':
+            return
+        busy = self._previous_state(cursor, elevator_id, timestamp, "state != 'resting'")
+        since = busy[1] if busy else -1
+        starts = []
+        for table, column in (('elevator_states', 'timestamp'), ('elevator_state_intervals', 'start_time')):
+            cursor.execute(f"""
+                SELECT MIN({column}) FROM {table} 
+                WHERE elevator_id = ? AND state = 'resting' AND {column} > ? AND {column} < ?
+            """, (elevator_id, since, timestamp))
+            value = cursor.fetchone()[0]
+            if value is not None:
+                starts.append(value)
+        #resting and busy reported in the same millisecond, no run to count
+        if not starts:
+            return
+        run_start = min(starts)
+        sketches.apply_updates(cursor, {(elevator_id, timestamps.hour_bucket(run_start), 'idle_minutes'):
+                                        [('add', (timestamp - run_start) / timestamps.MINUTE_MS)]})
+
+    #(state, time) of the newest report before `before`, raw or compacted, that matches `condition`
+    def _previous_state(self, cursor, elevator_id: int, before: int, condition: str = "1"):
+        latest = None
+        for table, column in (('elevator_states', 'timestamp'), ('elevator_state_intervals', 'start_time')):
+            cursor.execute(f"""
+                SELECT state, {column} FROM {table} WHERE elevator_id = ? AND {column} < ? AND {condition}
+                ORDER BY {column} DESC LIMIT 1
+            """, (elevator_id, before))
+            row = cursor.fetchone()
+            if row is not None and (latest is None or row[1] > latest[1]):
+                latest = (row[0], row[1])
+        return latest
+
+    #Reserves `count` values of a counter inside the caller's write transaction, returns the first one.
+    #Writers are serialized, so values are committed in increasing order
+    def _next_seq(self, cursor, name: str, count: int = 1) -> int:
+        cursor.execute("UPDATE sequences SET value = value + ? WHERE name = ?", (count, name))
+        cursor.execute("SELECT value FROM sequences WHERE name = ?", (name,))
+        return cursor.fetchone()[0] - count + 1
 #Add test data for immediate testing       
     def seed_test_data(self):
         conn = self.get_connection()
@@ -112,147 +986,550 @@ class ElevatorDataService:
         
         #Checkk
         cursor.execute("SELECT COUNT(*) FROM buildings")
+        seeded = cursor.fetchone()[0] > 0
+        conn.close()
         #If already seeded, returns
-        if cursor.fetchone()[0] > 0:
-            conn.close()
+        if seeded:
             return
         #Add test building and elevator
-        cursor.execute("""
-            INSERT INTO buildings (id, name, total_floors) VALUES (1, 'Yambay Tower', 10)
-        """)
-        
-        cursor.execute("""
-            INSERT INTO elevators (id, building_id, name, min_floor, max_floor) VALUES (1, 1, 'Benitez Building', 1, 10)
-        """)
-        
-        conn.commit()
-        conn.close()
+        self.create_building('Yambay Tower', 10, building_id=1)
+        self.create_elevator(1, 'Benitez Building', 1, 10, elevator_id=1)
         print("Test data seeded: Building 1 with Elevator 1 (floors 1-10)")
     
-  #Define peak hours based on business rules  
-    def is_peak_hour(self, hour: int, day_of_week: int) -> bool:
-        #Weekday morning (7-9) and evening (5-7) based on my country's business hours
-        if day_of_week in [0, 1, 2, 3, 4]:#Monday [0] to Friday [4]
-
-            return hour in [7, 8, 17, 18]
-        # Weekend lunch
-        elif day_of_week in [0, 6]: #Weekend
-            return hour in [12, 13]#lunch
-        return False
+    def _elevator_has_events(self, cursor, elevator_id: int) -> bool:
+        cursor.execute("""
+            SELECT EXISTS (SELECT 1 FROM demand_events WHERE elevator_id = ?)
+                OR EXISTS (SELECT 1 FROM elevator_states WHERE elevator_id = ?)
+        """, (elevator_id, elevator_id))
+        return bool(cursor.fetchone()[0])
+
+    #Sharded mode: writes the catalog's building row (and elevator row) into this shard
+    def replicate_registry_rows(self, building: Dict, elevator: Dict = None):
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            if building is not None:
+                cursor.execute("INSERT OR REPLACE INTO buildings (id, name, total_floors) VALUES (?, ?, ?)",
+                               (building['id'], building['name'], building['total_floors']))
+            if elevator is not None:
+                cursor.execute(f"INSERT OR REPLACE INTO elevators ({', '.join(ELEVATOR_COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?)",
+                               [elevator[column] for column in ELEVATOR_COLUMNS])
+                version = bump_version(cursor)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        if elevator is not None:
+            self.registry.put(elevator['id'], elevator, version)
+
     #Saves demand events when someone calls the elevator
+    @metrics.timed
     def record_demand(self, elevator_id: int, requested_floor: int, request_time: datetime = None) -> Dict:
-        if request_time is None:
-            request_time = datetime.now()
+        request_time = timestamps.wall_clock(request_time) if request_time else datetime.now()
+        request_ms = timestamps.to_ms(request_time)
         #0 Monday!!!
         day_of_week = request_time.weekday()  
         hour_of_day = request_time.hour
         is_peak = self.is_peak_hour(hour_of_day, day_of_week)
+        self.registry.check_floor(elevator_id, requested_floor)
         conn = self.get_connection()
         cursor = conn.cursor()
         
         cursor.execute("""
             INSERT INTO demand_events 
             (elevator_id, requested_floor, request_time, day_of_week, hour_of_day, is_peak_hour) VALUES (?, ?, ?, ?, ?, ?)
-        """, (elevator_id, requested_floor, request_time, day_of_week, hour_of_day, is_peak))
+        """, (elevator_id, requested_floor, request_ms, day_of_week, hour_of_day, is_peak))
         demand_id = cursor.lastrowid
+        self._close_resting_periods(cursor, demand_id, elevator_id, requested_floor, request_ms, day_of_week, hour_of_day, is_peak)
+        self._add_demand_rollups(cursor, [(elevator_id, requested_floor, request_ms, day_of_week, hour_of_day, is_peak)])
         conn.commit()
         conn.close()
-        
-        return {'demand_id': demand_id,
+        self.predictor.observe(elevator_id, requested_floor, request_time, day_of_week, hour_of_day, is_peak)
+        result = {'demand_id': demand_id,
             'elevator_id': elevator_id,
             'requested_floor': requested_floor,
             'is_peak_hour': is_peak,
-            'timestamp': request_time.isoformat()
+            'timestamp': timestamps.to_iso(request_ms)
         }
+        self._after_commit('demand', [result])
+        return result
     #Saves elevator state changes when it moves or rests
+    @metrics.timed
     def record_elevator_state(self, elevator_id: int, floor: int, state: str, passenger_count: int = 0, previous_floor: int = None, timestamp: datetime = None) -> Dict:
         if timestamp is None:
             timestamp = datetime.now()#ojo
-        
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        timestamp_ms = timestamps.to_ms(timestamp)
         
         #Validate state transitions
-        if state not in ['resting', 'moving', 'occupied']:
+        if state not in VALID_STATES:
             raise ValueError(f"Invalid state: {state}")
         
-        #Validate elevator bounds
-        cursor.execute("SELECT min_floor, max_floor FROM elevators WHERE id = ?", (elevator_id,))
-        elevator = cursor.fetchone()
-        if not elevator:
-            raise ValueError(f"Elevator {elevator_id} not found")
-        
-        if floor < elevator['min_floor'] or floor > elevator['max_floor']:
-            raise ValueError(f"Floor {floor} out of bounds for elevator {elevator_id}")
-        
+        #Validate elevator bounds, from the registry cache
+        self.registry.check_floor(elevator_id, floor)
+
+        conn = self.get_connection()
+        cursor = conn.cursor()
         cursor.execute("""
             INSERT INTO elevator_states (elevator_id, floor, state, passenger_count, timestamp, previous_floor) VALUES (?, ?, ?, ?, ?, ?)
-        """, (elevator_id, floor, state, passenger_count, timestamp, previous_floor))
+        """, (elevator_id, floor, state, passenger_count, timestamp_ms, previous_floor))
         
         state_id = cursor.lastrowid
+        if state == 'resting':
+            self._open_resting_period(cursor, state_id, elevator_id, floor, timestamp_ms)
+        else:
+            self._close_idle_run(cursor, elevator_id, timestamp_ms)
         conn.commit()
         conn.close()
-        
-        return {
+        result = {
             'state_id': state_id,
             'elevator_id': elevator_id,
             'floor': floor,
             'state': state,
-            'timestamp': timestamp.isoformat()}
+            'timestamp': timestamps.to_iso(timestamp_ms)}
+        self._after_commit('state', [dict(result, passenger_count=passenger_count, previous_floor=previous_floor)])
+        return result
 
-#Gets ML data    
-    def get_ml_training_data(self, elevator_id: int = None, start_date: datetime = None, end_date: datetime = None) -> List[Dict]:
+    #Results of committed events, as the API returned them: hot store, new cache versions, then the live feed
+    def _after_commit(self, kind: str, items: List[Dict]):
+        if items:
+            self.hot.add(kind, items)
+            self.versions.bump(item['elevator_id'] for item in items)
+        if self.hub is not None:
+            self.hub.publish_many(kind, [{key: value for key, value in item.items() if key != 'index'} for item in items])
+
+    #Inserts all rows with one executemany in one transaction. Ids are handed out
+    #explicitly under the write lock because executemany does not report lastrowid
+    def _insert_batch(self, conn, table: str, columns: List[str], rows: List[tuple], after_insert=None) -> List[int]:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            ids = self._insert_rows(cursor, table, columns, rows, after_insert)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return ids
+
+    #The inserts of _insert_batch, inside a write transaction the caller already holds
+    def _insert_rows(self, cursor, table: str, columns: List[str], rows: List[tuple], after_insert=None) -> List[int]:
+        cursor.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}")
+        first_id = cursor.fetchone()[0] + 1
+        ids = list(range(first_id, first_id + len(rows)))
+        placeholders = ', '.join('?' * (len(columns) + 1))
+        cursor.executemany(
+            f"INSERT INTO {table} (id, {', '.join(columns)}) VALUES ({placeholders})",
+            [(row_id,) + row for row_id, row in zip(ids, rows)])
+        #derived tables are kept in the same transaction as the raw rows
+        if after_insert:
+            after_insert(cursor, ids, rows)
+        return ids
+
+    #Rows are walked in id order so samples match what one by one inserts would produce
+    def _after_demand_batch(self, cursor, ids: List[int], rows: List[tuple]):
+        for demand_id, (elevator_id, requested_floor, request_time, day_of_week, hour_of_day, is_peak) in zip(ids, rows):
+            self._close_resting_periods(cursor, demand_id, elevator_id, requested_floor, request_time, day_of_week, hour_of_day, is_peak)
+        self._add_demand_rollups(cursor, rows)
+
+    def _after_state_batch(self, cursor, ids: List[int], rows: List[tuple]):
+        for state_id, (elevator_id, floor, state, _, timestamp, _) in zip(ids, rows):
+            if state == 'resting':
+                self._open_resting_period(cursor, state_id, elevator_id, floor, timestamp)
+            else:
+                self._close_idle_run(cursor, elevator_id, timestamp)
+
+    #Saves a batch of demand events (any mix of elevators), one commit for the whole batch.
+    #Bounds for all elevators are checked in one pass
+    @metrics.timed
+    def record_demands_batch(self, events: List[Dict]) -> Dict:
+        results = []
+        rows = []
+        bounds = self.load_elevator_bounds(events)
+        for index, event in enumerate(events):
+            try:
+                row = self.prepare_demand_event(event, bounds)
+            except (ValueError, TypeError) as e:
+                results.append({'index': index, 'error': str(e)})
+                continue
+            elevator_id, requested_floor, request_time, _, _, is_peak = row
+            rows.append(row)
+            results.append({'index': index,
+                'elevator_id': elevator_id,
+                'requested_floor': requested_floor,
+                'is_peak_hour': is_peak,
+                'timestamp': timestamps.to_iso(timestamps.to_ms(request_time))})
+
+        if rows:
+            conn = self.get_connection()
+            try:
+                ids = self._insert_batch(conn, 'demand_events',
+                    ['elevator_id', 'requested_floor', 'request_time', 'day_of_week', 'hour_of_day', 'is_peak_hour'],
+                    [row[:2] + (timestamps.to_ms(row[2]),) + row[3:] for row in rows],
+                    after_insert=self._after_demand_batch)
+            finally:
+                conn.close()
+            for elevator_id, requested_floor, request_time, day_of_week, hour_of_day, is_peak in rows:
+                self.predictor.observe(elevator_id, requested_floor, request_time, day_of_week, hour_of_day, is_peak)
+            accepted = iter(ids)
+            for result in results:
+                if 'error' not in result:
+                    result['demand_id'] = next(accepted)
+            self._after_commit('demand', [result for result in results if 'error' not in result])
+
+        return {'accepted': len(rows),
+            'rejected': len(results) - len(rows),
+            'results': results}
+
+    #Saves a batch of state changes, bounds for all elevators are checked in one pass
+    @metrics.timed
+    def record_elevator_states_batch(self, events: List[Dict]) -> Dict:
+        results = []
+        rows = []
+        bounds = self.load_elevator_bounds(events)
+        conn = self.get_connection()
+        try:
+            for index, event in enumerate(events):
+                try:
+                    row = self.prepare_state_event(event, bounds)
+                except (ValueError, TypeError) as e:
+                    results.append({'index': index, 'error': str(e)})
+                    continue
+                elevator_id, floor, state, _, timestamp, _ = row
+                rows.append(row[:4] + (timestamps.to_ms(timestamp),) + row[5:])
+                results.append({'index': index,
+                    'elevator_id': elevator_id,
+                    'floor': floor,
+                    'state': state,
+                    'timestamp': timestamps.to_iso(rows[-1][4])})
+
+            if rows:
+                ids = self._insert_batch(conn, 'elevator_states',
+                    ['elevator_id', 'floor', 'state', 'passenger_count', 'timestamp', 'previous_floor'], rows,
+                    after_insert=self._after_state_batch)
+                accepted = iter(ids)
+                for result in results:
+                    if 'error' not in result:
+                        result['state_id'] = next(accepted)
+        finally:
+            conn.close()
+        self._after_commit('state', [dict(result, passenger_count=row[3], previous_floor=row[5])
+                                for result, row in zip([result for result in results if 'error' not in result], rows)])
+
+        return {'accepted': len(rows),
+            'rejected': len(results) - len(rows),
+            'results': results}
+
+    #Rows already decoded and checked against the registry by the binary gateway (app/gateway.py), one frame:
+    #states (elevator_id, floor, state, passenger_count, timestamp ms, previous_floor) and demands
+    #(elevator_id, requested_floor, request_time ms, day_of_week, hour_of_day, is_peak). Both kinds commit in one
+    #transaction, states first so resting periods exist before the demands that close them: the frame is stored
+    #whole or not at all. Same derived tables, predictor and change events as the batch methods.
+    #Returns the number of rows stored
+    @metrics.timed
+    def record_event_rows(self, state_rows: List[tuple], demand_rows: List[tuple]) -> int:
+        if not state_rows and not demand_rows:
+            return 0
         conn = self.get_connection()
         cursor = conn.cursor()
-        
-        query = "SELECT * FROM ml_training_data WHERE 1=1"
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            state_ids = self._insert_rows(cursor, 'elevator_states',
+                ['elevator_id', 'floor', 'state', 'passenger_count', 'timestamp', 'previous_floor'], state_rows,
+                after_insert=self._after_state_batch) if state_rows else []
+            demand_ids = self._insert_rows(cursor, 'demand_events',
+                ['elevator_id', 'requested_floor', 'request_time', 'day_of_week', 'hour_of_day', 'is_peak_hour'], demand_rows,
+                after_insert=self._after_demand_batch) if demand_rows else []
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        #the rows are committed now, whatever happens below the caller must hear they were stored
+        try:
+            for elevator_id, requested_floor, request_ms, day_of_week, hour_of_day, is_peak in demand_rows:
+                self.predictor.observe(elevator_id, requested_floor, timestamps.from_ms(request_ms), day_of_week, hour_of_day, is_peak)
+            self._after_commit('state', [{'elevator_id': row[0], 'floor': row[1], 'state': row[2], 'timestamp': timestamps.to_iso(row[4]),
+                                          'state_id': state_id, 'passenger_count': row[3], 'previous_floor': row[5]}
+                                         for state_id, row in zip(state_ids, state_rows)])
+            self._after_commit('demand', [{'elevator_id': row[0], 'requested_floor': row[1], 'is_peak_hour': row[5],
+                                           'timestamp': timestamps.to_iso(row[2]), 'demand_id': demand_id}
+                                          for demand_id, row in zip(demand_ids, demand_rows)])
+        except Exception:
+            logger.exception("post-commit updates failed for %d stored rows", len(state_ids) + len(demand_ids))
+        return len(state_ids) + len(demand_ids)
+
+#Gets ML data    
+    @metrics.timed
+    def get_ml_training_data(self, elevator_id: int = None, start_date: datetime = None, end_date: datetime = None,
+                             after: str = None, limit: int = None) -> List[Dict]:
+        return list(self.iter_ml_training_data(elevator_id, start_date, end_date, after, limit))
+
+    #Filters shared by every training data read, ordered by the keyset (rest_start_time, elevator_id, id)
+    def _training_filters(self, elevator_id: int = None, start_date: datetime = None, end_date: datetime = None, after: str = None):
+        where = " WHERE 1=1"
         params = []
         if elevator_id:
-            query += " AND elevator_id = ?"
+            where += " AND elevator_id = ?"
             params.append(elevator_id)
         if start_date:
-            query += " AND rest_start_time >= ?"
-            params.append(start_date.strftime('%Y-%m-%d %H:%M:%S'))
+            where += " AND rest_start_time >= ?"
+            params.append(timestamps.to_ms(start_date))
 
         if end_date:
-            query += " AND rest_start_time <= ?"
-            params.append(end_date.strftime('%Y-%m-%d %H:%M:%S'))
+            where += " AND rest_start_time <= ?"
+            params.append(timestamps.to_ms(end_date))
+        if after:
+            where += " AND (rest_start_time, elevator_id, resting_state_id) > (?, ?, ?)"
+            params.extend(decode_training_cursor(after))
+        return where, params
 
-        
-        cursor.execute(query, params)
-        rows = cursor.fetchall()
+    @staticmethod
+    def _training_row(row) -> Dict:
+        row = {column: row[column] for column in TRAINING_COLUMNS}
+        row['rest_start_time'] = timestamps.to_iso(row['rest_start_time'])
+        row['next_demand_time'] = timestamps.to_iso(row['next_demand_time'])
+        return row
+
+    #Yields rows straight from the cursor, memory stays flat no matter how much history matches.
+    #keys=True yields (keyset key, row) pairs, for merging and cursors
+    def iter_ml_training_data(self, elevator_id: int = None, start_date: datetime = None, end_date: datetime = None,
+                              after: str = None, limit: int = None, batch_size: int = 1000, keys: bool = False):
+        where, params = self._training_filters(elevator_id, start_date, end_date, after)
+        query = f"SELECT {', '.join(TRAINING_COLUMNS)}, resting_state_id FROM ml_training_data{where} ORDER BY {TRAINING_KEY}"
+        if limit:
+            query += " LIMIT ?"
+            params.append(limit)
+        conn = self.get_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    if keys:
+                        yield (row['rest_start_time'], row['elevator_id'], row['resting_state_id']), self._training_row(row)
+                    else:
+                        yield self._training_row(row)
+        finally:
+            conn.close()
+
+    #One keyset page: (next cursor, rows). The cursor is the key of the page's last row, read by the same
+    #statement as the rows: the window columns put it on every row, so it is known from the first fetch,
+    #before anything is streamed (SQLite holds the page in its temp store, not Python).
+    #The cursor is None when the page isn't full, so there's nothing after it
+    @metrics.timed
+    def open_training_page(self, elevator_id: int = None, start_date: datetime = None, end_date: datetime = None,
+                           after: str = None, limit: int = None, batch_size: int = 1000):
+        if not limit:
+            return None, self.iter_ml_training_data(elevator_id, start_date, end_date, after, batch_size=batch_size)
+        where, params = self._training_filters(elevator_id, start_date, end_date, after)
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            SELECT {', '.join(TRAINING_COLUMNS)},
+                   last_value(rest_start_time) OVER page AS last_rest_start_time,
+                   last_value(elevator_id) OVER page AS last_elevator_id,
+                   last_value(resting_state_id) OVER page AS last_resting_state_id,
+                   count(*) OVER page AS page_rows
+            FROM (SELECT * FROM ml_training_data{where} ORDER BY {TRAINING_KEY} LIMIT ?)
+            WINDOW page AS (ORDER BY {TRAINING_KEY} ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING)
+            ORDER BY {TRAINING_KEY}
+        """, params + [limit])
+        first = cursor.fetchone()
+        if first is None:
+            conn.close()
+            return None, iter(())
+        next_cursor = None
+        if first['page_rows'] == limit:
+            next_cursor = encode_training_cursor(first['last_rest_start_time'], first['last_elevator_id'],
+                                                 first['last_resting_state_id'])
+
+        def rows():
+            try:
+                yield self._training_row(first)
+                while True:
+                    batch = cursor.fetchmany(batch_size)
+                    if not batch:
+                        break
+                    for row in batch:
+                        yield self._training_row(row)
+            finally:
+                conn.close()
+        return next_cursor, rows()
+
+    @metrics.timed
+    def count_ml_training_data(self, elevator_id: int = None, start_date: datetime = None, end_date: datetime = None,
+                               after: str = None) -> int:
+        where, params = self._training_filters(elevator_id, start_date, end_date, after)
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT COUNT(*) FROM ml_training_data{where}", params)
+        count = cursor.fetchone()[0]
         conn.close()
-        return [dict(row) for row in rows]
+        return count
     
+    #Columnar export: one typed NumPy array per feature, filled from the cursor in chunks
+    @metrics.timed
+    def get_training_arrays(self, elevator_id: int = None, start_date: datetime = None, end_date: datetime = None,
+                            chunk_size: int = 10000) -> Dict:
+        columnar.require_numpy()
+        total = self.count_ml_training_data(elevator_id, start_date, end_date)
+        where, params = self._training_filters(elevator_id, start_date, end_date)
+        conn = self.get_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(f"SELECT {', '.join(TRAINING_COLUMNS)} FROM ml_training_data{where} ORDER BY rest_start_time, elevator_id, resting_state_id", params)
+            chunks = iter(lambda: cursor.fetchmany(chunk_size), [])
+            return columnar.build_arrays(TRAINING_COLUMNS, chunks, total)
+        finally:
+            conn.close()
+
+    #Samples created or recomputed after a watermark, in seq order. A sample that is replaced
+    #(late demand, rebuild) comes back with its new values and a new seq
+    @metrics.timed
+    def get_training_changes(self, since: str = '0', limit: int = 1000, elevator_id: int = None) -> Dict:
+        if limit <= 0:
+            raise ValueError("limit must be positive")
+        seq = self.parse_watermark(since)
+        where = " WHERE seq > ?"
+        params = [seq]
+        if elevator_id:
+            where += " AND elevator_id = ?"
+            params.append(elevator_id)
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        #one snapshot for the rows and the counter
+        cursor.execute("BEGIN")
+        cursor.execute(f"""
+            SELECT seq, resting_state_id, {', '.join(TRAINING_COLUMNS)} FROM ml_training_data{where} 
+            ORDER BY seq LIMIT ?
+        """, params + [limit + 1])
+        rows = [dict(row) for row in cursor.fetchall()]
+        if len(rows) <= limit and elevator_id:
+            #filtered reads can skip ahead to the newest seq, nothing else for this elevator before it
+            cursor.execute("SELECT value FROM sequences WHERE name = 'ml_training_data'")
+            seq = cursor.fetchone()[0]
+        conn.commit()
+        conn.close()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        for row in rows:
+            row['rest_start_time'] = timestamps.to_iso(row['rest_start_time'])
+            row['next_demand_time'] = timestamps.to_iso(row['next_demand_time'])
+        if rows and (has_more or not elevator_id):
+            seq = rows[-1]['seq']
+        return {'data': rows, 'next_watermark': str(seq), 'has_more': has_more}
+
+    def parse_watermark(self, value) -> int:
+        return parse_watermark(value)
+
+    #Demand rows for a window, built from whole hour rollups plus the raw events of the
+    #first, partial hour, so results are exact but cost depends on buckets not events
+    def _demand_window(self, elevator_ids: List[int], start_date: datetime):
+        first_bucket = start_date.replace(minute=0, second=0, microsecond=0)
+        if first_bucket < start_date:
+            first_bucket += timedelta(hours=1)
+        placeholders = ','.join('?' * len(elevator_ids))
+        source = f"""(
+            SELECT elevator_id, requested_floor, hour_of_day, day_of_week, is_peak_hour, demand_count
+            FROM demand_hourly_rollups 
+            WHERE elevator_id IN ({placeholders}) AND hour_bucket >= ?
+            UNION ALL
+            SELECT elevator_id, requested_floor, hour_of_day, day_of_week, is_peak_hour, 1
+            FROM demand_events 
+            WHERE elevator_id IN ({placeholders}) AND request_time >= ? AND request_time < ?
+        )"""
+        first_bucket = timestamps.to_ms(first_bucket)
+        params = list(elevator_ids) + [first_bucket] + list(elevator_ids) + [timestamps.to_ms(start_date), first_bucket]
+        return source, params
+
+    #Latest state, last `limit` demands and states, from the hot store. None for unknown elevators
+    def get_current(self, elevator_id: int, limit: int = 10) -> Dict:
+        if self.registry.get(elevator_id) is None:
+            return None
+        return self.hot.current(elevator_id, limit)
+
+    #get_demand_analytics over the last `hours` (at most HOT_WINDOW_HOURS), from the hot store only
+    @metrics.timed
+    def get_recent_demand_analytics(self, elevator_id: int, hours: float = 1) -> Dict:
+        return self.hot.demand_analytics(elevator_id, hours)
+
+    def get_hot_metrics(self) -> Dict:
+        return self.hot.metrics()
+
+    #Best resting floor for the time bucket of `at`, answered from memory only
+    def recommend_resting_floor(self, elevator_id: int, at: datetime = None) -> Dict:
+        at = at or datetime.now()
+        day_of_week = at.weekday()
+        hour_of_day = at.hour
+        is_peak = self.is_peak_hour(hour_of_day, day_of_week)
+        result = {'elevator_id': elevator_id,
+            'at': at.isoformat(),
+            'day_of_week': day_of_week,
+            'hour_of_day': hour_of_day,
+            'is_peak_hour': is_peak}
+        prediction = self.predictor.recommend(elevator_id, at, day_of_week, hour_of_day, is_peak)
+        if prediction is None:
+            result.update({'recommended_floor': None, 'expected_distance': None, 'source': 'none', 'effective_demands': 0.0})
+        else:
+            result.update(prediction)
+        return result
+
+    #Replays a window of history and scores every resting floor per time bucket (NumPy).
+    #what_if = {'floor': 1, 'days_of_week': [0..4], 'hours': [7, 8]} adds a fixed policy comparison
+    @metrics.timed
+    def optimize_resting_floors(self, elevator_id: int, start_date: datetime = None, end_date: datetime = None,
+                                bucketing: str = 'hour_of_week', seconds_per_floor: float = 1.5, what_if: Dict = None) -> Dict:
+        end_date = end_date or datetime.now()
+        start_date = start_date or end_date - timedelta(days=365)
+        elevator = self.registry.get(elevator_id)
+        if not elevator:
+            raise ValueError(f"Elevator {elevator_id} not found")
+        conn = self.get_connection()
+        try:
+            history = optimizer.load_history(conn, elevator_id, start_date, end_date)
+        finally:
+            conn.close()
+        result = optimizer.optimize(history, elevator['min_floor'], elevator['max_floor'], bucketing, seconds_per_floor)
+        summary = optimizer.summarize(result)
+        summary.update({'elevator_id': elevator_id, 'start_date': start_date.isoformat(), 'end_date': end_date.isoformat()})
+        if what_if:
+            buckets = optimizer.bucket_indexes_for(bucketing, what_if.get('days_of_week'), what_if.get('hours'), what_if.get('peak'))
+            summary['what_if'] = optimizer.what_if(result, what_if['floor'], buckets)
+        return summary
+
+    @metrics.timed
     def get_demand_analytics(self, elevator_id: int, days: int = 7) -> Dict:
         conn = self.get_connection()
         cursor = conn.cursor()
         
         start_date = datetime.now() - timedelta(days=days)
+        source, params = self._demand_window([elevator_id], start_date)
         
     #floor popularity
-        cursor.execute("""
-            SELECT requested_floor, COUNT(*) as demand_count
-            FROM demand_events 
-            WHERE elevator_id = ? 
-            AND request_time >= ?
+        cursor.execute(f"""
+            SELECT requested_floor, SUM(demand_count) as demand_count
+            FROM {source}
             GROUP BY requested_floor
-            ORDER BY demand_count DESC
-        """, (elevator_id, start_date))
+            ORDER BY demand_count DESC, requested_floor
+        """, params)
         
         floor_popularity = [dict(row) for row in cursor.fetchall()]
         
 
-        cursor.execute("""
+        cursor.execute(f"""
             SELECT 
             is_peak_hour, 
-            AVG(CAST(hour_of_day AS FLOAT)) as avg_hour,
-            COUNT(*) as total_demands
-            FROM demand_events 
-            WHERE elevator_id = ? 
-            AND request_time >= ?
+            CAST(SUM(hour_of_day * demand_count) AS FLOAT) / SUM(demand_count) as avg_hour,
+            SUM(demand_count) as total_demands
+            FROM {source}
             GROUP BY is_peak_hour
-        """, (elevator_id, start_date))
+        """, params)
         
         peak_analysis = [dict(row) for row in cursor.fetchall()]
         conn.close()
@@ -262,86 +1539,945 @@ class ElevatorDataService:
             'floor_popularity': floor_popularity,
             'peak_hour_analysis': peak_analysis}
 
+    #Floor x hour of day demand counts, optionally for a single day of the week
+    @metrics.timed
+    def get_demand_heatmap(self, elevator_id: int, days: int = 7, day_of_week: int = None) -> Dict:
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        source, params = self._demand_window([elevator_id], datetime.now() - timedelta(days=days))
+        query = f"SELECT requested_floor, hour_of_day, SUM(demand_count) as demand_count FROM {source}"
+        if day_of_week is not None:
+            query += " WHERE day_of_week = ?"
+            params.append(day_of_week)
+        cursor.execute(query + " GROUP BY requested_floor, hour_of_day", params)
+        rows = cursor.fetchall()
+        conn.close()
+
+        floors = sorted({row['requested_floor'] for row in rows})
+        index = {floor: i for i, floor in enumerate(floors)}
+        counts = [[0] * 24 for _ in floors]
+        for row in rows:
+            counts[index[row['requested_floor']]][row['hour_of_day']] = row['demand_count']
+        return {'elevator_id': elevator_id,
+            'analysis_period_days': days,
+            'day_of_week': day_of_week,
+            'floors': floors,
+            'hours': list(range(24)),
+            'counts': counts}
 
+    #p50/p95/p99 (or any quantiles) of the wait until the next demand and of idle run lengths, plus
+    #distinct floors requested, over the last `days`. Hourly sketches are merged on read, overall or per
+    #hour of day / day of week (of the hour the rest started). Quantiles are within relative_error
+    @metrics.timed
+    def get_demand_percentiles(self, elevator_id: int, days: int = 7, quantiles: List[float] = None,
+                               group_by: str = None) -> Dict:
+        quantiles = list(quantiles or DEFAULT_QUANTILES)
+        for q in quantiles:
+            if not 0 <= q <= 1:
+                raise ValueError(f"Quantile must be between 0 and 1: {q}")
+        if group_by not in PERCENTILE_GROUPS:
+            raise ValueError(f"Invalid group_by: {group_by}")
+        start = timestamps.hour_bucket(timestamps.to_ms(datetime.now() - timedelta(days=days)))
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT hour_bucket, metric, sketch FROM elevator_sketches WHERE elevator_id = ? AND hour_bucket >= ?",
+                       (elevator_id, start))
+        rows = cursor.fetchall()
+        conn.close()
 
+        groups = {}
+        for hour, metric, data in rows:
+            if group_by == 'hour_of_day':
+                group = timestamps.from_ms(hour).hour
+            elif group_by == 'day_of_week':
+                group = timestamps.from_ms(hour).weekday()
+            else:
+                group = None
+            merged = groups.setdefault(group, {})
+            summary = sketches.load(metric, data)
+            if metric in merged:
+                merged[metric].merge(summary)
+            else:
+                merged[metric] = summary
 
-service = ElevatorDataService(DATABASE)
+        def describe(merged):
+            result = {}
+            for metric in ('wait_minutes', 'idle_minutes'):
+                summary = merged.get(metric) or sketches.QuantileSketch()
+                result[metric] = {'count': summary.count,
+                    'quantiles': {f'p{q * 100:g}': summary.quantile(q) for q in quantiles}}
+            result['distinct_floors'] = merged['floors'].count if 'floors' in merged else 0
+            return result
 
-#Endpoints,
-#Saves demand
-@app.route('/elevators/<int:elevator_id>/demand', methods=['POST'])
-def record_demand(elevator_id):
-    data = request.get_json()
+        result = {'elevator_id': elevator_id,
+            'analysis_period_days': days,
+            'relative_error': sketches.RELATIVE_ACCURACY,
+            'group_by': group_by}
+        if group_by is None:
+            result.update(describe(groups.get(None, {})))
+        else:
+            result['groups'] = [dict(describe(groups[group]), **{group_by: group}) for group in sorted(groups)]
+        return result
+
+    #Side by side totals for several elevators, all from one pass over the rollups
+    @metrics.timed
+    def compare_elevators(self, elevator_ids: List[int], days: int = 7) -> Dict:
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        source, params = self._demand_window(elevator_ids, datetime.now() - timedelta(days=days))
+        cursor.execute(f"""
+            SELECT elevator_id, requested_floor, is_peak_hour, SUM(demand_count) as demand_count
+            FROM {source}
+            GROUP BY elevator_id, requested_floor, is_peak_hour
+        """, params)
+        rows = cursor.fetchall()
+        conn.close()
+
+        summary = {elevator_id: {'elevator_id': elevator_id, 'total_demands': 0, 'peak_demands': 0, 'floors': {}}
+                   for elevator_id in elevator_ids}
+        for row in rows:
+            item = summary[row['elevator_id']]
+            item['total_demands'] += row['demand_count']
+            if row['is_peak_hour']:
+                item['peak_demands'] += row['demand_count']
+            item['floors'][row['requested_floor']] = item['floors'].get(row['requested_floor'], 0) + row['demand_count']
+        elevators = []
+        for item in summary.values():
+            floors = item.pop('floors')
+            item['top_floor'] = min(floors, key=lambda floor: (-floors[floor], floor)) if floors else None
+            item['peak_share'] = item['peak_demands'] / item['total_demands'] if item['total_demands'] else 0.0
+            elevators.append(item)
+        return {'analysis_period_days': days, 'elevators': elevators}
+
+
+
+#Module level service, opened on first use: importing this module does no I/O, a forked worker or a
+#CLI command that never touches the database doesn't pay for opening it. Tests swap `service` for
+#a mock or their own instance as before
+class LazyService:
+    def __init__(self, factory, on_open=None):
+        self._factory = factory
+        self._on_open = on_open
+        self._instance = None
+        self._lock = threading.Lock()
+
+    @property
+    def opened(self) -> bool:
+        return self._instance is not None
+
+    def get(self):
+        if self._instance is None:
+            with self._lock:
+                if self._instance is None:
+                    instance = self._factory()
+                    self._instance = instance
+                    if self._on_open is not None:
+                        self._on_open(instance)
+        return self._instance
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+    #Never opens the database just to close it
+    def close(self):
+        if self._instance is not None:
+            self._instance.close()
+
+
+#Live event feed for GET /stream
+hub = EventHub(int(os.environ.get('ELEVATOR_STREAM_HISTORY', 10000)))
+
+#ELEVATOR_SHARD_DIR switches to one database per building (see app/sharding.py)
+def open_service(db_path: str = None, shard_dir: str = None):
+    shard_dir = shard_dir or os.environ.get('ELEVATOR_SHARD_DIR')
+    if shard_dir:
+        from app.sharding import ShardedElevatorDataService
+        return ShardedElevatorDataService(shard_dir, hub=hub)
+    return ElevatorDataService(db_path or DATABASE, hub=hub)
+
+#Background work that reads the database starts with the service
+def _service_opened(instance):
+    if os.environ.get('ELEVATOR_COMPACTION', 'off') == 'on' and compactor is None:
+        enable_compaction()
+    start_background()
+
+service = LazyService(open_service, _service_opened)
+
+#App factory: points the service at another file or shard directory, still opened lazily
+#unless eager (e.g. gunicorn --preload opens it once in the master before forking)
+def create_app(db_path: str = None, shard_dir: str = None, eager: bool = False) -> Flask:
+    global service
+    _stop_background()
+    service.close()
+    service = LazyService(lambda: open_service(db_path, shard_dir), _service_opened)
+    if eager:
+        service.get()
+    return app
+
+#Opens the service now rather than on the first request, for server startup hooks
+def warm_up():
+    if isinstance(service, LazyService):
+        service.get()
+
+def _close_service():
+    service.close()
+
+atexit.register(_close_service)
+
+#Analytics and JSON training data responses, see app/cache.py. ELEVATOR_CACHE_SIZE=0 keeps
+#ETag / 304 handling but stores no bodies. ELEVATOR_CACHE_TTL is also how long a write from another
+#process can go unnoticed, 0 turns the window off (only this process writes to the database)
+response_cache = ResponseCache(max_entries=int(os.environ.get('ELEVATOR_CACHE_SIZE', 1024)),
+                               ttl=float(os.environ.get('ELEVATOR_CACHE_TTL', 30)))
+
+#304 straight from the in-memory write versions, otherwise the cached body or compute()
+def cached_json(route: str, key: tuple, elevator_id: int, compute):
+    etag, last_modified = response_cache.validators(service.versions, key, elevator_id)
+    headers = validator_headers(etag, last_modified)
+    if response_cache.not_modified(etag, last_modified, request.headers.get('If-None-Match'),
+                                   request.headers.get('If-Modified-Since'), route):
+        return Response(status=304, headers=headers)
+    return jsonify(response_cache.get_or_compute(key, etag, compute, route)), 200, headers
+
+#Optional write-behind ingestion (ELEVATOR_INGEST_MODE=async). Events are acknowledged with a
+#provisional id and group committed by a background writer
+ingest_queue = None
+
+def enable_async_ingest(max_size: int = None, batch_size: int = None, flush_interval: float = None, synchronous: str = None):
+    global ingest_queue
+    ingest_queue = IngestQueue(service,
+        max_size=max_size or int(os.environ.get('ELEVATOR_INGEST_QUEUE_SIZE', 10000)),
+        batch_size=batch_size or int(os.environ.get('ELEVATOR_INGEST_BATCH_SIZE', 500)),
+        flush_interval=flush_interval if flush_interval is not None else int(os.environ.get('ELEVATOR_INGEST_FLUSH_MS', 50)) / 1000,
+        synchronous=synchronous or os.environ.get('ELEVATOR_INGEST_SYNCHRONOUS', 'NORMAL'),
+        retries=int(os.environ.get('ELEVATOR_INGEST_RETRIES', 5))).start()
+    #atexit runs in reverse, so the queue is drained before the pool closes
+    atexit.register(ingest_queue.stop)
+    return ingest_queue
+
+def disable_async_ingest():
+    global ingest_queue
+    if ingest_queue is not None:
+        ingest_queue.stop()
+        atexit.unregister(ingest_queue.stop)
+        ingest_queue = None
+
+#Optional binary listener for controller gateways, ELEVATOR_GATEWAY=tcp://0.0.0.0:2026 (comma separated,
+#unix:///path too). Length prefixed fixed layout records, see app/gateway.py
+gateway = None
+
+def enable_gateway(addresses: List[str] = None):
+    global gateway
+    from app.gateway import GatewayListener
+    gateway = GatewayListener(service, addresses or os.environ['ELEVATOR_GATEWAY'].split(',')).start()
+    atexit.register(gateway.stop)
+    return gateway
+
+def disable_gateway():
+    global gateway
+    if gateway is not None:
+        gateway.stop()
+        atexit.unregister(gateway.stop)
+        gateway = None
+
+#Optional background compaction of elevator_states (ELEVATOR_COMPACTION=on, starts when the service
+#is opened), tiers from ELEVATOR_RETENTION_* (see app/compaction.py)
+compactor = None
+
+def enable_compaction(policy: RetentionPolicy = None, interval: float = None):
+    global compactor
+    compactor = StateCompactor(service, policy or RetentionPolicy.from_env(),
+        interval=interval if interval is not None else float(os.environ.get('ELEVATOR_COMPACTION_INTERVAL', 300))).start()
+    atexit.register(compactor.stop)
+    return compactor
+
+def disable_compaction():
+    global compactor
+    if compactor is not None:
+        compactor.stop()
+        atexit.unregister(compactor.stop)
+        compactor = None
+
+#The write-behind queue (ELEVATOR_INGEST_MODE=async) and the gateway (ELEVATOR_GATEWAY) start with the
+#service or on the first request, whichever comes first, never at import. create_app stops them so
+#they restart against the new service
+background_started = False
+_background_stops = []  #disable_* for what start_background started, enable_* calls made by hand are left alone
+_background_lock = threading.Lock()
+
+def start_background():
+    global background_started
+    if background_started:
+        return
+    with _background_lock:
+        if background_started:
+            return
+        #set first: the queue's writer opens the service, which calls back in here
+        background_started = True
+        if os.environ.get('ELEVATOR_INGEST_MODE', 'sync') == 'async' and ingest_queue is None:
+            enable_async_ingest()
+            _background_stops.append(disable_async_ingest)
+        if os.environ.get('ELEVATOR_GATEWAY') and gateway is None:
+            enable_gateway()
+            _background_stops.append(disable_gateway)
+
+def _stop_background():
+    global background_started
+    with _background_lock:
+        while _background_stops:
+            _background_stops.pop()()
+        background_started = False
+
+#Per route request count and latency. Streaming responses are timed until the body starts
+@app.before_request
+def _start_background():
+    if not background_started:
+        start_background()
+
+@app.before_request
+def _start_timer():
+    if metrics.ENABLED:
+        g.metrics_started = time.perf_counter()
+
+@app.after_request
+def _record_request(response):
+    started = g.pop('metrics_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.http_latency.observe(time.perf_counter() - started, route, request.method)
+        metrics.http_requests.inc(1, route, request.method, response.status_code)
+    return response
+
+metrics.register_db_size_gauge(lambda: service.db_path)
+metrics.register_gauge('elevator_ingest_queue_depth', 'Events waiting for the write-behind writer', (),
+                       lambda: {(): ingest_queue.depth} if ingest_queue is not None else {})
+metrics.register_gauge('elevator_ingest_flush_seconds', 'Write-behind flush latency', ('stat',),
+                       lambda: {(stat,): ingest_queue.metrics()[f'{stat}_flush_seconds'] for stat in ('last', 'avg')}
+                       if ingest_queue is not None else {})
+metrics.register_gauge('elevator_stream_subscribers', 'Open /stream connections', (),
+                       lambda: {(): hub.subscriber_count})
+metrics.register_gauge('elevator_db_pool_connections', 'Open pooled connections', (),
+                       lambda: {(): service.pool.size})
+
+#Queues events in async mode, 202 Accepted, 429 when full and 503 when shutting down
+def _queue_events(kind: str, events: List[Dict], single: bool = False) -> tuple:
+    try:
+        if kind == 'demand':
+            result = ingest_queue.submit_demands(events)
+        else:
+            result = ingest_queue.submit_states(events)
+    except QueueFullError as e:
+        return 429, {'error': str(e)}, {'Retry-After': '1'}
+    except QueueClosedError as e:
+        return 503, {'error': str(e)}
+    if single:
+        item = result['results'][0]
+        if 'error' in item:
+            return 400, {'error': item['error']}
+        item.pop('index')
+        return 202, item
+    status = 202 if result['accepted'] else 400
+    return status, result
+
+#Route bodies shared with the ASGI app (app/asgi.py), so both servers validate and answer alike.
+#Plain arguments in, (status, payload[, headers]) out, or a CachedAnswer that each server resolves
+#through its own cache step (cached_json here, AsyncElevatorAPI._cached there)
+CachedAnswer = namedtuple('CachedAnswer', 'route key elevator_id compute')
+
+def respond(answer):
+    if isinstance(answer, CachedAnswer):
+        try:
+            return cached_json(*answer)
+        except Exception as e:
+            return jsonify({'error': str(e)}), 400
+    status, payload = answer[:2]
+    return jsonify(payload), status, (answer[2] if len(answer) > 2 else {})
+
+#like request.args.get(name, default, type=type) for any mapping: missing or bad values give the default
+def query_arg(args, name: str, type=str, default=None):
+    try:
+        return type(args[name])
+    except (KeyError, TypeError, ValueError):
+        return default
+
+def _json_object(data):
+    if not isinstance(data, dict):
+        return 400, {'error': 'JSON object body is required'}
+    return None
+
+def demand_answer(elevator_id: int, data) -> tuple:
+    error = _json_object(data)
+    if error:
+        return error
     if 'requested_floor' not in data:
-        return jsonify({'error': 'requested_floor is required'}), 400
-    
+        return 400, {'error': 'requested_floor is required'}
+    if ingest_queue is not None:
+        return _queue_events('demand', [dict(data, elevator_id=elevator_id)], single=True)
     try:
         request_time = None
         if 'request_time' in data:
             request_time = datetime.fromisoformat(data['request_time'])
-        result = service.record_demand(
+        return 201, service.record_demand(
             elevator_id=elevator_id,
             requested_floor=data['requested_floor'],
             request_time=request_time
         )
-        return jsonify(result), 201
-    
     except Exception as e:
-        return jsonify({'error': str(e)}), 400
-#Saves elevator state
-@app.route('/elevators/<int:elevator_id>/state', methods=['POST'])
-def record_state(elevator_id):
-    """Record elevator state change"""
-    data = request.get_json()
-    
-    required_fields = ['floor', 'state']
-    for field in required_fields:
+        return 400, {'error': str(e)}
+
+def state_answer(elevator_id: int, data) -> tuple:
+    error = _json_object(data)
+    if error:
+        return error
+    for field in ('floor', 'state'):
         if field not in data:
-            return jsonify({'error': f'{field} is required'}), 400
-    
+            return 400, {'error': f'{field} is required'}
+    if ingest_queue is not None:
+        return _queue_events('state', [dict(data, elevator_id=elevator_id)], single=True)
     try:
-        result = service.record_elevator_state(
+        return 201, service.record_elevator_state(
             elevator_id=elevator_id,
             floor=data['floor'],
             state=data['state'],
             passenger_count=data.get('passenger_count', 0),
             previous_floor=data.get('previous_floor')
         )
-        return jsonify(result), 201
-    
+    except Exception as e:
+        return 400, {'error': str(e)}
+
+#?hours comes from the hot store (memory only), ?days from the cached database query
+def analytics_answer(elevator_id: int, args):
+    hours = query_arg(args, 'hours', float)
+    if hours is not None:
+        try:
+            return 200, service.get_recent_demand_analytics(elevator_id, hours)
+        except Exception as e:
+            return 400, {'error': str(e)}
+    days = query_arg(args, 'days', int, 7)
+    return CachedAnswer('/elevators/<int:elevator_id>/analytics', ('analytics', elevator_id, days), elevator_id,
+                        lambda: service.get_demand_analytics(elevator_id, days))
+
+def current_answer(elevator_id: int, args) -> tuple:
+    try:
+        current = service.get_current(elevator_id, query_arg(args, 'limit', int, 10))
+    except Exception as e:
+        return 400, {'error': str(e)}
+    if current is None:
+        return 404, {'error': f'Elevator {elevator_id} not found'}
+    return 200, current
+
+def health_answer() -> tuple:
+    return 200, {'status': 'healthy', 'timestamp': datetime.now().isoformat()}
+
+#/training-data arguments, checked the same way for every format. Raises ValueError
+def training_query(args) -> Dict:
+    output = args.get('format', 'json')
+    start_date = args.get('start_date')
+    end_date = args.get('end_date')
+    query = {'elevator_id': query_arg(args, 'elevator_id', int),
+             'start': datetime.fromisoformat(start_date) if start_date else None,
+             'end': datetime.fromisoformat(end_date) if end_date else None,
+             'after': args.get('after'),
+             'limit': query_arg(args, 'limit', int),
+             'format': output,
+             'with_count': args.get('count', 'true' if output == 'json' else 'false').lower() == 'true'}
+    if query['after']:
+        decode_training_cursor(query['after'])
+    if query['limit'] is not None and query['limit'] <= 0:
+        raise ValueError("limit must be positive")
+    if output != 'json' and output not in STREAM_FORMATS:
+        raise ValueError(f"Unknown format: {output}")
+    return query
+
+#One JSON page of training data, the cursor comes with it
+def training_page(elevator_id, start, end, after, limit, with_count) -> Dict:
+    if limit:
+        next_cursor, rows = service.open_training_page(elevator_id, start, end, after, limit)
+        data = list(rows)
+    else:
+        data = service.get_ml_training_data(elevator_id, start, end, after=after)
+    body = {'data': data}
+    if with_count:
+        body['count'] = len(data)
+    if limit:
+        body['next_cursor'] = next_cursor
+    return body
+
+def training_answer(query: Dict) -> CachedAnswer:
+    page = (query['elevator_id'], query['start'], query['end'], query['after'], query['limit'], query['with_count'])
+    return CachedAnswer('/training-data', ('training-data',) + page, query['elevator_id'],
+                        lambda: training_page(*page))
+
+#Backfills ml_training_data from history: flask --app app.elevator_api rebuild-training-data
+@app.cli.command('rebuild-training-data')
+def rebuild_training_data_command():
+    samples = service.rebuild_ml_training_data()
+    print(f"ml_training_data rebuilt: {samples} samples")
+
+@app.cli.command('rebuild-rollups')
+def rebuild_rollups_command():
+    buckets = service.rebuild_demand_rollups()
+    print(f"demand_hourly_rollups rebuilt: {buckets} buckets")
+
+@app.cli.command('rebuild-sketches')
+def rebuild_sketches_command():
+    summaries = service.rebuild_sketches()
+    print(f"elevator_sketches rebuilt: {summaries} sketches")
+
+#One compaction pass with the ELEVATOR_RETENTION_* tiers: flask --app app.elevator_api compact-states
+@app.cli.command('compact-states')
+@click.option('--vacuum', is_flag=True, help='Incremental vacuum afterwards')
+def compact_states_command(vacuum):
+    policy = RetentionPolicy.from_env()
+    result = StateCompactor(service, policy, pause=0).run_once()
+    print(f"{policy}: {result['raw_rows_compacted']} raw rows into {result['intervals_created']} intervals, "
+          f"{result['intervals_rolled_up']} intervals rolled up, {result['hourly_rows_expired']} hourly rows expired")
+    if vacuum:
+        print(f"{StateCompactor(service).vacuum()['pages_freed']} pages freed")
+
+#Full VACUUM, also switches databases from before compaction to incremental auto_vacuum.
+#Locks the database while it runs: flask --app app.elevator_api vacuum
+@app.cli.command('vacuum')
+def vacuum_command():
+    result = StateCompactor(service).vacuum(full=True)
+    print(f"{len(result['full'])} database(s) vacuumed, {result['pages_freed']} pages freed")
+
+#Writes memory mappable .npy files + manifest.json: flask --app app.elevator_api export-training-data <dir>
+@app.cli.command('export-training-data')
+@click.argument('directory')
+@click.option('--elevator-id', type=int, default=None)
+def export_training_data_command(directory, elevator_id):
+    arrays = service.get_training_arrays(elevator_id)
+    info = columnar.write_npy_dir(arrays, directory, elevator_id=elevator_id)
+    print(f"Exported {info['rows']} samples to {directory}")
+
+#Endpoints,
+#Buildings and elevators registry
+@app.route('/buildings', methods=['GET'])
+def list_buildings():
+    return jsonify({'buildings': service.list_buildings()})
+
+@app.route('/buildings', methods=['POST'])
+def create_building():
+    data = request.get_json(silent=True) or {}
+    try:
+        building = service.create_building(data.get('name'), data.get('total_floors'), data.get('id'))
+        return jsonify(building), 201
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/buildings/<int:building_id>', methods=['GET'])
+def get_building(building_id):
+    building = service.get_building(building_id)
+    if building is None:
+        return jsonify({'error': f'Building {building_id} not found'}), 404
+    return jsonify(building)
+
+@app.route('/buildings/<int:building_id>', methods=['PUT', 'PATCH'])
+def update_building(building_id):
+    data = request.get_json(silent=True) or {}
+    try:
+        building = service.update_building(building_id, data)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+    if building is None:
+        return jsonify({'error': f'Building {building_id} not found'}), 404
+    return jsonify(building)
+
+@app.route('/buildings/<int:building_id>', methods=['DELETE'])
+def delete_building(building_id):
+    try:
+        deleted = service.delete_building(building_id)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+    if not deleted:
+        return jsonify({'error': f'Building {building_id} not found'}), 404
+    return '', 204
+
+#/elevators?building_id=1
+@app.route('/elevators', methods=['GET'])
+def list_elevators():
+    building_id = request.args.get('building_id', type=int)
+    return jsonify({'elevators': service.list_elevators(building_id)})
+
+@app.route('/elevators', methods=['POST'])
+def create_elevator():
+    data = request.get_json(silent=True) or {}
+    try:
+        elevator = service.create_elevator(data.get('building_id'), data.get('name'), data.get('min_floor', 1),
+                                           data.get('max_floor'), data.get('max_capacity', 10), data.get('id'))
+        return jsonify(elevator), 201
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/elevators/<int:elevator_id>', methods=['GET'])
+def get_elevator(elevator_id):
+    elevator = service.get_elevator(elevator_id)
+    if elevator is None:
+        return jsonify({'error': f'Elevator {elevator_id} not found'}), 404
+    return jsonify(elevator)
+
+#Current floor and state plus the last ?limit=10 demands and states, from memory
+@app.route('/elevators/<int:elevator_id>/current', methods=['GET'])
+def get_elevator_current(elevator_id):
+    return respond(current_answer(elevator_id, request.args))
+
+@app.route('/elevators/<int:elevator_id>', methods=['PUT', 'PATCH'])
+def update_elevator(elevator_id):
+    data = request.get_json(silent=True) or {}
+    try:
+        elevator = service.update_elevator(elevator_id, data)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+    if elevator is None:
+        return jsonify({'error': f'Elevator {elevator_id} not found'}), 404
+    return jsonify(elevator)
+
+@app.route('/elevators/<int:elevator_id>', methods=['DELETE'])
+def delete_elevator(elevator_id):
+    try:
+        deleted = service.delete_elevator(elevator_id)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+    if not deleted:
+        return jsonify({'error': f'Elevator {elevator_id} not found'}), 404
+    return '', 204
+
+#Saves demand
+@app.route('/elevators/<int:elevator_id>/demand', methods=['POST'])
+def record_demand(elevator_id):
+    return respond(demand_answer(elevator_id, request.get_json(silent=True, force=True)))
+
+#Saves elevator state
+@app.route('/elevators/<int:elevator_id>/state', methods=['POST'])
+def record_state(elevator_id):
+    """Record elevator state change"""
+    return respond(state_answer(elevator_id, request.get_json(silent=True, force=True)))
+
+#Batch endpoints, body is a JSON array (or {"events": [...]}) spanning any elevators
+def _batch_events():
+    data = request.get_json(silent=True)
+    if isinstance(data, dict):
+        data = data.get('events')
+    if not isinstance(data, list) or not data:
+        return None, (jsonify({'error': 'a non-empty list of events is required'}), 400)
+    if len(data) > MAX_BATCH_SIZE:
+        return None, (jsonify({'error': f'batch too large, max {MAX_BATCH_SIZE} events'}), 413)
+    return data, None
+
+#201 when everything was stored, 207 when some items were rejected, 400 when none were
+def _batch_response(result):
+    if result['rejected'] == 0:
+        status = 201
+    elif result['accepted'] == 0:
+        status = 400
+    else:
+        status = 207
+    return jsonify(result), status
+
+@app.route('/elevators/demand/batch', methods=['POST'])
+def record_demand_batch():
+    events, error = _batch_events()
+    if error:
+        return error
+    if ingest_queue is not None:
+        return respond(_queue_events('demand', events))
+    try:
+        return _batch_response(service.record_demands_batch(events))
     except Exception as e:
         return jsonify({'error': str(e)}), 400
+
+@app.route('/elevators/state/batch', methods=['POST'])
+def record_state_batch():
+    events, error = _batch_events()
+    if error:
+        return error
+    if ingest_queue is not None:
+        return respond(_queue_events('state', events))
+    try:
+        return _batch_response(service.record_elevator_states_batch(events))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+#Streams rows as they come off the cursor
+def _ndjson_rows(rows):
+    for row in rows:
+        yield json.dumps(row) + '\n'
+
+def _csv_rows(rows, chunk_size: int = 500):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=TRAINING_COLUMNS)
+    writer.writeheader()
+    for i, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if i % chunk_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+STREAM_FORMATS = {'ndjson': ('application/x-ndjson', _ndjson_rows),
+                  'csv': ('text/csv', _csv_rows)}
+
 #Brings training data
+#format=json (default) | ndjson | csv, limit + after=<cursor> for keyset paging
 @app.route('/training-data', methods=['GET'])
 def get_training_data():
+    try:
+        query = training_query(request.args)
+        if query['format'] == 'json':
+            return respond(training_answer(query))
+        elevator_id, start, end, after, limit = (query[name] for name in ('elevator_id', 'start', 'end', 'after', 'limit'))
+        #Streaming: nothing is buffered, the next cursor goes in a header since it's known up front
+        mimetype, render = STREAM_FORMATS[query['format']]
+        headers = {}
+        if query['with_count']:
+            headers['X-Total-Count'] = str(service.count_ml_training_data(elevator_id, start, end, after))
+        next_cursor, rows = service.open_training_page(elevator_id, start, end, after, limit)
+        if next_cursor:
+            headers['X-Next-Cursor'] = next_cursor
+        return Response(render(rows), mimetype=mimetype, headers=headers)
+    
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+#Incremental feed: samples created or recomputed since a watermark, ?since=<watermark>&limit=N.
+#With ?consumer=<name> and no since, reading starts from that consumer's committed watermark
+@app.route('/training-data/changes', methods=['GET'])
+def get_training_changes():
     elevator_id = request.args.get('elevator_id', type=int)
+    since = request.args.get('since')
+    limit = request.args.get('limit', default=1000, type=int)
+    consumer = request.args.get('consumer')
+    try:
+        if since is None:
+            offset = service.get_consumer_offset(consumer) if consumer else None
+            since = offset['watermark'] if offset else '0'
+        return jsonify(service.get_training_changes(since, limit, elevator_id))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/training-data/consumers', methods=['GET'])
+def list_training_consumers():
+    return jsonify({'consumers': service.list_consumers()})
+
+@app.route('/training-data/consumers/<name>', methods=['GET'])
+def get_training_consumer(name):
+    offset = service.get_consumer_offset(name)
+    if offset is None:
+        return jsonify({'error': f'Unknown consumer: {name}'}), 404
+    return jsonify(offset)
+
+#Commits a watermark, body {"watermark": "..."} usually the next_watermark of a processed page
+@app.route('/training-data/consumers/<name>', methods=['PUT'])
+def commit_training_consumer(name):
+    data = request.get_json(silent=True) or {}
+    if 'watermark' not in data:
+        return jsonify({'error': 'watermark is required'}), 400
+    try:
+        return jsonify(service.commit_consumer_offset(name, data['watermark']))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/training-data/consumers/<name>', methods=['DELETE'])
+def delete_training_consumer(name):
+    if not service.delete_consumer(name):
+        return jsonify({'error': f'Unknown consumer: {name}'}), 404
+    return '', 204
+
+#Server-Sent Events: every accepted demand / state event, live from the in-process hub.
+#?elevator_id=1&elevator_id=2 or ?building_id=1 filter, ?types=demand,state, resume with the
+#Last-Event-ID header (browsers send it on reconnect) or ?resume=<token>. Control frames in app/events.py
+STREAM_KEEPALIVE_SECONDS = 15
+
+def stream_subscription(elevator_ids: List[int], building_id: int, types: str, resume: str):
+    kinds = [kind for kind in (types or '').split(',') if kind]
+    for kind in kinds:
+        if kind not in ('demand', 'state'):
+            raise ValueError(f"Unknown event type: {kind}")
+    elevator_ids = list(elevator_ids)
+    if building_id is not None:
+        building_elevators = service.get_building_elevator_ids(building_id)
+        if not building_elevators:
+            raise ValueError(f"Building {building_id} has no elevators")
+        elevator_ids = [elevator_id for elevator_id in building_elevators if not elevator_ids or elevator_id in elevator_ids]
+    return hub.subscribe(elevator_ids or None, kinds or None, resume,
+                         max_buffer=int(os.environ.get('ELEVATOR_STREAM_BUFFER', 256)))
+
+def sse_frames(subscription, replayed, complete, keepalive: float = STREAM_KEEPALIVE_SECONDS):
+    try:
+        yield RETRY_FRAME
+        if not complete:
+            yield RESET_FRAME
+        for event in replayed:
+            yield event.sse()
+        while True:
+            events = subscription.get(keepalive)
+            if events:
+                yield ''.join(event.sse() for event in events)
+            if subscription.closed:
+                if subscription.dropped:
+                    yield DROPPED_FRAME
+                return
+            if not events:
+                yield KEEPALIVE_FRAME
+    finally:
+        subscription.close()
+
+@app.route('/stream', methods=['GET'])
+def stream_events():
+    try:
+        subscription, replayed, complete = stream_subscription(
+            request.args.getlist('elevator_id', type=int), request.args.get('building_id', type=int),
+            request.args.get('types'), request.headers.get('Last-Event-ID') or request.args.get('resume'))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+    return Response(sse_frames(subscription, replayed, complete), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/stream/metrics', methods=['GET'])
+def get_stream_metrics():
+    return jsonify(hub.metrics())
 
+#Training features as NumPy arrays: format=npz (default) or tar (one .npy per column + manifest.json)
+@app.route('/training-data/columns', methods=['GET'])
+def get_training_columns():
+    elevator_id = request.args.get('elevator_id', type=int)
     start_date = request.args.get('start_date')
-    end_date = request.args.get('end_date')    
+    end_date = request.args.get('end_date')
+    output = request.args.get('format', default='npz')
     try:
         start = datetime.fromisoformat(start_date) if start_date else None
         end = datetime.fromisoformat(end_date) if end_date else None
-        
-        data = service.get_ml_training_data(elevator_id, start, end)
-        
-        return jsonify({'count': len(data),'data': data})
-    
+        if output not in ('npz', 'tar'):
+            raise ValueError(f"Unknown format: {output}")
+        arrays = service.get_training_arrays(elevator_id, start, end)
+    except RuntimeError as e:
+        return jsonify({'error': str(e)}), 501
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+    buffer = io.BytesIO()
+    if output == 'npz':
+        columnar.write_npz(arrays, buffer)
+        mimetype = 'application/octet-stream'
+    else:
+        columnar.write_npy_tar(arrays, buffer, elevator_id=elevator_id, start_date=start_date, end_date=end_date)
+        mimetype = 'application/x-tar'
+    return Response(buffer.getvalue(), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename=training-data.{output}'})
+
+#Floor that minimizes expected travel to the next call, ?at=ISO time (default now)
+@app.route('/elevators/<int:elevator_id>/recommended-resting-floor', methods=['GET'])
+def get_recommended_resting_floor(elevator_id):
+    at = request.args.get('at')
+    try:
+        return jsonify(service.recommend_resting_floor(elevator_id, datetime.fromisoformat(at) if at else None))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+#Offline what-if analysis, e.g. ?start_date=...&what_if_floor=1&what_if_days=0,1,2,3,4&what_if_hours=7,8
+@app.route('/elevators/<int:elevator_id>/resting-floor-analysis', methods=['GET'])
+def get_resting_floor_analysis(elevator_id):
+    def int_list(name):
+        value = request.args.get(name)
+        return [int(item) for item in value.split(',') if item.strip()] if value else None
+    try:
+        start_date = request.args.get('start_date')
+        end_date = request.args.get('end_date')
+        what_if = None
+        if request.args.get('what_if_floor') is not None:
+            peak = request.args.get('what_if_peak')
+            what_if = {'floor': request.args.get('what_if_floor', type=int),
+                       'days_of_week': int_list('what_if_days'),
+                       'hours': int_list('what_if_hours'),
+                       'peak': None if peak is None else peak.lower() == 'true'}
+        result = service.optimize_resting_floors(elevator_id,
+            datetime.fromisoformat(start_date) if start_date else None,
+            datetime.fromisoformat(end_date) if end_date else None,
+            bucketing=request.args.get('bucketing', default='hour_of_week'),
+            seconds_per_floor=request.args.get('seconds_per_floor', default=1.5, type=float),
+            what_if=what_if)
+        return jsonify(result)
+    except RuntimeError as e:
+        return jsonify({'error': str(e)}), 501
     except Exception as e:
         return jsonify({'error': str(e)}), 400
 
-#Brings demand analytics
+#Brings demand analytics. ?hours=1 is the short window mode, answered from the hot store
 @app.route('/elevators/<int:elevator_id>/analytics', methods=['GET'])
 def get_analytics(elevator_id):
+    return respond(analytics_answer(elevator_id, request.args))
+
+@app.route('/elevators/<int:elevator_id>/analytics/heatmap', methods=['GET'])
+def get_heatmap(elevator_id):
     days = request.args.get('days', default=7, type=int)
+    day_of_week = request.args.get('day_of_week', type=int)
     try:
-        analytics = service.get_demand_analytics(elevator_id, days)
-        return jsonify(analytics)
+        return jsonify(service.get_demand_heatmap(elevator_id, days, day_of_week))
     except Exception as e:
         return jsonify({'error': str(e)}), 400
+
+#Wait and idle percentiles: /elevators/1/analytics/percentiles?days=30&quantiles=0.5,0.9&group_by=hour_of_day
+@app.route('/elevators/<int:elevator_id>/analytics/percentiles', methods=['GET'])
+def get_percentiles(elevator_id):
+    days = request.args.get('days', default=7, type=int)
+    group_by = request.args.get('group_by')
+    try:
+        quantiles = tuple(float(value) for value in request.args.get('quantiles', '').split(',') if value.strip()) or DEFAULT_QUANTILES
+        return cached_json('/elevators/<int:elevator_id>/analytics/percentiles', ('percentiles', elevator_id, days, quantiles, group_by),
+                           elevator_id, lambda: service.get_demand_percentiles(elevator_id, days, quantiles, group_by))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+#Compare several elevators: /analytics/compare?elevator_ids=1,2,3&days=90
+@app.route('/analytics/compare', methods=['GET'])
+def compare_elevators():
+    days = request.args.get('days', default=7, type=int)
+    try:
+        elevator_ids = [int(value) for value in request.args.get('elevator_ids', '').split(',') if value.strip()]
+        if not elevator_ids:
+            return jsonify({'error': 'elevator_ids is required'}), 400
+        return jsonify(service.compare_elevators(elevator_ids, days))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+#Write-behind queue depth and flush latency
+@app.route('/ingest/metrics', methods=['GET'])
+def get_ingest_metrics():
+    if ingest_queue is None:
+        return jsonify({'mode': 'sync'})
+    return jsonify(dict(ingest_queue.metrics(), mode='async'))
+
+@app.route('/gateway/metrics', methods=['GET'])
+def get_gateway_metrics():
+    if gateway is None:
+        return jsonify({'running': False})
+    return jsonify(gateway.metrics())
+
+@app.route('/hotstore/metrics', methods=['GET'])
+def get_hotstore_metrics():
+    return jsonify(service.get_hot_metrics())
+
+@app.route('/cache/metrics', methods=['GET'])
+def get_cache_metrics():
+    return jsonify(response_cache.metrics())
+
+@app.route('/compaction/metrics', methods=['GET'])
+def get_compaction_metrics():
+    if compactor is None:
+        return jsonify({'running': False})
+    return jsonify(compactor.metrics())
+
+#Prometheus scrape endpoint, ELEVATOR_METRICS=off disables it and every hook
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    if not metrics.ENABLED:
+        return jsonify({'error': 'metrics are disabled'}), 404
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 #Health check, classic
 @app.route('/health', methods=['GET'])
 def health_check():
-    return jsonify({'status': 'healthy', 'timestamp': datetime.now().isoformat()})
+    return respond(health_answer())
 
 if __name__ == '__main__':
     app.run(debug=True, port=2025)
\ No newline at end of file
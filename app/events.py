@@ -0,0 +1,153 @@
+import itertools
+import json
+import threading
+import uuid
+from collections import deque
+from typing import Dict, List
+
+#In-process pub/sub for accepted demand and state events, feeds GET /stream.
+#Publishing never blocks and never touches the database: each subscriber has a bounded buffer,
+#one that falls behind by more than its buffer is dropped (it reconnects with its resume token).
+#The last `history_size` events are kept so reconnecting clients get what they missed.
+#Resume tokens are '<hub epoch>-<event id>', the epoch changes on restart so stale tokens are detected
+
+DEFAULT_BUFFER = 256
+DEFAULT_HISTORY = 10000
+
+#Control frames. reset: events were missed (restart, or older than the history), reload state.
+#dropped: the client fell behind and was cut off, reconnect with the last id it got
+RETRY_FRAME = "retry: 3000\n\n"
+RESET_FRAME = "event: reset\ndata: {}\n\n"
+DROPPED_FRAME = "event: dropped\ndata: {}\n\n"
+KEEPALIVE_FRAME = ": keepalive\n\n"
+
+
+class Event:
+    __slots__ = ('id', 'kind', 'elevator_id', 'data', 'token')
+
+    def __init__(self, event_id: int, kind: str, elevator_id: int, data: Dict, token: str):
+        self.id = event_id
+        self.kind = kind
+        self.elevator_id = elevator_id
+        self.data = data
+        self.token = token
+
+    #text/event-stream frame
+    def sse(self) -> str:
+        return f"id: {self.token}\nevent: {self.kind}\ndata: {json.dumps(self.data)}\n\n"
+
+
+class Subscription:
+    def __init__(self, hub: 'EventHub', elevator_ids=None, kinds=None, max_buffer: int = DEFAULT_BUFFER):
+        self.hub = hub
+        self.elevator_ids = set(elevator_ids) if elevator_ids else None
+        self.kinds = set(kinds) if kinds else None
+        self.max_buffer = max_buffer
+        self.dropped = False
+        self.closed = False
+        self.listener = None  #called from the publishing thread when events arrive (asyncio wakeups)
+        self._events = deque()
+        self._cond = threading.Condition()
+
+    def wants(self, event: Event) -> bool:
+        return (self.elevator_ids is None or event.elevator_id in self.elevator_ids) and \
+            (self.kinds is None or event.kind in self.kinds)
+
+    def _offer(self, event: Event):
+        with self._cond:
+            if self.closed:
+                return
+            if len(self._events) >= self.max_buffer:
+                self.dropped = True
+                self.closed = True
+            else:
+                self._events.append(event)
+            self._cond.notify()
+        if self.closed:
+            self.hub.unsubscribe(self)
+        if self.listener is not None:
+            self.listener()
+
+    #Everything buffered, waits up to timeout for the first one. [] on timeout or once closed
+    def get(self, timeout: float = None) -> List[Event]:
+        with self._cond:
+            if not self._events and not self.closed:
+                self._cond.wait(timeout)
+            events = list(self._events)
+            self._events.clear()
+            return events
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+        self.hub.unsubscribe(self)
+        if self.listener is not None:
+            self.listener()
+
+
+class EventHub:
+    def __init__(self, history_size: int = DEFAULT_HISTORY):
+        self.epoch = uuid.uuid4().hex[:8]
+        self._ids = itertools.count(1)
+        self._history = deque(maxlen=history_size)
+        self._subscribers = ()  #replaced, never mutated, publishers iterate without the lock
+        self._lock = threading.Lock()
+        #held from id to delivery, so every subscription gets ids in order (a resume token never skips one).
+        #Taken before _lock, never while holding it
+        self._deliver_lock = threading.Lock()
+        self._stats = {'published': 0, 'dropped_subscribers': 0}
+
+    def publish(self, kind: str, elevator_id: int, data: Dict) -> Event:
+        with self._deliver_lock:
+            with self._lock:
+                event_id = next(self._ids)
+                event = Event(event_id, kind, elevator_id, data, f'{self.epoch}-{event_id}')
+                self._history.append(event)
+                self._stats['published'] += 1
+                #subscribers that joined after this point got the event through their replay
+                subscribers = self._subscribers
+            #outside _lock: a subscription that overflows unsubscribes itself
+            for subscription in subscribers:
+                if subscription.wants(event):
+                    subscription._offer(event)
+        return event
+
+    def publish_many(self, kind: str, items: List[Dict]):
+        for data in items:
+            self.publish(kind, data['elevator_id'], data)
+
+    #Subscribes and replays what was missed since `resume`. Returns (subscription, replayed, complete):
+    #complete is False when the token is from another run or older than the history, the client
+    #has a gap and should reload its state
+    def subscribe(self, elevator_ids=None, kinds=None, resume: str = None, max_buffer: int = DEFAULT_BUFFER):
+        subscription = Subscription(self, elevator_ids, kinds, max_buffer)
+        with self._lock:
+            replayed, complete = self._replay(subscription, resume)
+            self._subscribers = self._subscribers + (subscription,)
+        return subscription, replayed, complete
+
+    def _replay(self, subscription: Subscription, resume: str):
+        if not resume:
+            return [], True
+        epoch, _, last_id = resume.rpartition('-')
+        if epoch != self.epoch or not last_id.isdigit():
+            return [], False
+        last_id = int(last_id)
+        complete = not self._history or self._history[0].id <= last_id + 1
+        return [event for event in self._history if event.id > last_id and subscription.wants(event)], complete
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            if subscription in self._subscribers:
+                self._subscribers = tuple(item for item in self._subscribers if item is not subscription)
+                if subscription.dropped:
+                    self._stats['dropped_subscribers'] += 1
+
+    @property
+    def subscriber_count(self) -> int:
+        return len(self._subscribers)
+
+    def metrics(self) -> Dict:
+        with self._lock:
+            return dict(self._stats, subscribers=len(self._subscribers), history=len(self._history))
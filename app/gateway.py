@@ -0,0 +1,276 @@
+#Binary ingestion for controller gateways. Length prefixed frames of fixed layout records over TCP or
+#a Unix socket, decoded a whole frame at a time (NumPy structured arrays, struct when NumPy is missing),
+#checked against the elevator registry in one pass and stored with record_event_rows, one transaction per frame.
+#No JSON, no HTTP request cycle, no per event dicts on the way in.
+#   python -m app.gateway --db elevator_data.db --listen tcp://0.0.0.0:2026 --listen unix:///run/elevators.sock
+#or ELEVATOR_GATEWAY=tcp://127.0.0.1:2026 in the API process, then the events also reach GET /stream.
+#Protocol, everything little endian:
+#   frame   uint32 payload length, then the payload: any number of records. An empty frame is a ping
+#   record  RECORD_STRUCT, 20 bytes: elevator_id u32, kind u8 (DEMAND / STATE), state u8 (index in
+#           VALID_STATES, states only), floor i16 (requested floor for demands), previous_floor i16
+#           (NO_FLOOR when unknown), passenger_count u16, timestamp i64 epoch ms (wall clock, app/timestamps.py,
+#           records outside MIN_MS..MAX_MS are rejected)
+#   ack     ACK_STRUCT, accepted u32 and rejected u32, one per frame in frame order, sent once the rows
+#           are committed. A frame is stored in one transaction: accepted records are committed, none of the
+#           others are (invalid, or the write failed and rejected is the whole frame; sharded, per building).
+#           A frame that isn't whole records or is above MAX_FRAME_BYTES closes the connection
+#Load generator: python -m bench.gateway_load
+import argparse
+import asyncio
+import logging
+import os
+import struct
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Tuple
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app import rules  # noqa: E402
+from app.columnar import np  # noqa: E402
+from app.elevator_api import VALID_STATES  # noqa: E402
+from app.timestamps import DAY_MS, HOUR_MS, MAX_MS, MIN_MS  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+DEMAND = 0
+STATE = 1
+NO_FLOOR = -32768
+RECORD_STRUCT = struct.Struct('<IBBhhHq')
+RECORD_SIZE = RECORD_STRUCT.size
+FRAME_HEADER = struct.Struct('<I')
+ACK_STRUCT = struct.Struct('<II')
+MAX_FRAME_RECORDS = 65536
+MAX_FRAME_BYTES = MAX_FRAME_RECORDS * RECORD_SIZE
+DEFAULT_ADDRESS = 'tcp://127.0.0.1:2026'
+
+#1970-01-01 was a Thursday, weekday() 3
+EPOCH_WEEKDAY = 3
+#is_peak_hour by day_of_week * 24 + hour_of_day, the same rule as every other ingest path
+PEAK_HOURS = [rules.is_peak_hour(index % 24, index // 24) for index in range(7 * 24)]
+
+if np is not None:
+    RECORD_DTYPE = np.dtype([('elevator_id', '<u4'), ('kind', 'u1'), ('state', 'u1'), ('floor', '<i2'),
+                             ('previous_floor', '<i2'), ('passenger_count', '<u2'), ('timestamp', '<i8')])
+    assert RECORD_DTYPE.itemsize == RECORD_SIZE
+    _PEAK_ARRAY = np.array(PEAK_HOURS)
+    _STATE_NAMES = np.array(VALID_STATES, dtype=object)
+
+
+def encode_records(records: List[tuple]) -> bytes:
+    return b''.join(RECORD_STRUCT.pack(*record) for record in records)
+
+
+def encode_frame(payload: bytes) -> bytes:
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+#Returns (demand rows, state rows, rejected count) in the row layouts of record_event_rows, each in
+#record order. load_bounds(ids) -> {elevator_id: registry row}
+def decode_frame(payload: bytes, load_bounds: Callable) -> Tuple[List[tuple], List[tuple], int]:
+    if len(payload) % RECORD_SIZE:
+        raise ValueError(f"Frame of {len(payload)} bytes is not a whole number of {RECORD_SIZE} byte records")
+    if not payload:
+        return [], [], 0
+    if np is not None:
+        return _decode_numpy(payload, load_bounds)
+    return _decode_struct(payload, load_bounds)
+
+
+def _decode_numpy(payload: bytes, load_bounds: Callable):
+    records = np.frombuffer(payload, dtype=RECORD_DTYPE)
+    #bounds once per distinct elevator, spread back over the records; unknown ids get an empty range
+    elevator_ids, inverse = np.unique(records['elevator_id'], return_inverse=True)
+    bounds = load_bounds(elevator_ids.tolist())
+    ranges = [(bounds[elevator_id]['min_floor'], bounds[elevator_id]['max_floor']) if elevator_id in bounds else (1, 0)
+              for elevator_id in elevator_ids.tolist()]
+    ranges = np.array(ranges, dtype=np.int32).reshape(-1, 2)[inverse]
+    kind, floor, timestamp = records['kind'], records['floor'], records['timestamp']
+    valid = (floor >= ranges[:, 0]) & (floor <= ranges[:, 1]) & (timestamp >= MIN_MS) & (timestamp <= MAX_MS)
+    demands = records[valid & (kind == DEMAND)]
+    states = records[valid & (kind == STATE) & (records['state'] < len(VALID_STATES))]
+
+    request_ms = demands['timestamp']
+    day_of_week = (request_ms // DAY_MS + EPOCH_WEEKDAY) % 7
+    hour_of_day = request_ms // HOUR_MS % 24
+    demand_rows = list(zip(demands['elevator_id'].tolist(), demands['floor'].tolist(), request_ms.tolist(),
+                           day_of_week.tolist(), hour_of_day.tolist(), _PEAK_ARRAY[day_of_week * 24 + hour_of_day].tolist()))
+    previous_floor = states['previous_floor']
+    previous_floor = np.where(previous_floor == NO_FLOOR, None, previous_floor.astype(object))
+    state_rows = list(zip(states['elevator_id'].tolist(), states['floor'].tolist(), _STATE_NAMES[states['state']].tolist(),
+                          states['passenger_count'].tolist(), states['timestamp'].tolist(), previous_floor.tolist()))
+    return demand_rows, state_rows, len(records) - len(demand_rows) - len(state_rows)
+
+
+def _decode_struct(payload: bytes, load_bounds: Callable):
+    records = list(RECORD_STRUCT.iter_unpack(payload))
+    bounds = load_bounds({record[0] for record in records})
+    demand_rows, state_rows = [], []
+    for elevator_id, kind, state, floor, previous_floor, passenger_count, timestamp in records:
+        elevator = bounds.get(elevator_id)
+        if elevator is None or not elevator['min_floor'] <= floor <= elevator['max_floor']:
+            continue
+        if not MIN_MS <= timestamp <= MAX_MS:
+            continue
+        if kind == DEMAND:
+            day_of_week = (timestamp // DAY_MS + EPOCH_WEEKDAY) % 7
+            hour_of_day = timestamp // HOUR_MS % 24
+            demand_rows.append((elevator_id, floor, timestamp, day_of_week, hour_of_day, PEAK_HOURS[day_of_week * 24 + hour_of_day]))
+        elif kind == STATE and state < len(VALID_STATES):
+            state_rows.append((elevator_id, floor, VALID_STATES[state], passenger_count, timestamp,
+                               None if previous_floor == NO_FLOOR else previous_floor))
+    return demand_rows, state_rows, len(records) - len(demand_rows) - len(state_rows)
+
+
+#'tcp://host:port' or 'unix:///path/to.sock'
+def parse_address(address: str) -> Tuple[str, tuple]:
+    if address.startswith('unix://'):
+        return 'unix', (address[len('unix://'):],)
+    if address.startswith('tcp://'):
+        host, _, port = address[len('tcp://'):].rpartition(':')
+        if host and port.isdigit():
+            return 'tcp', (host.strip('[]'), int(port))
+    raise ValueError(f"Invalid gateway address: {address} (tcp://host:port or unix:///path)")
+
+
+#Sockets live on an asyncio loop, frames are decoded and stored on a single writer thread (SQLite has
+#one writer anyway), so frames from every connection are committed one after the other
+class GatewayListener:
+    def __init__(self, service, addresses: List[str] = None):
+        self.service = service
+        self.addresses = [parse_address(address) for address in (addresses or [DEFAULT_ADDRESS])]
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='gateway-writer')
+        self._servers = []
+        self._connections = set()  #stream writers of the open connections, closed on stop
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stats = {'connections': 0, 'open_connections': 0, 'frames': 0, 'accepted': 0, 'rejected': 0,
+                       'failed': 0, 'protocol_errors': 0}
+
+    #Decodes, validates and stores one frame, returns (accepted, rejected)
+    def store_frame(self, payload: bytes) -> Tuple[int, int]:
+        demand_rows, state_rows, rejected = decode_frame(payload, self.service.registry.bounds)
+        #all or nothing per database, so a frame that fails is never half stored
+        accepted = self.service.record_event_rows(state_rows, demand_rows)
+        rejected += len(demand_rows) + len(state_rows) - accepted
+        self._count(frames=1, accepted=accepted, rejected=rejected)
+        return accepted, rejected
+
+    def _count(self, **increments):
+        with self._lock:
+            for key, value in increments.items():
+                self._stats[key] += value
+
+    async def _handle(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        self._connections.add(writer)
+        self._count(connections=1, open_connections=1)
+        try:
+            while True:
+                try:
+                    header = await reader.readexactly(FRAME_HEADER.size)
+                except asyncio.IncompleteReadError:
+                    break  #closed between frames
+                (length,) = FRAME_HEADER.unpack(header)
+                if length % RECORD_SIZE or length > MAX_FRAME_BYTES:
+                    logger.warning("gateway: bad frame length %d, closing connection", length)
+                    self._count(protocol_errors=1)
+                    break
+                payload = await reader.readexactly(length)
+                try:
+                    accepted, rejected = await loop.run_in_executor(self._writer, self.store_frame, payload)
+                except Exception:
+                    logger.exception("gateway: storing a frame of %d records failed", length // RECORD_SIZE)
+                    self._count(failed=length // RECORD_SIZE)
+                    accepted, rejected = 0, length // RECORD_SIZE
+                writer.write(ACK_STRUCT.pack(accepted, rejected))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass  #gateway went away mid frame, that frame was never acknowledged
+        finally:
+            self._connections.discard(writer)
+            self._count(open_connections=-1)
+            writer.close()
+
+    async def _start_servers(self):
+        for kind, args in self.addresses:
+            if kind == 'unix':
+                if os.path.exists(args[0]):
+                    os.unlink(args[0])  #left over from a previous run
+                server = await asyncio.start_unix_server(self._handle, args[0])
+            else:
+                server = await asyncio.start_server(self._handle, *args, reuse_address=True, backlog=1024)
+            self._servers.append(server)
+
+    #Bound addresses, port 0 becomes the port the OS picked
+    @property
+    def sockets(self) -> List:
+        return [sock.getsockname() for server in self._servers for sock in server.sockets]
+
+    #Runs the listener on its own thread, returns once the sockets are bound
+    def start(self):
+        if self._thread is None:
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(self._start_servers())
+            self._thread = threading.Thread(target=self._loop.run_forever, name='gateway-listener', daemon=True)
+            self._thread.start()
+        return self
+
+    #wait_closed() also waits for the open connections on newer Pythons, they are closed first
+    async def _close_servers(self):
+        for server in self._servers:
+            server.close()
+        for writer in list(self._connections):
+            writer.close()
+        for server in self._servers:
+            await server.wait_closed()
+        self._servers = []
+
+    #Stops accepting, waits for the frames already handed to the writer
+    def stop(self, timeout: float = None):
+        if self._thread is not None:
+            asyncio.run_coroutine_threadsafe(self._close_servers(), self._loop).result(timeout)
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout)
+            self._loop.close()
+            self._thread = None
+        self._writer.shutdown(wait=True)
+
+    def serve_forever(self):
+        self.start()
+        try:
+            self._thread.join()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def metrics(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+        stats['addresses'] = [f'{kind}://{":".join(str(part) for part in args)}' for kind, args in self.addresses]
+        stats['running'] = self._thread is not None and self._thread.is_alive()
+        return stats
+
+
+def main(argv=None):
+    from app.elevator_api import open_service
+    parser = argparse.ArgumentParser(description='Binary ingestion listener for elevator gateways')
+    parser.add_argument('--db', help='SQLite file, default: the API database (ELEVATOR_SHARD_DIR is honored)')
+    parser.add_argument('--listen', action='append', help=f'tcp://host:port or unix:///path, repeatable, default {DEFAULT_ADDRESS}')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    service = open_service(args.db)
+    listener = GatewayListener(service, args.listen)
+    try:
+        listener.start()
+        logger.info("gateway listening on %s", ', '.join(listener.metrics()['addresses']))
+        listener.serve_forever()
+    finally:
+        service.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,219 @@
+import heapq
+import threading
+from array import array
+from datetime import datetime
+from typing import Dict, List
+
+from app import timestamps
+from app.timestamps import HOUR_MS
+
+#Recent events per elevator, in memory, for the reads that only look at the last few hours: current
+#floor and state, the last N demands and states, demand by floor over the last hour.
+#Every elevator gets two ring buffers (demands, states) made of array.array columns, allocated once
+#with the capacity its byte budget allows, so a busy elevator costs the same memory as an idle one and
+#the oldest events are overwritten first. Fed after every commit, warmed from the database when the
+#service opens. Like the predictor it only sees this process's writes, bulk imports show up after a restart.
+#Reads over a window say whether the rings still hold all of it ('complete')
+
+DEFAULT_WINDOW_HOURS = 6.0
+DEFAULT_BUDGET_BYTES = 64 * 1024
+NO_FLOOR = -2 ** 31  #previous_floor not known
+
+DEMAND_COLUMNS = (('demand_id', 'q'), ('timestamp', 'q'), ('requested_floor', 'i'), ('is_peak_hour', 'b'))
+STATE_COLUMNS = (('state_id', 'q'), ('timestamp', 'q'), ('floor', 'i'), ('previous_floor', 'i'),
+                 ('passenger_count', 'i'), ('state', 'b'))
+
+
+def record_size(columns) -> int:
+    return sum(array(code).itemsize for _, code in columns)
+
+
+class Ring:
+    def __init__(self, columns, capacity: int):
+        self.columns = [array(code, [0]) * capacity for _, code in columns]
+        self.capacity = capacity
+        self.size = 0
+        self.next = 0  #slot the next event goes to
+        self.dropped_until = None  #newest timestamp that was overwritten (or not loaded)
+
+    def append(self, values: tuple):
+        slot = self.next
+        if self.size == self.capacity:
+            evicted = self.columns[1][slot]
+            if self.dropped_until is None or evicted > self.dropped_until:
+                self.dropped_until = evicted
+        else:
+            self.size += 1
+        for column, value in zip(self.columns, values):
+            column[slot] = value
+        self.next = (slot + 1) % self.capacity
+
+    #Events with timestamp >= since, as tuples in column order, newest arrival first
+    def rows(self, since: int = None) -> List[tuple]:
+        rows = []
+        for i in range(self.size):
+            slot = (self.next - 1 - i) % self.capacity
+            if since is None or self.columns[1][slot] >= since:
+                rows.append(tuple(column[slot] for column in self.columns))
+        return rows
+
+    def covers(self, since: int) -> bool:
+        return self.dropped_until is None or self.dropped_until < since
+
+
+class HotStore:
+    def __init__(self, states: tuple, window_hours: float = DEFAULT_WINDOW_HOURS,
+                 budget_bytes: int = DEFAULT_BUDGET_BYTES):
+        self.states = list(states)  #state codes are indexes in here
+        self._codes = {state: code for code, state in enumerate(self.states)}
+        self.window_ms = int(window_hours * HOUR_MS)
+        self.budget_bytes = budget_bytes
+        #half of the budget each, at least one event
+        self.demand_capacity = max(1, budget_bytes // 2 // record_size(DEMAND_COLUMNS))
+        self.state_capacity = max(1, budget_bytes // 2 // record_size(STATE_COLUMNS))
+        self._demands = {}  #elevator_id -> Ring
+        self._states = {}  #elevator_id -> Ring
+        self._current = {}  #elevator_id -> latest state row, kept even when it is older than the window
+        self._lock = threading.Lock()
+
+    def _ring(self, rings: Dict, columns, capacity: int, elevator_id: int) -> Ring:
+        ring = rings.get(elevator_id)
+        if ring is None:
+            ring = rings[elevator_id] = Ring(columns, capacity)
+        return ring
+
+    def _since(self, now_ms: int = None) -> int:
+        return (now_ms if now_ms is not None else timestamps.to_ms(datetime.now())) - self.window_ms
+
+    #Committed events as _after_commit gets them (API results, ISO timestamps). Events older than the
+    #window (history, backfills) only move the current state
+    def add(self, kind: str, items: List[Dict], now_ms: int = None):
+        since = self._since(now_ms)
+        with self._lock:
+            for item in items:
+                when = timestamps.to_ms(item['timestamp'])
+                elevator_id = item['elevator_id']
+                if kind == 'demand':
+                    if when >= since:
+                        self._ring(self._demands, DEMAND_COLUMNS, self.demand_capacity, elevator_id).append(
+                            (item['demand_id'], when, item['requested_floor'], bool(item['is_peak_hour'])))
+                    continue
+                previous_floor = item.get('previous_floor')
+                row = (item['state_id'], when, item['floor'], NO_FLOOR if previous_floor is None else previous_floor,
+                       item.get('passenger_count') or 0, self._codes[item['state']])
+                if when >= since:
+                    self._ring(self._states, STATE_COLUMNS, self.state_capacity, elevator_id).append(row)
+                current = self._current.get(elevator_id)
+                if current is None or (when, row[0]) >= (current[1], current[0]):
+                    self._current[elevator_id] = row
+
+    #Last window of events per elevator through the (elevator_id, time) indexes, newest capacity rows
+    #of each. Returns the number of events loaded
+    def warm(self, conn, now_ms: int = None) -> int:
+        since = self._since(now_ms)
+        cursor = conn.cursor()
+        elevator_ids = [row[0] for row in cursor.execute("SELECT id FROM elevators").fetchall()]
+        loaded = 0
+        demands, states, current = {}, {}, {}
+        for elevator_id in elevator_ids:
+            rows = cursor.execute("""
+                SELECT id, request_time, requested_floor, is_peak_hour FROM demand_events
+                WHERE elevator_id = ? AND request_time >= ? ORDER BY request_time DESC, id DESC LIMIT ?
+            """, (elevator_id, since, self.demand_capacity)).fetchall()
+            if rows:
+                demands[elevator_id] = self._load(DEMAND_COLUMNS, self.demand_capacity,
+                                                  [(row[0], row[1], row[2], bool(row[3])) for row in rows])
+            state_rows = cursor.execute("""
+                SELECT id, timestamp, floor, previous_floor, passenger_count, state FROM elevator_states
+                WHERE elevator_id = ? AND timestamp >= ? ORDER BY timestamp DESC, id DESC LIMIT ?
+            """, (elevator_id, since, self.state_capacity)).fetchall()
+            if not state_rows:
+                #resting for longer than the window, the latest state is still the current one
+                state_rows = cursor.execute("""
+                    SELECT id, timestamp, floor, previous_floor, passenger_count, state FROM elevator_states
+                    WHERE elevator_id = ? ORDER BY timestamp DESC, id DESC LIMIT 1
+                """, (elevator_id,)).fetchall()
+            state_rows = [(row[0], row[1], row[2], NO_FLOOR if row[3] is None else row[3], row[4] or 0,
+                           self._codes[row[5]]) for row in state_rows if row[5] in self._codes]
+            if state_rows:
+                current[elevator_id] = state_rows[0]
+                in_window = [row for row in state_rows if row[1] >= since]
+                if in_window:
+                    states[elevator_id] = self._load(STATE_COLUMNS, self.state_capacity, in_window)
+            loaded += len(rows) + len(state_rows)
+        with self._lock:
+            self._demands, self._states, self._current = demands, states, current
+        return loaded
+
+    #rows newest first; a full ring may have left older events of the window in the database
+    @staticmethod
+    def _load(columns, capacity: int, rows: List[tuple]) -> Ring:
+        ring = Ring(columns, capacity)
+        for row in reversed(rows):
+            ring.append(row)
+        if len(rows) == capacity:
+            ring.dropped_until = rows[-1][1]
+        return ring
+
+    def _state_dict(self, elevator_id: int, row: tuple) -> Dict:
+        state_id, when, floor, previous_floor, passenger_count, state = row
+        return {'state_id': state_id, 'elevator_id': elevator_id, 'floor': floor, 'state': self.states[state],
+                'passenger_count': passenger_count, 'previous_floor': None if previous_floor == NO_FLOOR else previous_floor,
+                'timestamp': timestamps.to_iso(when)}
+
+    @staticmethod
+    def _demand_dict(elevator_id: int, row: tuple) -> Dict:
+        demand_id, when, requested_floor, is_peak = row
+        return {'demand_id': demand_id, 'elevator_id': elevator_id, 'requested_floor': requested_floor,
+                'is_peak_hour': bool(is_peak), 'timestamp': timestamps.to_iso(when)}
+
+    #Latest state and the last `limit` demands and states (by event time, newest first)
+    def current(self, elevator_id: int, limit: int = 10) -> Dict:
+        if limit < 0:
+            raise ValueError("limit must not be negative")
+        with self._lock:
+            current = self._current.get(elevator_id)
+            demand_ring = self._demands.get(elevator_id)
+            state_ring = self._states.get(elevator_id)
+            demands = demand_ring.rows() if demand_ring else []
+            states = state_ring.rows() if state_ring else []
+        latest = lambda rows: heapq.nlargest(limit, rows, key=lambda row: (row[1], row[0]))
+        return {'elevator_id': elevator_id,
+            'current_state': self._state_dict(elevator_id, current) if current else None,
+            'recent_demands': [self._demand_dict(elevator_id, row) for row in latest(demands)],
+            'recent_states': [self._state_dict(elevator_id, row) for row in latest(states)]}
+
+    #Same shape as get_demand_analytics, over the last `hours` from the rings only
+    def demand_analytics(self, elevator_id: int, hours: float, now_ms: int = None) -> Dict:
+        if not 0 < hours * HOUR_MS <= self.window_ms:
+            raise ValueError(f"hours must be above 0 and at most {self.window_ms / HOUR_MS:g}")
+        since = self._since(now_ms) + self.window_ms - int(hours * HOUR_MS)
+        with self._lock:
+            ring = self._demands.get(elevator_id)
+            rows = ring.rows(since) if ring else []
+            complete = ring.covers(since) if ring else True
+        floors, peaks = {}, {}
+        for _, when, requested_floor, is_peak in rows:
+            floors[requested_floor] = floors.get(requested_floor, 0) + 1
+            peak = peaks.setdefault(int(is_peak), [0, 0])
+            peak[0] += when // HOUR_MS % 24
+            peak[1] += 1
+        return {'elevator_id': elevator_id,
+            'analysis_period_hours': hours,
+            'source': 'memory',
+            'complete': complete,
+            'floor_popularity': [{'requested_floor': floor, 'demand_count': count}
+                                 for floor, count in sorted(floors.items(), key=lambda item: (-item[1], item[0]))],
+            'peak_hour_analysis': [{'is_peak_hour': is_peak, 'avg_hour': hour_sum / count, 'total_demands': count}
+                                   for is_peak, (hour_sum, count) in sorted(peaks.items())]}
+
+    def metrics(self) -> Dict:
+        with self._lock:
+            elevators = set(self._demands) | set(self._states)
+            demands = sum(ring.size for ring in self._demands.values())
+            states = sum(ring.size for ring in self._states.values())
+            allocated = (len(self._demands) * self.demand_capacity * record_size(DEMAND_COLUMNS)
+                         + len(self._states) * self.state_capacity * record_size(STATE_COLUMNS))
+        return {'window_hours': self.window_ms / HOUR_MS, 'budget_bytes_per_elevator': self.budget_bytes,
+                'demand_capacity': self.demand_capacity, 'state_capacity': self.state_capacity,
+                'elevators': len(elevators), 'demands': demands, 'states': states, 'allocated_bytes': allocated}
@@ -0,0 +1,358 @@
+#Bulk import of historical controller logs (CSV or NDJSON, optionally .gz) straight into the SQLite file.
+#   python -m app.importer --db elevator_data.db logs/2019-*.csv logs/demands.ndjson
+#Files are read in line chunks, parsed and validated in a process pool (same time features as
+#ElevatorDataService, via rules.time_features) and written in file order by this process only, in large
+#transactions with relaxed pragmas. The ind_* indexes on the raw tables are dropped for the load and built
+#once at the end, derived tables (training data, rollups, sketches) are rebuilt once too.
+#Progress is committed with the rows, an interrupted import picks up where it stopped when run again.
+#Meant for a database the API isn't writing to at the same time
+import argparse
+import csv
+import gzip
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Dict, List
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app import rules, timestamps  # noqa: E402
+from app.db import DEFAULT_PRAGMAS  # noqa: E402
+from app.elevator_api import VALID_STATES, ElevatorDataService  # noqa: E402
+
+#synchronous OFF: a crashed load is resumed, not recovered. Big page cache for the index builds
+IMPORT_PRAGMAS = dict(DEFAULT_PRAGMAS, synchronous='OFF', cache_size=-400000, wal_autocheckpoint=100000)
+RAW_TABLES = ('demand_events', 'elevator_states')
+MAX_ERROR_SAMPLES = 20
+
+IMPORT_SCHEMA = """
+--one row per imported file, offset is the byte position after the last committed line
+CREATE TABLE IF NOT EXISTS import_progress (
+    source TEXT PRIMARY KEY,
+    size INTEGER NOT NULL, --file size when last committed, a finished file that grew is resumed
+    offset INTEGER NOT NULL,
+    rows INTEGER NOT NULL,
+    rejected INTEGER NOT NULL,
+    finished BOOLEAN NOT NULL DEFAULT 0,
+    updated_at INTEGER NOT NULL
+);
+
+--indexes dropped for a load that hasn't finished, built again at its end
+CREATE TABLE IF NOT EXISTS import_dropped_indexes (
+    name TEXT PRIMARY KEY,
+    sql TEXT NOT NULL
+);
+"""
+
+#Set in each worker by _init_worker: elevator_id -> (min_floor, max_floor)
+_bounds = {}
+
+
+def _init_worker(bounds: Dict):
+    global _bounds
+    _bounds = bounds
+
+
+#CSV gives strings, NDJSON may give either
+def _int(record: Dict, field: str, required: bool = True, alias: str = None):
+    value = record.get(field)
+    if value in (None, '') and alias:
+        value = record.get(alias)
+    if value in (None, ''):
+        if required:
+            raise ValueError(f"{field} is required")
+        return None
+    if isinstance(value, bool):
+        raise ValueError(f"{field} must be an integer")
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{field} must be an integer") from None
+
+
+#ISO-8601 text or epoch milliseconds, returns (wall clock datetime, epoch ms)
+def _time(record: Dict, field: str, alias: str = None):
+    value = record.get(field) or (record.get(alias) if alias else None)
+    if value in (None, ''):
+        raise ValueError(f"{field} is required")
+    if isinstance(value, int) or (isinstance(value, str) and value.isdigit()):
+        value = int(value)
+        if not timestamps.in_range(value):
+            raise ValueError(f"{field} out of range: {value}")
+        return timestamps.from_ms(value), value
+    when = timestamps.wall_clock(datetime.fromisoformat(value))
+    return when, timestamps.to_ms(when)
+
+
+def _check_floor(elevator_id: int, floor: int):
+    bounds = _bounds.get(elevator_id)
+    if bounds is None:
+        raise ValueError(f"Elevator {elevator_id} not found")
+    if floor < bounds[0] or floor > bounds[1]:
+        raise ValueError(f"Floor {floor} out of bounds for elevator {elevator_id}")
+
+
+#(elevator_id, requested_floor, request_time ms, day_of_week, hour_of_day, is_peak)
+def parse_demand(record: Dict) -> tuple:
+    elevator_id = _int(record, 'elevator_id')
+    requested_floor = _int(record, 'requested_floor', alias='floor')
+    when, request_ms = _time(record, 'request_time', alias='timestamp')
+    _check_floor(elevator_id, requested_floor)
+    return (elevator_id, requested_floor, request_ms) + rules.time_features(when)
+
+
+#(elevator_id, floor, state, passenger_count, timestamp ms, previous_floor)
+def parse_state(record: Dict) -> tuple:
+    elevator_id = _int(record, 'elevator_id')
+    floor = _int(record, 'floor')
+    state = record.get('state')
+    if state not in VALID_STATES:
+        raise ValueError(f"Invalid state: {state}")
+    _, timestamp_ms = _time(record, 'timestamp')
+    _check_floor(elevator_id, floor)
+    return (elevator_id, floor, state, _int(record, 'passenger_count', required=False) or 0,
+            timestamp_ms, _int(record, 'previous_floor', required=False))
+
+
+#Runs in the pool. task is (source, kind, csv header or None, offset after the chunk, raw lines).
+#kind None means every record says what it is in its 'type' field
+def parse_chunk(task) -> Dict:
+    source, kind, header, end, lines = task
+    demands, states, errors = [], [], []
+    text = [line.decode('utf-8') for line in lines]
+    records = csv.DictReader(text, fieldnames=header) if header else (line for line in text if line.strip())
+    for record in records:
+        try:
+            if not header:
+                record = json.loads(record)
+                if not isinstance(record, dict):
+                    raise ValueError("record must be an object")
+            record_kind = kind or record.get('type')
+            if record_kind == 'demand':
+                demands.append(parse_demand(record))
+            elif record_kind == 'state':
+                states.append(parse_state(record))
+            else:
+                raise ValueError(f"Unknown record type: {record_kind}")
+        except (ValueError, TypeError) as e:
+            errors.append(str(e) if len(errors) < MAX_ERROR_SAMPLES else None)
+    return {'source': source, 'end': end, 'demands': demands, 'states': states,
+            'rejected': len(errors), 'errors': [error for error in errors if error]}
+
+
+def _open(path: str):
+    return gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+
+
+#Chunks of one file from `offset` on. CSV files start with their header row
+def read_chunks(path: str, kind: str, offset: int = 0, chunk_rows: int = 50000):
+    is_csv = path.removesuffix('.gz').endswith('.csv')
+    with _open(path) as handle:
+        header = None
+        if is_csv:
+            header = next(csv.reader([handle.readline().decode('utf-8')]), None)
+            if not header:
+                return
+            offset = max(offset, handle.tell())
+        handle.seek(offset)
+        while True:
+            lines = []
+            for line in handle:
+                lines.append(line)
+                if len(lines) >= chunk_rows:
+                    break
+            if not lines:
+                return
+            yield (path, kind, header, handle.tell(), lines)
+
+
+class BulkImporter:
+    def __init__(self, db_path: str, workers: int = None, chunk_rows: int = 50000, commit_rows: int = 500000,
+                 progress_interval: float = 5.0, out=sys.stderr):
+        self.service = ElevatorDataService(db_path, pragmas=IMPORT_PRAGMAS)
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_rows = chunk_rows
+        self.commit_rows = commit_rows
+        self.progress_interval = progress_interval
+        self.out = out
+        self.conn = self.service.get_connection()
+        self.conn.executescript(IMPORT_SCHEMA)
+        self.stats = {'files': 0, 'skipped_files': 0, 'demands': 0, 'states': 0, 'rejected': 0, 'errors': []}
+        self._uncommitted = 0
+        self._positions = {}  #source -> [offset, rows, rejected] not committed yet
+        self._started = None
+        self._last_report = 0.0
+
+    def _load_bounds(self) -> Dict:
+        return {row['id']: (row['min_floor'], row['max_floor'])
+                for row in self.conn.execute("SELECT id, min_floor, max_floor FROM elevators")}
+
+    def _progress(self, source: str):
+        return self.conn.execute("SELECT size, offset, rows, rejected, finished FROM import_progress WHERE source = ?",
+                                 (source,)).fetchone()
+
+    #Index definitions are saved before dropping, a crashed load still gets them back on the next run
+    def drop_indexes(self) -> List[str]:
+        placeholders = ','.join('?' * len(RAW_TABLES))
+        rows = self.conn.execute(f"""
+            SELECT name, sql FROM sqlite_master
+            WHERE type = 'index' AND name LIKE 'ind_%' AND sql IS NOT NULL AND tbl_name IN ({placeholders})
+        """, RAW_TABLES).fetchall()
+        self.conn.execute("BEGIN IMMEDIATE")
+        for name, sql in rows:
+            self.conn.execute("INSERT OR REPLACE INTO import_dropped_indexes (name, sql) VALUES (?, ?)", (name, sql))
+            self.conn.execute(f"DROP INDEX {name}")
+        self.conn.commit()
+        return [row[0] for row in rows]
+
+    def rebuild_indexes(self) -> List[str]:
+        rows = self.conn.execute("SELECT name, sql FROM import_dropped_indexes").fetchall()
+        self.conn.execute("BEGIN IMMEDIATE")
+        for name, sql in rows:
+            self.conn.execute(sql.replace('CREATE INDEX', 'CREATE INDEX IF NOT EXISTS', 1))
+        self.conn.execute("DELETE FROM import_dropped_indexes")
+        self.conn.commit()
+        return [row[0] for row in rows]
+
+    def _tasks(self, paths: List[str], kind: str, restart: bool):
+        for path in paths:
+            source = os.path.abspath(path)
+            progress = None if restart else self._progress(source)
+            if progress is not None and progress['finished'] and os.path.getsize(source) == progress['size']:
+                self.stats['skipped_files'] += 1
+                continue
+            offset = progress['offset'] if progress is not None else 0
+            #rows/rejected so far, the counts of the resumed file keep adding up
+            self._positions[source] = [offset, progress['rows'] if progress else 0, progress['rejected'] if progress else 0]
+            self.stats['files'] += 1
+            yield from read_chunks(source, kind, offset, self.chunk_rows)
+            yield source  #end of file marker, handled in order like the chunks
+
+    def _write(self, result: Dict):
+        if not self.conn.in_transaction:
+            self.conn.execute("BEGIN IMMEDIATE")
+        self.conn.executemany("""
+            INSERT INTO demand_events (elevator_id, requested_floor, request_time, day_of_week, hour_of_day, is_peak_hour)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, result['demands'])
+        self.conn.executemany("""
+            INSERT INTO elevator_states (elevator_id, floor, state, passenger_count, timestamp, previous_floor)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, result['states'])
+        accepted = len(result['demands']) + len(result['states'])
+        position = self._positions[result['source']]
+        position[0] = result['end']
+        position[1] += accepted
+        position[2] += result['rejected']
+        self.stats['demands'] += len(result['demands'])
+        self.stats['states'] += len(result['states'])
+        self.stats['rejected'] += result['rejected']
+        room = MAX_ERROR_SAMPLES - len(self.stats['errors'])
+        if room > 0:
+            self.stats['errors'].extend(f"{os.path.basename(result['source'])}: {error}" for error in result['errors'][:room])
+        self._uncommitted += accepted + result['rejected']
+        if self._uncommitted >= self.commit_rows:
+            self._commit()
+        self._report()
+
+    #Rows and their file offsets go in the same transaction
+    def _commit(self, finished_source: str = None):
+        if not self.conn.in_transaction:
+            self.conn.execute("BEGIN IMMEDIATE")
+        now = timestamps.to_ms(datetime.now())
+        for source, (offset, rows, rejected) in self._positions.items():
+            self.conn.execute("""
+                INSERT INTO import_progress (source, size, offset, rows, rejected, finished, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (source) DO UPDATE SET size = excluded.size, offset = excluded.offset, rows = excluded.rows,
+                rejected = excluded.rejected, finished = excluded.finished, updated_at = excluded.updated_at
+            """, (source, os.path.getsize(source), offset, rows, rejected, source == finished_source, now))
+        self.conn.commit()
+        if finished_source is not None:
+            del self._positions[finished_source]
+        self._uncommitted = 0
+
+    def _report(self, force: bool = False):
+        now = time.perf_counter()
+        if self.out is None or not (force or now - self._last_report >= self.progress_interval):
+            return
+        self._last_report = now
+        rows = self.stats['demands'] + self.stats['states']
+        elapsed = now - self._started
+        self.out.write(f"{rows:,} rows  {rows / elapsed if elapsed else 0:,.0f} rows/s  "
+                       f"{self.stats['rejected']:,} rejected  {elapsed:.1f}s\n")
+        self.out.flush()
+
+    def run(self, paths: List[str], kind: str = None, restart: bool = False, rebuild: bool = True) -> Dict:
+        self._started = time.perf_counter()
+        if restart:
+            self.conn.execute("DELETE FROM import_progress")
+            self.conn.commit()
+        self.drop_indexes()
+        bounds = self._load_bounds()
+        pending = deque()
+        with ProcessPoolExecutor(self.workers, initializer=_init_worker, initargs=(bounds,)) as pool:
+            #a few chunks in flight per worker, reading never runs far ahead of the writer
+            for task in self._tasks(paths, kind, restart):
+                pending.append(pool.submit(parse_chunk, task) if isinstance(task, tuple) else task)
+                while len(pending) > self.workers * 2 or (pending and isinstance(pending[0], str)):
+                    self._drain(pending.popleft())
+            while pending:
+                self._drain(pending.popleft())
+        self._report(force=True)
+        load_seconds = time.perf_counter() - self._started
+
+        started = time.perf_counter()
+        self.stats['indexes'] = self.rebuild_indexes()
+        self.stats['index_seconds'] = round(time.perf_counter() - started, 3)
+        if rebuild:
+            started = time.perf_counter()
+            self.stats['training_samples'] = self.service.rebuild_ml_training_data()
+            self.stats['rollup_rows'] = self.service.rebuild_demand_rollups()
+            self.stats['sketches'] = self.service.rebuild_sketches()
+            self.stats['rebuild_seconds'] = round(time.perf_counter() - started, 3)
+        rows = self.stats['demands'] + self.stats['states']
+        self.stats['load_seconds'] = round(load_seconds, 3)
+        self.stats['rows_per_second'] = round(rows / load_seconds) if load_seconds else 0
+        return self.stats
+
+    def _drain(self, item):
+        if isinstance(item, str):
+            self._commit(finished_source=item)
+        else:
+            self._write(item.result())
+
+    def close(self):
+        if self.conn.in_transaction:
+            self.conn.rollback()
+        self.service.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Bulk import historical elevator logs')
+    parser.add_argument('paths', nargs='+', help='.csv or .ndjson/.jsonl files, optionally .gz')
+    parser.add_argument('--db', default='elevator_data.db', help='SQLite file to load into')
+    parser.add_argument('--kind', choices=('demand', 'state'), help="every record's type, default: its 'type' field")
+    parser.add_argument('--workers', type=int, help='parser processes, default: CPU count')
+    parser.add_argument('--chunk-rows', type=int, default=50000)
+    parser.add_argument('--commit-rows', type=int, default=500000)
+    parser.add_argument('--restart', action='store_true', help='forget earlier progress and import everything again')
+    parser.add_argument('--no-rebuild', action='store_true', help='skip rebuilding ml_training_data, rollups and sketches')
+    args = parser.parse_args(argv)
+
+    importer = BulkImporter(args.db, args.workers, args.chunk_rows, args.commit_rows)
+    try:
+        result = importer.run(args.paths, args.kind, args.restart, rebuild=not args.no_rebuild)
+    except KeyboardInterrupt:
+        importer.close()
+        print("Interrupted, run the same command again to resume", file=sys.stderr)
+        return 130
+    importer.close()
+    print(json.dumps(result, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,234 @@
+import itertools
+import logging
+import sqlite3
+import threading
+import time
+from collections import deque
+from typing import Dict, List
+
+from app import metrics, timestamps
+
+logger = logging.getLogger(__name__)
+
+SYNCHRONOUS_LEVELS = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+STOP_TIMEOUT = 30.0  #seconds stop() waits for the writer, so shutdown can't hang on a locked database
+
+#Queued events were already acknowledged (202), every one that never reaches the database is counted
+events_lost = metrics.REGISTRY.register(metrics.Counter(
+    'elevator_ingest_events_lost_total', 'Acknowledged events that were never written, by kind and reason (rejected, error, locked)',
+    ('kind', 'reason')))
+flush_retries = metrics.REGISTRY.register(metrics.Counter(
+    'elevator_ingest_flush_retries_total', 'Flushes retried because the database was locked or busy', ('kind',)))
+
+
+#Lock contention with another writer (importer, compactor, gateway, another worker): worth retrying
+def is_transient(error: Exception) -> bool:
+    return isinstance(error, sqlite3.OperationalError) and ('locked' in str(error) or 'busy' in str(error))
+
+
+class QueueFullError(Exception):
+    """Queue is at capacity, the client should retry later (HTTP 429)"""
+
+
+class QueueClosedError(Exception):
+    """Queue is shutting down or the writer died (HTTP 503)"""
+
+
+#Write-behind ingestion: events are validated and acknowledged right away, a single
+#writer thread group commits them through the service batch methods
+class IngestQueue:
+    def __init__(self, service, max_size: int = 10000, batch_size: int = 500, flush_interval: float = 0.05,
+                 synchronous: str = 'NORMAL', retries: int = 5, retry_delay: float = 0.05, shutdown_requeues: int = 3):
+        synchronous = synchronous.upper()
+        if synchronous not in SYNCHRONOUS_LEVELS:
+            raise ValueError(f"Invalid synchronous level: {synchronous}")
+        self.service = service
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.synchronous = synchronous
+        self.retries = retries  #per flush, on a locked database, waiting retry_delay * 2 ** attempt in between
+        self.retry_delay = retry_delay
+        self.shutdown_requeues = shutdown_requeues  #flushes still requeued on a locked database once stopping
+        self._requeues_since_close = 0
+
+        self._items = deque()  #(provisional_id, kind, event, enqueued_at)
+        self._cond = threading.Condition()
+        self._ids = itertools.count(1)
+        self._closed = False
+        self._thread = None
+        self._stats = {'enqueued': 0, 'written': 0, 'rejected_full': 0, 'dropped': 0, 'lost': 0, 'retries': 0, 'requeued': 0,
+                       'flushes': 0, 'flush_seconds_total': 0.0, 'flush_seconds_max': 0.0,
+                       'last_flush_seconds': 0.0, 'max_event_age_seconds': 0.0, 'committed_through': 0}
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='ingest-writer', daemon=True)
+            self._thread.start()
+        return self
+
+    #Validates synchronously so clients still get per item errors, then queues the valid
+    #events. Results mirror the service batch methods with provisional ids instead of row ids
+    def submit_demands(self, events: List[Dict]) -> Dict:
+        results, queued = [], []
+        bounds = self.service.load_elevator_bounds(events)
+        for index, event in enumerate(events):
+            try:
+                elevator_id, floor, request_time, _, _, is_peak = self.service.prepare_demand_event(event, bounds)
+            except (ValueError, TypeError) as e:
+                results.append({'index': index, 'error': str(e)})
+                continue
+            queued.append({'elevator_id': elevator_id, 'requested_floor': floor, 'request_time': request_time})
+            results.append({'index': index, 'elevator_id': elevator_id, 'requested_floor': floor,
+                            'is_peak_hour': is_peak, 'timestamp': timestamps.to_iso(timestamps.to_ms(request_time))})
+        return self._submit('demand', results, queued)
+
+    def submit_states(self, events: List[Dict]) -> Dict:
+        bounds = self.service.load_elevator_bounds(events)
+        results, queued = [], []
+        for index, event in enumerate(events):
+            try:
+                elevator_id, floor, state, passenger_count, timestamp, previous_floor = self.service.prepare_state_event(event, bounds)
+            except (ValueError, TypeError) as e:
+                results.append({'index': index, 'error': str(e)})
+                continue
+            queued.append({'elevator_id': elevator_id, 'floor': floor, 'state': state, 'passenger_count': passenger_count,
+                           'timestamp': timestamp, 'previous_floor': previous_floor})
+            results.append({'index': index, 'elevator_id': elevator_id, 'floor': floor, 'state': state,
+                            'timestamp': timestamps.to_iso(timestamps.to_ms(timestamp))})
+        return self._submit('state', results, queued)
+
+    def _submit(self, kind: str, results: List[Dict], queued: List[Dict]) -> Dict:
+        ids = iter(self._enqueue(kind, queued) if queued else [])
+        for result in results:
+            if 'error' not in result:
+                result['provisional_id'] = next(ids)
+                result['status'] = 'queued'
+        return {'accepted': len(queued), 'rejected': len(results) - len(queued), 'results': results}
+
+    #All or nothing, a batch is never half queued
+    def _enqueue(self, kind: str, events: List[Dict]) -> List[int]:
+        with self._cond:
+            if self._closed or self._thread is None or not self._thread.is_alive():
+                raise QueueClosedError("ingest queue is not accepting events")
+            if len(self._items) + len(events) > self.max_size:
+                self._stats['rejected_full'] += len(events)
+                raise QueueFullError(f"ingest queue full ({len(self._items)}/{self.max_size})")
+            now = time.monotonic()
+            ids = [next(self._ids) for _ in events]
+            self._items.extend((pid, kind, event, now) for pid, event in zip(ids, events))
+            self._stats['enqueued'] += len(events)
+            self._cond.notify()
+            return ids
+
+    #Flushes on batch_size or when the oldest event is flush_interval old, whatever comes first
+    def _run(self):
+        self.service.get_connection().execute(f"PRAGMA synchronous={self.synchronous}")
+        while True:
+            with self._cond:
+                while not self._items and not self._closed:
+                    self._cond.wait()
+                if self._items and not self._closed:
+                    deadline = self._items[0][3] + self.flush_interval
+                    while len(self._items) < self.batch_size and not self._closed:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+                batch = [self._items.popleft() for _ in range(min(self.batch_size, len(self._items)))]
+                if not batch and self._closed:
+                    return
+            self._flush(batch)
+
+    #A batch write rolls back as a whole, so a locked database is retried with backoff
+    def _write(self, kind: str, events: List[Dict]) -> Dict:
+        write = self.service.record_demands_batch if kind == 'demand' else self.service.record_elevator_states_batch
+        for attempt in itertools.count():
+            try:
+                return write(events)
+            except Exception as e:
+                if not is_transient(e) or attempt >= self.retries:
+                    raise
+            with self._cond:
+                self._stats['retries'] += 1
+            if metrics.ENABLED:
+                flush_retries.inc(1, kind)
+            time.sleep(self.retry_delay * 2 ** attempt)
+
+    def _flush(self, batch: List[tuple]):
+        started = time.monotonic()
+        written = dropped = lost = 0
+        requeue = []
+        #consecutive runs of the same kind keep arrival order between demands and states
+        runs = [(kind, list(run)) for kind, run in itertools.groupby(batch, key=lambda item: item[1])]
+        for position, (kind, run) in enumerate(runs):
+            events = [item[2] for item in run]
+            try:
+                result = self._write(kind, events)
+            except Exception as e:
+                if is_transient(e) and not self._give_up():
+                    #still locked after every retry: this run and the ones after it go back to the
+                    #front of the queue, in order, and are written by a later flush
+                    requeue = [item for _, rest in runs[position:] for item in rest]
+                    logger.warning("ingest flush: database still locked after %d retries, %d events requeued",
+                                   self.retries, len(requeue))
+                    break
+                logger.exception("ingest flush failed, %d %s events lost", len(events), kind)
+                lost += len(events)
+                if metrics.ENABLED:
+                    events_lost.inc(len(events), kind, 'locked' if is_transient(e) else 'error')
+                continue
+            written += result['accepted']
+            #rows that passed validation at submit time but not at write time (elevator removed)
+            dropped += result['rejected']
+            if metrics.ENABLED and result['rejected']:
+                events_lost.inc(result['rejected'], kind, 'rejected')
+        elapsed = time.monotonic() - started
+        with self._cond:
+            if requeue:
+                self._items.extendleft(reversed(requeue))
+            stats = self._stats
+            stats['written'] += written
+            stats['dropped'] += dropped + lost
+            stats['lost'] += lost
+            stats['requeued'] += len(requeue)
+            stats['flushes'] += 1
+            stats['last_flush_seconds'] = elapsed
+            stats['flush_seconds_total'] += elapsed
+            stats['flush_seconds_max'] = max(stats['flush_seconds_max'], elapsed)
+            stats['max_event_age_seconds'] = max(stats['max_event_age_seconds'], time.monotonic() - batch[0][3])
+            if len(requeue) < len(batch):
+                stats['committed_through'] = batch[len(batch) - len(requeue) - 1][0]
+
+    #Once stop() was called a locked database gets shutdown_requeues more tries, then the events left
+    #are counted as lost instead of requeued again
+    def _give_up(self) -> bool:
+        with self._cond:
+            if not self._closed:
+                return False
+            self._requeues_since_close += 1
+            return self._requeues_since_close > self.shutdown_requeues
+
+    @property
+    def depth(self) -> int:
+        return len(self._items)
+
+    def metrics(self) -> Dict:
+        with self._cond:
+            stats = dict(self._stats)
+        stats['queue_depth'] = len(self._items)
+        stats['queue_capacity'] = self.max_size
+        stats['avg_flush_seconds'] = stats['flush_seconds_total'] / stats['flushes'] if stats['flushes'] else 0.0
+        stats['synchronous'] = self.synchronous
+        stats['running'] = self._thread is not None and self._thread.is_alive()
+        return stats
+
+    #Stops accepting events and waits (up to timeout seconds) until everything queued is committed
+    def stop(self, timeout: float = STOP_TIMEOUT):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                logger.error("ingest queue: writer still busy after %.0fs, %d queued events not written", timeout, len(self._items))
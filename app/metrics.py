@@ -0,0 +1,241 @@
+import functools
+import os
+import re
+import sqlite3
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, List, Tuple
+
+#Prometheus text format metrics without extra dependencies.
+#ELEVATOR_METRICS=off turns every hook into a flag check
+ENABLED = os.environ.get('ELEVATOR_METRICS', 'on').lower() not in ('off', '0', 'false')
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def set_enabled(enabled: bool):
+    global ENABLED
+    ENABLED = enabled
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names: Tuple[str, ...], values: Tuple, extra: str = '') -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.name, self.help, self.label_names = name, help_text, labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, *labels):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = dict(self._values)
+        return [f'{self.name}{_labels(self.label_names, key)} {value}' for key, value in sorted(values.items())]
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name, self.help, self.label_names = name, help_text, labels
+        self.buckets = tuple(buckets)
+        self._values = {}  #labels -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            data = self._values.get(labels)
+            if data is None:
+                data = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            data[index] += 1
+            data[-1] += value
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = {key: list(data) for key, data in self._values.items()}
+        lines = []
+        for key, data in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), data[:-1]):
+                cumulative += count
+                le = 'le="%s"' % bound
+                lines.append(f'{self.name}_bucket{_labels(self.label_names, key, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.label_names, key)} {data[-1]}')
+            lines.append(f'{self.name}_count{_labels(self.label_names, key)} {cumulative}')
+        return lines
+
+
+#Value read at scrape time, callback returns {label tuple: value}
+class Gauge:
+    kind = 'gauge'
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = (), callback: Callable[[], Dict] = None):
+        self.name, self.help, self.label_names = name, help_text, labels
+        self.callback = callback
+
+    def samples(self) -> List[str]:
+        try:
+            values = self.callback() if self.callback else {}
+        except Exception:  #a broken gauge must not break the scrape
+            return []
+        return [f'{self.name}{_labels(self.label_names, key)} {value}' for key, value in sorted(values.items())]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def get(self, name: str):
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            samples = metric.samples()
+            if not samples:
+                continue
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(samples)
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+http_requests = REGISTRY.register(Counter(
+    'elevator_http_requests_total', 'HTTP requests by route, method and status', ('route', 'method', 'status')))
+http_latency = REGISTRY.register(Histogram(
+    'elevator_http_request_duration_seconds', 'HTTP request latency by route', ('route', 'method')))
+service_latency = REGISTRY.register(Histogram(
+    'elevator_service_call_duration_seconds', 'ElevatorDataService method latency', ('method',)))
+service_errors = REGISTRY.register(Counter(
+    'elevator_service_errors_total', 'ElevatorDataService calls that raised', ('method',)))
+sql_latency = REGISTRY.register(Histogram(
+    'elevator_sql_duration_seconds', 'SQL statement latency by statement kind and table', ('statement',)))
+sql_rows = REGISTRY.register(Counter(
+    'elevator_sql_rows_fetched_total', 'Rows fetched by statement kind and table', ('statement',)))
+connection_wait = REGISTRY.register(Histogram(
+    'elevator_db_connection_wait_seconds', 'Time to get a pooled connection (includes opening new ones)'))
+
+
+#Reports DB, WAL and SHM file sizes at scrape time, db_path is a callable so it follows the live service
+def register_db_size_gauge(db_path: Callable[[], str]):
+    def sizes():
+        result = {}
+        base = db_path()
+        for suffix, name in (('', 'db'), ('-wal', 'wal'), ('-shm', 'shm')):
+            path = base + suffix
+            if os.path.exists(path):
+                result[(name,)] = os.path.getsize(path)
+        return result
+    REGISTRY.register(Gauge('elevator_db_file_bytes', 'Database file sizes', ('file',), sizes))
+
+
+#Times a service method and counts failures, a flag check when metrics are off
+def timed(method):
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        if not ENABLED:
+            return method(*args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        except Exception:
+            service_errors.inc(1, name)
+            raise
+        finally:
+            service_latency.observe(time.perf_counter() - started, name)
+    return wrapper
+
+
+_STATEMENT_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE|TABLE|INDEX\s+\w+\s+ON)\s+(\w+)', re.IGNORECASE)
+_statement_labels = {}
+
+
+#"INSERT demand_events", "SELECT ml_training_data"... keeps label cardinality low
+def statement_label(sql: str) -> str:
+    label = _statement_labels.get(sql)
+    if label is None:
+        words = sql.split(None, 1)
+        verb = words[0].upper() if words else 'UNKNOWN'
+        match = _STATEMENT_TABLE.search(sql)
+        label = f'{verb} {match.group(1)}' if match else verb
+        if len(_statement_labels) < 2000:
+            _statement_labels[sql] = label
+    return label
+
+
+#Cursor that times every statement and counts the rows fetched from it, whether through
+#fetchone/fetchmany/fetchall or by iterating the cursor
+class InstrumentedCursor(sqlite3.Cursor):
+    _label = None
+
+    def execute(self, sql, parameters=()):
+        self._label = statement_label(sql)
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            sql_latency.observe(time.perf_counter() - started, self._label)
+
+    def executemany(self, sql, seq_of_parameters):
+        self._label = statement_label(sql)
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            sql_latency.observe(time.perf_counter() - started, self._label)
+
+    def __next__(self):
+        row = super().__next__()
+        if self._label:
+            sql_rows.inc(1, self._label)
+        return row
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None and self._label:
+            sql_rows.inc(1, self._label)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        if self._label:
+            sql_rows.inc(len(rows), self._label)
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        if self._label:
+            sql_rows.inc(len(rows), self._label)
+        return rows
+
+
+def register_gauge(name: str, help_text: str, labels: Tuple[str, ...], callback: Callable[[], Dict]):
+    return REGISTRY.register(Gauge(name, help_text, labels, callback))
+
+
+def render() -> str:
+    return REGISTRY.render()
@@ -0,0 +1,203 @@
+from datetime import datetime
+from typing import Dict, Iterable
+
+from app import timestamps
+from app.columnar import np, require_numpy
+
+#Offline resting floor analysis. History for one elevator is loaded into arrays once, then
+#every candidate floor is scored against every time bucket with a histogram and one matmul:
+#expected[b, f] = sum_g counts[b, g] * |g - f| / calls[b]
+
+BUCKETINGS = {
+    'hour_of_week': 7 * 24,  #day_of_week * 24 + hour_of_day
+    'hour': 24,
+    'peak': 2,
+}
+
+
+def _bucket_index(bucketing: str, day_of_week, hour_of_day, is_peak):
+    if bucketing == 'hour_of_week':
+        return day_of_week.astype(np.int64) * 24 + hour_of_day
+    if bucketing == 'hour':
+        return hour_of_day.astype(np.int64)
+    if bucketing == 'peak':
+        return is_peak.astype(np.int64)
+    raise ValueError(f"Unknown bucketing: {bucketing}")
+
+
+def bucket_label(bucketing: str, index: int) -> Dict:
+    if bucketing == 'hour_of_week':
+        return {'day_of_week': index // 24, 'hour_of_day': index % 24}
+    if bucketing == 'hour':
+        return {'hour_of_day': index}
+    return {'is_peak_hour': bool(index)}
+
+
+#Demands and resting states of one elevator in [start, end) as arrays, plus the last
+#resting state before start so the first calls of the window have a resting floor
+def load_history(conn, elevator_id: int, start: datetime, end: datetime) -> Dict:
+    require_numpy()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT request_time, requested_floor, day_of_week, hour_of_day, is_peak_hour FROM demand_events
+        WHERE elevator_id = ? AND request_time >= ? AND request_time < ?
+        ORDER BY request_time, id
+    """, (elevator_id, timestamps.to_ms(start), timestamps.to_ms(end)))
+    demands = cursor.fetchall()
+    cursor.execute("""
+        SELECT timestamp, floor FROM (
+            SELECT timestamp, floor FROM resting_states
+            WHERE elevator_id = ? AND timestamp < ?
+            ORDER BY timestamp DESC LIMIT 1)
+        UNION ALL
+        SELECT timestamp, floor FROM resting_states
+        WHERE elevator_id = ? AND timestamp >= ? AND timestamp < ?
+        ORDER BY timestamp
+    """, (elevator_id, timestamps.to_ms(start), elevator_id, timestamps.to_ms(start), timestamps.to_ms(end)))
+    rests = cursor.fetchall()
+    columns = list(zip(*demands)) if demands else [(), (), (), (), ()]
+    rest_columns = list(zip(*rests)) if rests else [(), ()]
+    return {
+        'demand_time': np.array(columns[0], dtype='datetime64[ms]'),
+        'demand_floor': np.array(columns[1], dtype=np.int32),
+        'day_of_week': np.array(columns[2], dtype=np.int8),
+        'hour_of_day': np.array(columns[3], dtype=np.int8),
+        'is_peak': np.array(columns[4], dtype=bool),
+        'rest_time': np.array(rest_columns[0], dtype='datetime64[ms]'),
+        'rest_floor': np.array(rest_columns[1], dtype=np.int32),
+    }
+
+
+#Floor the elevator was resting on when each call came in, -1 when it wasn't idle.
+#Like ml_training_data, only the first call after a rest counts as an idle call
+def _actual_resting_floor(history: Dict):
+    rest_index = np.searchsorted(history['rest_time'], history['demand_time'], side='left') - 1
+    first_after_rest = np.ones(len(rest_index), dtype=bool)
+    first_after_rest[1:] = rest_index[1:] != rest_index[:-1]
+    idle = (rest_index >= 0) & first_after_rest
+    floors = np.full(len(rest_index), -1, dtype=np.int64)
+    floors[idle] = history['rest_floor'][rest_index[idle]]
+    return floors, idle
+
+
+def optimize(history: Dict, min_floor: int, max_floor: int, bucketing: str = 'hour_of_week',
+             seconds_per_floor: float = 1.5, idle_only: bool = True) -> Dict:
+    require_numpy()
+    n_buckets = BUCKETINGS.get(bucketing)
+    if n_buckets is None:
+        raise ValueError(f"Unknown bucketing: {bucketing}")
+    floors = np.arange(min_floor, max_floor + 1)
+    n_floors = len(floors)
+
+    actual_floor, idle = _actual_resting_floor(history)
+    demand_floor = history['demand_floor'].astype(np.int64)
+    buckets = _bucket_index(bucketing, history['day_of_week'], history['hour_of_day'], history['is_peak'])
+    #calls outside the elevator's floors can't be served, drop them instead of failing
+    keep = (demand_floor >= min_floor) & (demand_floor <= max_floor)
+    if idle_only:
+        keep &= idle
+    demand_floor, buckets, actual_floor, idle = demand_floor[keep], buckets[keep], actual_floor[keep], idle[keep]
+
+    #calls per (bucket, requested floor) in one bincount
+    counts = np.bincount(buckets * n_floors + (demand_floor - min_floor),
+                         minlength=n_buckets * n_floors).reshape(n_buckets, n_floors).astype(np.float64)
+    calls = counts.sum(axis=1)
+    distance = np.abs(floors[:, None] - floors[None, :]).astype(np.float64)
+    travel = counts @ distance  #travel[b, f]: total floors travelled if resting on f during bucket b
+    #same over idle calls only, the calls actual_travel covers, so savings compare like with like
+    idle_counts = np.bincount(buckets[idle] * n_floors + (demand_floor[idle] - min_floor),
+                              minlength=n_buckets * n_floors).reshape(n_buckets, n_floors).astype(np.float64)
+    idle_travel = idle_counts @ distance
+    with np.errstate(invalid='ignore', divide='ignore'):
+        expected = np.where(calls[:, None] > 0, travel / calls[:, None], np.nan)
+
+    best_index = np.argmin(np.where(calls[:, None] > 0, travel, np.inf), axis=1)
+    best_travel = travel[np.arange(n_buckets), best_index]
+    best_idle_travel = idle_travel[np.arange(n_buckets), best_index]
+
+    #what actually happened, for idle calls only (busy calls have no resting floor)
+    actual_distance = np.where(idle, np.abs(demand_floor - actual_floor), 0)
+    actual_travel = np.bincount(buckets, weights=actual_distance, minlength=n_buckets)
+    actual_calls = np.bincount(buckets, weights=idle.astype(np.float64), minlength=n_buckets)
+
+    return {
+        'bucketing': bucketing,
+        'floors': floors,
+        'calls': calls,
+        'travel': travel,
+        'expected_distance': expected,
+        'expected_wait_seconds': expected * seconds_per_floor,
+        'best_floor': np.where(calls > 0, floors[best_index], -1),
+        'best_travel': np.where(calls > 0, best_travel, 0.0),
+        'idle_travel': idle_travel,
+        'best_idle_travel': np.where(calls > 0, best_idle_travel, 0.0),
+        'actual_calls': actual_calls,
+        'actual_travel': actual_travel,
+        'seconds_per_floor': seconds_per_floor,
+    }
+
+
+#Travel if the elevator had rested on `floor` during the given buckets, vs what happened.
+#Savings only cover idle calls, busy calls have no actual resting floor to compare against
+def what_if(result: Dict, floor: int, bucket_indexes: Iterable[int]) -> Dict:
+    bucket_indexes = np.asarray(list(bucket_indexes), dtype=np.int64)
+    column = int(floor - result['floors'][0])
+    if column < 0 or column >= len(result['floors']):
+        raise ValueError(f"Floor {floor} out of bounds")
+    selected = bucket_indexes[result['calls'][bucket_indexes] > 0]
+    policy_travel = float(result['travel'][selected, column].sum())
+    idle_policy_travel = float(result['idle_travel'][selected, column].sum())
+    actual_travel = float(result['actual_travel'][selected].sum())
+    return {'floor': floor,
+            'calls': float(result['calls'][selected].sum()),
+            'policy_travel': policy_travel,
+            'idle_calls': float(result['actual_calls'][selected].sum()),
+            'idle_policy_travel': idle_policy_travel,
+            'actual_travel': actual_travel,
+            'saved_travel': actual_travel - idle_policy_travel,
+            'saved_wait_seconds': (actual_travel - idle_policy_travel) * result['seconds_per_floor']}
+
+
+#Buckets matching a description, e.g. weekday mornings: days_of_week=range(5), hours=[7, 8]
+def bucket_indexes_for(bucketing: str, days_of_week: Iterable[int] = None, hours: Iterable[int] = None,
+                       peak: bool = None):
+    days = set(days_of_week) if days_of_week is not None else None
+    hours = set(hours) if hours is not None else None
+    indexes = []
+    for index in range(BUCKETINGS[bucketing]):
+        label = bucket_label(bucketing, index)
+        if days is not None and 'day_of_week' in label and label['day_of_week'] not in days:
+            continue
+        if hours is not None and 'hour_of_day' in label and label['hour_of_day'] not in hours:
+            continue
+        if peak is not None and 'is_peak_hour' in label and label['is_peak_hour'] != peak:
+            continue
+        indexes.append(index)
+    return indexes
+
+
+#JSON friendly view: one row per bucket that had calls, plus totals
+def summarize(result: Dict) -> Dict:
+    rows = []
+    for index in np.flatnonzero(result['calls'] > 0):
+        index = int(index)
+        actual_calls = result['actual_calls'][index]
+        rows.append(dict(bucket_label(result['bucketing'], index),
+            bucket=index,
+            calls=int(result['calls'][index]),
+            best_floor=int(result['best_floor'][index]),
+            best_expected_distance=float(result['best_travel'][index] / result['calls'][index]),
+            best_expected_wait_seconds=float(result['best_travel'][index] / result['calls'][index] * result['seconds_per_floor']),
+            actual_expected_distance=float(result['actual_travel'][index] / actual_calls) if actual_calls else None,
+            expected_distance_by_floor=[round(float(value), 4) for value in result['expected_distance'][index]]))
+    best = float(result['best_travel'].sum())
+    best_idle = float(result['best_idle_travel'].sum())
+    actual = float(result['actual_travel'].sum())
+    return {'bucketing': result['bucketing'],
+        'floors': [int(floor) for floor in result['floors']],
+        'seconds_per_floor': result['seconds_per_floor'],
+        'buckets': rows,
+        'policy': {str(row['bucket']): row['best_floor'] for row in rows},
+        'totals': {'calls': int(result['calls'].sum()), 'best_travel': best, 'actual_travel': actual,
+                   'idle_calls': int(result['actual_calls'].sum()), 'best_idle_travel': best_idle,
+                   'saved_travel': actual - best_idle}}
@@ -0,0 +1,132 @@
+import math
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+from app import timestamps
+
+#Online next-floor demand model. Per elevator it keeps decayed demand counts per floor at
+#three levels: (day_of_week, hour_of_day), peak / off peak, and overall. Every demand is
+#O(1) and recommendations never touch the database.
+#Decay is lazy: new observations are weighted by exp((t - ref) / tau), which keeps old
+#weights comparable without rescaling them on every update.
+
+MAX_EXPONENT = 700.0  #exp() overflows a float just above 709
+MAX_FUTURE_SKEW = timedelta(hours=1)  #demands further ahead of the clock than this are not learned from
+
+
+class DemandPredictor:
+    def __init__(self, half_life_days: float = 14.0, min_weight: float = 3.0, warm_days: int = 90):
+        self.tau = half_life_days * 86400 / math.log(2)
+        self.min_weight = min_weight  #decayed demands needed before a bucket is trusted
+        self.warm_days = warm_days  #history older than this has decayed to almost nothing
+        self._ref = None
+        self._tables = {}
+        self._lock = threading.Lock()
+        self.skipped_future = 0  #observations ignored for being ahead of the clock
+
+    def _growth(self, when: datetime) -> float:
+        seconds = when.timestamp()
+        if self._ref is None:
+            self._ref = seconds
+        exponent = (seconds - self._ref) / self.tau
+        #keep exp() far from overflowing, rebasing is O(tables) but happens every few years of data
+        if exponent > 500:
+            self._rebase(seconds)
+            exponent = 0.0
+        return math.exp(exponent)
+
+    def _rebase(self, seconds: float):
+        factor = math.exp(-(seconds - self._ref) / self.tau)
+        for table in self._tables.values():
+            table['weights'] = {floor: weight * factor for floor, weight in table['weights'].items()}
+            table['total'] *= factor
+        self._ref = seconds
+
+    #total / exp(exponent) in log space: a far future `when` decays to 0, a far past one gives a large
+    #finite weight, neither raises OverflowError
+    @staticmethod
+    def _decayed(total: float, exponent: float) -> float:
+        return math.exp(min(math.log(total) - exponent, MAX_EXPONENT))
+
+    @staticmethod
+    def _keys(elevator_id: int, day_of_week: int, hour_of_day: int, is_peak: bool):
+        return ((elevator_id, 'hour', day_of_week, hour_of_day),
+                (elevator_id, 'peak', bool(is_peak)),
+                (elevator_id, 'all'))
+
+    #O(1): three dictionary updates, the cached recommendation of each bucket is dropped.
+    #A demand far in the future (a mistyped year) would rebase the model onto it and decay every
+    #real weight to nothing, so it is skipped
+    def observe(self, elevator_id: int, floor: int, when: datetime, day_of_week: int, hour_of_day: int,
+                is_peak: bool, count: int = 1):
+        if when > datetime.now() + MAX_FUTURE_SKEW:
+            with self._lock:
+                self.skipped_future += 1
+            return
+        with self._lock:
+            weight = count * self._growth(when)
+            for key in self._keys(elevator_id, day_of_week, hour_of_day, is_peak):
+                table = self._tables.get(key)
+                if table is None:
+                    table = self._tables[key] = {'weights': {}, 'total': 0.0, 'best': None}
+                table['weights'][floor] = table['weights'].get(floor, 0.0) + weight
+                table['total'] += weight
+                table['best'] = None
+
+    #Warm start from the hourly rollups (already aggregated demand_events), last warm_days only
+    def warm(self, conn, now: datetime = None) -> int:
+        since = (now or datetime.now()) - timedelta(days=self.warm_days)
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT elevator_id, hour_bucket, requested_floor, day_of_week, hour_of_day, is_peak_hour, demand_count
+            FROM demand_hourly_rollups WHERE hour_bucket >= ?
+            ORDER BY hour_bucket
+        """, (timestamps.to_ms(since),))
+        rows = 0
+        for row in cursor:
+            self.observe(row['elevator_id'], row['requested_floor'], timestamps.from_ms(row['hour_bucket']),
+                         row['day_of_week'], row['hour_of_day'], row['is_peak_hour'], row['demand_count'])
+            rows += 1
+        return rows
+
+    #Weighted median minimizes expected |floor - resting floor|, cached until the bucket changes
+    @staticmethod
+    def _best(table: Dict):
+        if table['best'] is None:
+            weights = table['weights']
+            total = table['total']
+            running = 0.0
+            median = None
+            for floor in sorted(weights):
+                running += weights[floor]
+                if running >= total / 2:
+                    median = floor
+                    break
+            expected = sum(weight * abs(floor - median) for floor, weight in weights.items()) / total
+            table['best'] = (median, expected)
+        return table['best']
+
+    def recommend(self, elevator_id: int, when: datetime, day_of_week: int, hour_of_day: int, is_peak: bool) -> Optional[Dict]:
+        with self._lock:
+            if self._ref is None:
+                return None
+            exponent = (when.timestamp() - self._ref) / self.tau
+            #most specific bucket with enough recent demand, else the most general one that has any
+            fallback = None
+            for key in self._keys(elevator_id, day_of_week, hour_of_day, is_peak):
+                table = self._tables.get(key)
+                if table is None or table['total'] <= 0:
+                    continue
+                effective = self._decayed(table['total'], exponent)
+                fallback = (key, table, effective)
+                if effective >= self.min_weight:
+                    break
+            if fallback is None:
+                return None
+            key, table, effective = fallback
+            floor, expected = self._best(table)
+            return {'recommended_floor': floor,
+                    'expected_distance': expected,
+                    'source': key[1],
+                    'effective_demands': effective}
@@ -0,0 +1,155 @@
+import threading
+import time
+from typing import Dict, Iterable
+
+from app.db import DEFAULT_PRAGMAS, ConnectionPool
+
+#In-process copy of the elevators table (floor bounds, capacity, building), so the ingest paths
+#validate without a query. Loaded when the service opens, kept current by the service's own CRUD
+#methods. Changes made by other processes are picked up through registry_version, read at most
+#every `recheck` seconds, and an elevator that isn't cached is looked up once before it is rejected.
+#Ids that turned out not to exist are remembered until the version changes, so requests for a
+#nonexistent elevator don't each cost a query.
+#Lookups use their own connections: they happen inside the ingest write transactions, and closing a
+#pooled connection of the service would roll those back
+
+DEFAULT_RECHECK = 5.0
+
+#Set on the database file by the service already. Re-setting them needs a lock, which a lookup made
+#inside the same thread's write transaction can never get
+FILE_PRAGMAS = ('auto_vacuum', 'journal_mode')
+
+#Every building / elevator change bumps the version in the same transaction
+REGISTRY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS registry_version (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    version INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO registry_version (id, version) VALUES (1, 0);
+
+CREATE INDEX IF NOT EXISTS ind_elevators_building ON elevators(building_id);
+"""
+
+#Bound on remembered missing ids, the set starts over when a scan of random ids fills it
+MAX_MISSING = 10000
+
+ELEVATOR_COLUMNS = ('id', 'building_id', 'name', 'max_capacity', 'min_floor', 'max_floor')
+
+
+def check_bounds(elevator: Dict, elevator_id: int, floor: int):
+    if not elevator:
+        raise ValueError(f"Elevator {elevator_id} not found")
+    if floor < elevator['min_floor'] or floor > elevator['max_floor']:
+        raise ValueError(f"Floor {floor} out of bounds for elevator {elevator_id}")
+
+
+#Bumps registry_version inside the caller's write transaction, returns the new version
+def bump_version(cursor) -> int:
+    cursor.execute("UPDATE registry_version SET version = version + 1 WHERE id = 1")
+    cursor.execute("SELECT version FROM registry_version WHERE id = 1")
+    return cursor.fetchone()[0]
+
+
+class ElevatorRegistry:
+    def __init__(self, db_path: str, pragmas: Dict = None, recheck: float = DEFAULT_RECHECK):
+        pragmas = DEFAULT_PRAGMAS if pragmas is None else pragmas
+        self.pool = ConnectionPool(db_path, {name: value for name, value in pragmas.items() if name not in FILE_PRAGMAS})
+        self.recheck = recheck
+        self._elevators = {}  #elevator_id -> dict of ELEVATOR_COLUMNS
+        self._missing = set()  #ids looked up and not found at _version
+        self._version = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def load(self):
+        conn = self.pool.get()
+        try:
+            #one read transaction, the version matches the rows
+            conn.execute("BEGIN")
+            version = conn.execute("SELECT version FROM registry_version WHERE id = 1").fetchone()[0]
+            rows = conn.execute(f"SELECT {', '.join(ELEVATOR_COLUMNS)} FROM elevators").fetchall()
+            conn.commit()
+        finally:
+            conn.close()
+        with self._lock:
+            self._elevators = {row['id']: dict(row) for row in rows}
+            self._missing = set()
+            self._version = version
+            self._checked = time.monotonic()
+
+    def _refresh(self):
+        if time.monotonic() - self._checked < self.recheck:
+            return
+        conn = self.pool.get()
+        try:
+            version = conn.execute("SELECT version FROM registry_version WHERE id = 1").fetchone()[0]
+        finally:
+            conn.close()
+        if version != self._version:
+            self.load()
+        else:
+            self._checked = time.monotonic()
+
+    def _lookup(self, elevator_ids: Iterable[int]) -> Dict[int, Dict]:
+        elevator_ids = [elevator_id for elevator_id in elevator_ids if elevator_id not in self._missing]
+        if not elevator_ids:
+            return {}
+        version = self._version
+        conn = self.pool.get()
+        try:
+            placeholders = ','.join('?' * len(elevator_ids))
+            rows = conn.execute(f"SELECT {', '.join(ELEVATOR_COLUMNS)} FROM elevators WHERE id IN ({placeholders})",
+                                elevator_ids).fetchall()
+        finally:
+            conn.close()
+        found = {row['id']: dict(row) for row in rows}
+        with self._lock:
+            self._elevators.update(found)
+            #a put or reload since the query started may have added one of them
+            if version == self._version:
+                if len(self._missing) >= MAX_MISSING:
+                    self._missing.clear()
+                self._missing.update(elevator_id for elevator_id in elevator_ids if elevator_id not in found)
+        return found
+
+    def get(self, elevator_id: int) -> Dict:
+        self._refresh()
+        elevator = self._elevators.get(elevator_id)
+        if elevator is None:
+            elevator = self._lookup([elevator_id]).get(elevator_id)
+        return elevator
+
+    #Config for every id in one pass, the ones not cached in one query
+    def bounds(self, elevator_ids: Iterable[int]) -> Dict[int, Dict]:
+        self._refresh()
+        found, missing = {}, []
+        for elevator_id in set(elevator_ids):
+            elevator = self._elevators.get(elevator_id)
+            if elevator is None:
+                missing.append(elevator_id)
+            else:
+                found[elevator_id] = elevator
+        found.update(self._lookup(missing))
+        return found
+
+    def check_floor(self, elevator_id: int, floor: int) -> Dict:
+        elevator = self.get(elevator_id)
+        check_bounds(elevator, elevator_id, floor)
+        return elevator
+
+    #After this process committed a change: new row (or None when deleted) and the version it bumped to
+    def put(self, elevator_id: int, elevator: Dict, version: int):
+        with self._lock:
+            if elevator is None:
+                self._elevators.pop(elevator_id, None)
+            else:
+                self._elevators[elevator_id] = {column: elevator[column] for column in ELEVATOR_COLUMNS}
+                self._missing.discard(elevator_id)
+            #a version we didn't produce means another process changed something too
+            if self._version is not None and version == self._version + 1:
+                self._version = version
+            else:
+                self._checked = 0.0
+
+    def close(self):
+        self.pool.close_all()
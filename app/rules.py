@@ -0,0 +1,23 @@
+from datetime import datetime
+from typing import Tuple
+
+#Business rules shared by the service and the tools that write data without it (simulator, importers),
+#so every path derives day_of_week, hour_of_day and is_peak_hour the same way
+
+
+#Weekday morning (7-9) and evening (5-7) based on my country's business hours
+def is_peak_hour(hour: int, day_of_week: int) -> bool:
+    if day_of_week in [0, 1, 2, 3, 4]:#Monday [0] to Friday [4]
+
+        return hour in [7, 8, 17, 18]
+    # Weekend lunch
+    elif day_of_week in [0, 6]: #Weekend
+        return hour in [12, 13]#lunch
+    return False
+
+
+#(day_of_week, hour_of_day, is_peak_hour) stored with every demand
+def time_features(when: datetime) -> Tuple[int, int, bool]:
+    day_of_week = when.weekday()
+    hour_of_day = when.hour
+    return day_of_week, hour_of_day, is_peak_hour(hour_of_day, day_of_week)
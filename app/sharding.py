@@ -0,0 +1,418 @@
+import heapq
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, List
+
+from app import columnar, metrics
+from app.db import ConnectionPool
+from app.cache import WriteVersions
+from app.elevator_api import (CATALOG_SCHEMA, CATALOG_VERSION, FEED_CONSUMERS_SCHEMA, REGISTRY_RECHECK_SECONDS,
+                              CatalogMixin, ElevatorDataService, encode_training_cursor)
+from app.registry import REGISTRY_SCHEMA, ElevatorRegistry, bump_version
+
+logger = logging.getLogger(__name__)
+
+#Sharded storage: one SQLite file per building, so buildings don't queue behind a single writer lock.
+#A small catalog DB owns buildings and elevators; each shard keeps a copy of its own elevators rows,
+#so bounds checks and training features never leave the shard. Registry changes go to the catalog
+#first, then to the shard's copy.
+#Single elevator calls go to one shard, fleet wide reads fan out on a thread pool and are merged in
+#(rest_start_time, elevator_id) order. Elevator ids are global, so keyset cursors work across shards
+#   ELEVATOR_SHARD_DIR=/var/lib/elevators flask --app app.elevator_api run
+
+
+class ShardedElevatorDataService(CatalogMixin):
+    def __init__(self, shard_dir: str, pragmas: Dict = None, max_workers: int = None, hub=None):
+        os.makedirs(shard_dir, exist_ok=True)
+        self.shard_dir = shard_dir
+        self.db_path = os.path.join(shard_dir, 'catalog.db')
+        self.pragmas = pragmas
+        self.hub = hub  #every shard publishes its accepted events here
+        self.versions = WriteVersions()  #shared too, fleet wide ETags see writes to any shard
+        self.pool = ConnectionPool(self.db_path, pragmas)
+        conn = self.pool.get()
+        #the catalog is versioned like the shards, nothing is written once it is up to date
+        if conn.execute("PRAGMA user_version").fetchone()[0] < CATALOG_VERSION:
+            conn.executescript(CATALOG_SCHEMA)
+            conn.executescript(FEED_CONSUMERS_SCHEMA)
+            conn.executescript(REGISTRY_SCHEMA)
+            conn.execute(f"PRAGMA user_version = {CATALOG_VERSION}")
+        conn.close()
+        #elevator -> building routing and the bounds for queued events, from memory
+        self.registry = ElevatorRegistry(self.db_path, pragmas, REGISTRY_RECHECK_SECONDS)
+        self.registry.load()
+        self.max_workers = max_workers
+        self._shards = {}  #building_id -> ElevatorDataService
+        self._elevator_buildings = {}  #elevator_id -> building_id
+        self._lock = threading.Lock()
+        self._executor = None
+        #open the shards that already exist, so fleet wide reads see them right away
+        for name in sorted(os.listdir(shard_dir)):
+            if name.startswith('building_') and name.endswith('.db'):
+                self._shard(int(name[len('building_'):-len('.db')]))
+
+    def get_connection(self):
+        return self.pool.get()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+        for shard in list(self._shards.values()):
+            shard.close()
+        self.pool.close_all()
+        self.registry.close()
+
+    def shard_path(self, building_id: int) -> str:
+        return os.path.join(self.shard_dir, f'building_{building_id}.db')
+
+    def _shard(self, building_id: int) -> ElevatorDataService:
+        shard = self._shards.get(building_id)
+        if shard is None:
+            with self._lock:
+                shard = self._shards.get(building_id)
+                if shard is None:
+                    shard = self._shards[building_id] = ElevatorDataService(self.shard_path(building_id), self.pragmas,
+                                                                        self.hub, self.versions)
+        return shard
+
+    #Registry lookup on first use, copies the elevator (and building) rows into its shard
+    def shard_for(self, elevator_id: int) -> ElevatorDataService:
+        building_id = self._elevator_buildings.get(elevator_id)
+        if building_id is None:
+            elevator = self.registry.get(elevator_id)
+            if elevator is None:
+                raise ValueError(f"Elevator {elevator_id} not found")
+            building_id = elevator['building_id']
+            self._copy_to_shard(building_id, elevator)
+            self._elevator_buildings[elevator_id] = building_id
+        return self._shard(building_id)
+
+    def _copy_to_shard(self, building_id: int, elevator: Dict = None):
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, name, total_floors FROM buildings WHERE id = ?", (building_id,))
+        building = cursor.fetchone()
+        conn.close()
+        self._shard(building_id).replicate_registry_rows(building, elevator)
+
+    def add_building(self, building_id: int, name: str, total_floors: int):
+        conn = self.get_connection()
+        conn.execute("INSERT OR REPLACE INTO buildings (id, name, total_floors) VALUES (?, ?, ?)",
+                     (building_id, name, total_floors))
+        conn.commit()
+        conn.close()
+
+    def add_elevator(self, elevator_id: int, building_id: int, name: str, min_floor: int, max_floor: int,
+                     max_capacity: int = 10):
+        elevator = {'id': elevator_id, 'building_id': building_id, 'name': name, 'max_capacity': max_capacity,
+                    'min_floor': min_floor, 'max_floor': max_floor}
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT OR REPLACE INTO elevators (id, building_id, name, max_capacity, min_floor, max_floor)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (elevator_id, building_id, name, max_capacity, min_floor, max_floor))
+        version = bump_version(cursor)
+        conn.commit()
+        conn.close()
+        self.registry.put(elevator_id, elevator, version)
+        self._elevator_buildings.pop(elevator_id, None)
+        self.shard_for(elevator_id)
+
+    #Buildings, elevators, event validation and consumers come from CatalogMixin and run on the catalog
+    #with the same queries as a single database; the shard of the building gets a copy afterwards
+    def update_building(self, building_id: int, fields: Dict) -> Dict:
+        building = super().update_building(building_id, fields)
+        if building is not None and building_id in self._shards:
+            self._copy_to_shard(building_id)
+        return building
+
+    def _save_elevator(self, elevator: Dict, insert: bool) -> Dict:
+        elevator = super()._save_elevator(elevator, insert)
+        self._elevator_buildings.pop(elevator['id'], None)
+        self.shard_for(elevator['id'])
+        return elevator
+
+    #An elevator's history lives in its building's shard, it can't move to another one
+    def update_elevator(self, elevator_id: int, fields: Dict) -> Dict:
+        elevator = self.registry.get(elevator_id)
+        if elevator is not None and fields.get('building_id', elevator['building_id']) != elevator['building_id']:
+            raise ValueError("Elevators can't move to another building in sharded mode")
+        return super().update_elevator(elevator_id, fields)
+
+    #The shard checks for events and drops its copy, then the catalog row goes
+    def delete_elevator(self, elevator_id: int) -> bool:
+        if self.registry.get(elevator_id) is None:
+            return False
+        self.shard_for(elevator_id).delete_elevator(elevator_id)
+        self._elevator_buildings.pop(elevator_id, None)
+        return super().delete_elevator(elevator_id)
+
+    def _elevator_has_events(self, cursor, elevator_id: int) -> bool:
+        return False
+
+    @property
+    def shards(self) -> List[ElevatorDataService]:
+        return list(self._shards.values())
+
+    #Runs fn(shard, *args) on every shard in parallel, results in shard order
+    def _fan_out(self, shards: List[ElevatorDataService], fn, *args, **kwargs) -> List:
+        if len(shards) <= 1:
+            return [fn(shard, *args, **kwargs) for shard in shards]
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers or min(32, (os.cpu_count() or 1) * 4),
+                                                        thread_name_prefix='elevator-shard')
+        futures = [self._executor.submit(fn, shard, *args, **kwargs) for shard in shards]
+        return [future.result() for future in futures]
+
+    #Groups (index, event) by shard, events for unknown elevators become per item errors
+    def _route_events(self, events: List[Dict]):
+        groups, errors = {}, {}
+        for index, event in enumerate(events):
+            try:
+                elevator_id = event.get('elevator_id') if isinstance(event, dict) else None
+                if not isinstance(elevator_id, int) or isinstance(elevator_id, bool):
+                    raise ValueError("elevator_id must be an integer" if elevator_id is not None else "elevator_id is required")
+                shard = self.shard_for(elevator_id)
+            except ValueError as e:
+                errors[index] = {'index': index, 'error': str(e)}
+                continue
+            groups.setdefault(shard, []).append(index)
+        return groups, errors
+
+    #Each shard commits its part on its own writer, in parallel. Results keep the request order
+    def _record_batch(self, events: List[Dict], method: str) -> Dict:
+        groups, errors = self._route_events(events)
+        shards = list(groups)
+        outcomes = self._fan_out(shards, lambda shard: getattr(shard, method)([events[i] for i in groups[shard]]))
+        results = dict(errors)
+        for shard, outcome in zip(shards, outcomes):
+            for index, item in zip(groups[shard], outcome['results']):
+                item['index'] = index
+                results[index] = item
+        ordered = [results[index] for index in range(len(events))]
+        accepted = sum(1 for item in ordered if 'error' not in item)
+        return {'accepted': accepted, 'rejected': len(ordered) - accepted, 'results': ordered}
+
+    @metrics.timed
+    def record_demands_batch(self, events: List[Dict]) -> Dict:
+        return self._record_batch(events, 'record_demands_batch')
+
+    @metrics.timed
+    def record_elevator_states_batch(self, events: List[Dict]) -> Dict:
+        return self._record_batch(events, 'record_elevator_states_batch')
+
+    #Gateway rows are validated already, they only need grouping by shard. Ids come back in row order
+    #Every shard stores its part of the frame in one transaction. A shard that fails is logged and left out
+    #of the count, so the gateway acks what was actually stored; when nothing was stored the error is raised
+    def record_event_rows(self, state_rows: List[tuple], demand_rows: List[tuple]) -> int:
+        groups = {}
+        for kind, rows in enumerate((state_rows, demand_rows)):
+            for row in rows:
+                groups.setdefault(self.shard_for(row[0]), ([], []))[kind].append(row)
+        def store(shard):
+            try:
+                return shard.record_event_rows(*groups[shard]), None
+            except Exception as e:
+                return 0, e
+        outcomes = self._fan_out(list(groups), store)
+        stored = sum(count for count, _ in outcomes)
+        errors = [error for _, error in outcomes if error is not None]
+        if errors and not stored:
+            raise errors[0]
+        for error in errors:
+            logger.error("storing gateway rows in a shard failed: %s", error)
+        return stored
+
+    def record_demand(self, elevator_id: int, requested_floor: int, request_time: datetime = None) -> Dict:
+        return self.shard_for(elevator_id).record_demand(elevator_id, requested_floor, request_time)
+
+    def record_elevator_state(self, elevator_id: int, floor: int, state: str, passenger_count: int = 0,
+                              previous_floor: int = None, timestamp: datetime = None) -> Dict:
+        return self.shard_for(elevator_id).record_elevator_state(elevator_id, floor, state, passenger_count,
+                                                                 previous_floor, timestamp)
+
+    #Training data: one shard when elevator_id is given, otherwise every shard merged by the keyset
+    def _training_shards(self, elevator_id: int = None) -> List[ElevatorDataService]:
+        if elevator_id:
+            try:
+                return [self.shard_for(elevator_id)]
+            except ValueError:
+                return []
+        return self.shards
+
+    @metrics.timed
+    def get_ml_training_data(self, elevator_id: int = None, start_date: datetime = None, end_date: datetime = None,
+                             after: str = None, limit: int = None) -> List[Dict]:
+        return [row for _, row in self._training_page_rows(elevator_id, start_date, end_date, after, limit)]
+
+    #Each shard's page with its keys, merged by the keyset and cut to `limit`
+    def _training_page_rows(self, elevator_id, start_date, end_date, after, limit) -> List[tuple]:
+        pages = self._fan_out(self._training_shards(elevator_id), lambda shard: list(shard.iter_ml_training_data(
+            elevator_id, start_date, end_date, after, limit, keys=True)))
+        merged = heapq.merge(*pages, key=lambda item: item[0])
+        return [item for _, item in zip(range(limit), merged)] if limit else list(merged)
+
+    #Streams stay lazy: one open cursor per shard, merged row by row
+    def iter_ml_training_data(self, elevator_id: int = None, start_date: datetime = None, end_date: datetime = None,
+                              after: str = None, limit: int = None, batch_size: int = 1000, keys: bool = False):
+        streams = [shard.iter_ml_training_data(elevator_id, start_date, end_date, after, limit, batch_size, keys=True)
+                   for shard in self._training_shards(elevator_id)]
+        merged = heapq.merge(*streams, key=lambda item: item[0])
+        try:
+            for count, item in enumerate(merged, 1):
+                yield item if keys else item[1]
+                if limit and count >= limit:
+                    break
+        finally:
+            for stream in streams:
+                stream.close()
+
+    #Same contract as ElevatorDataService.open_training_page, from one fan out: the cursor is the key of the
+    #last merged row, so a page with a limit is merged in memory (at most `limit` rows per shard)
+    @metrics.timed
+    def open_training_page(self, elevator_id: int = None, start_date: datetime = None, end_date: datetime = None,
+                           after: str = None, limit: int = None, batch_size: int = 1000):
+        if not limit:
+            return None, self.iter_ml_training_data(elevator_id, start_date, end_date, after, batch_size=batch_size)
+        page = self._training_page_rows(elevator_id, start_date, end_date, after, limit)
+        next_cursor = encode_training_cursor(*page[-1][0]) if len(page) == limit else None
+        return next_cursor, iter([row for _, row in page])
+
+    @metrics.timed
+    def count_ml_training_data(self, elevator_id: int = None, start_date: datetime = None, end_date: datetime = None,
+                               after: str = None) -> int:
+        return sum(self._fan_out(self._training_shards(elevator_id), lambda shard: shard.count_ml_training_data(
+            elevator_id, start_date, end_date, after)))
+
+    @metrics.timed
+    def get_training_arrays(self, elevator_id: int = None, start_date: datetime = None, end_date: datetime = None,
+                            chunk_size: int = 10000) -> Dict:
+        columnar.require_numpy()
+        np = columnar.np
+        parts = self._fan_out(self._training_shards(elevator_id), lambda shard: shard.get_training_arrays(
+            elevator_id, start_date, end_date, chunk_size))
+        if not parts:
+            return columnar.build_arrays(list(columnar.TRAINING_DTYPES), [], 0)
+        arrays = {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+        order = np.lexsort((arrays['elevator_id'], arrays['rest_start_time']))
+        return {name: array[order] for name, array in arrays.items()}
+
+    #Change feed watermarks carry one position per shard: '1:120,2:88' (building_id:seq).
+    #Shards missing from it start at 0, '0' alone is the beginning of every shard
+    def parse_watermark(self, value) -> Dict[int, int]:
+        if str(value) == '0':
+            return {}
+        positions = {}
+        try:
+            for part in str(value).split(','):
+                building_id, seq = part.split(':')
+                positions[int(building_id)] = int(seq)
+        except (ValueError, TypeError) as e:
+            raise ValueError(f"Invalid watermark: {value}") from e
+        if any(seq < 0 for seq in positions.values()):
+            raise ValueError(f"Invalid watermark: {value}")
+        return positions
+
+    #Every shard reads from its own position, pages are interleaved row by row so one busy building
+    #doesn't hold the others back. Positions only move past rows that made it into the page
+    @metrics.timed
+    def get_training_changes(self, since: str = '0', limit: int = 1000, elevator_id: int = None) -> Dict:
+        if limit <= 0:
+            raise ValueError("limit must be positive")
+        positions = self.parse_watermark(since)
+        if elevator_id:
+            try:
+                self.shard_for(elevator_id)
+            except ValueError:
+                return {'data': [], 'next_watermark': str(since), 'has_more': False}
+            buildings = [self._elevator_buildings[elevator_id]]
+        else:
+            buildings = sorted(self._shards)
+        starts = {self._shards[building_id]: str(positions.get(building_id, 0)) for building_id in buildings}
+        pages = self._fan_out(list(starts), lambda shard: shard.get_training_changes(starts[shard], limit, elevator_id))
+        #(row number within its shard, shard number, row), so the first `limit` rows take turns
+        interleaved = sorted(((number, index, row) for index, page in enumerate(pages)
+                              for number, row in enumerate(page['data'])), key=lambda item: item[:2])
+        taken = [0] * len(pages)
+        data = []
+        for _, index, row in interleaved[:limit]:
+            taken[index] += 1
+            data.append(row)
+        next_positions = dict(positions)
+        has_more = False
+        for building_id, page, count in zip(buildings, pages, taken):
+            if count == len(page['data']):
+                next_positions[building_id] = int(page['next_watermark'])
+                has_more = has_more or page['has_more']
+            else:
+                next_positions[building_id] = page['data'][count - 1]['seq'] if count else positions.get(building_id, 0)
+                has_more = True
+        watermark = ','.join(f'{building_id}:{seq}' for building_id, seq in sorted(next_positions.items())) or '0'
+        return {'data': data, 'next_watermark': watermark, 'has_more': has_more}
+
+    def get_demand_analytics(self, elevator_id: int, days: int = 7) -> Dict:
+        return self.shard_for(elevator_id).get_demand_analytics(elevator_id, days)
+
+    def get_demand_heatmap(self, elevator_id: int, days: int = 7, day_of_week: int = None) -> Dict:
+        return self.shard_for(elevator_id).get_demand_heatmap(elevator_id, days, day_of_week)
+
+    def get_demand_percentiles(self, elevator_id: int, days: int = 7, quantiles: List[float] = None,
+                               group_by: str = None) -> Dict:
+        return self.shard_for(elevator_id).get_demand_percentiles(elevator_id, days, quantiles, group_by)
+
+    def get_current(self, elevator_id: int, limit: int = 10) -> Dict:
+        if self.registry.get(elevator_id) is None:
+            return None
+        return self.shard_for(elevator_id).get_current(elevator_id, limit)
+
+    def get_recent_demand_analytics(self, elevator_id: int, hours: float = 1) -> Dict:
+        return self.shard_for(elevator_id).get_recent_demand_analytics(elevator_id, hours)
+
+    #Every shard keeps its own hot store, sizes add up
+    def get_hot_metrics(self) -> Dict:
+        parts = [shard.get_hot_metrics() for shard in self.shards]
+        totals = {key: sum(part[key] for part in parts) for key in ('elevators', 'demands', 'states', 'allocated_bytes')}
+        return dict(parts[0] if parts else {}, shards=len(parts), **totals)
+
+    def recommend_resting_floor(self, elevator_id: int, at: datetime = None) -> Dict:
+        return self.shard_for(elevator_id).recommend_resting_floor(elevator_id, at)
+
+    def optimize_resting_floors(self, elevator_id: int, start_date: datetime = None, end_date: datetime = None,
+                                bucketing: str = 'hour_of_week', seconds_per_floor: float = 1.5, what_if: Dict = None) -> Dict:
+        return self.shard_for(elevator_id).optimize_resting_floors(elevator_id, start_date, end_date, bucketing,
+                                                                   seconds_per_floor, what_if)
+
+    @metrics.timed
+    def compare_elevators(self, elevator_ids: List[int], days: int = 7) -> Dict:
+        groups = {}
+        for elevator_id in elevator_ids:
+            groups.setdefault(self.shard_for(elevator_id), []).append(elevator_id)
+        shards = list(groups)
+        results = self._fan_out(shards, lambda shard: shard.compare_elevators(groups[shard], days))
+        by_id = {item['elevator_id']: item for result in results for item in result['elevators']}
+        return {'analysis_period_days': days, 'elevators': [by_id[elevator_id] for elevator_id in elevator_ids]}
+
+    def rebuild_ml_training_data(self) -> int:
+        return sum(self._fan_out(self.shards, lambda shard: shard.rebuild_ml_training_data()))
+
+    def rebuild_demand_rollups(self) -> int:
+        return sum(self._fan_out(self.shards, lambda shard: shard.rebuild_demand_rollups()))
+
+    def rebuild_sketches(self) -> int:
+        return sum(self._fan_out(self.shards, lambda shard: shard.rebuild_sketches()))
+
+    def seed_test_data(self):
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM buildings")
+        seeded = cursor.fetchone()[0] > 0
+        conn.close()
+        if not seeded:
+            self.add_building(1, 'Yambay Tower', 10)
+            self.add_elevator(1, 1, 'Benitez Building', 1, 10)
@@ -0,0 +1,8 @@
+#Synthetic elevator traffic for load tests and ML experiments.
+#   python -m app.simulator --output sim.db --elevators 100 --days 180
+from app.simulator.engine import Simulator
+from app.simulator.profiles import PROFILES, DemandProfile, ElevatorSpec, create_fleet, load_fleet
+from app.simulator.sinks import ListSink, ServiceSink, SQLiteSink, replay
+
+__all__ = ['Simulator', 'PROFILES', 'DemandProfile', 'ElevatorSpec', 'create_fleet', 'load_fleet',
+           'ListSink', 'ServiceSink', 'SQLiteSink', 'replay']
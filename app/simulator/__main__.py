@@ -0,0 +1,43 @@
+#   python -m app.simulator --output sim.db --elevators 500 --days 365 --profile busy
+#Uses the elevators already in --output when it has any, otherwise creates a synthetic fleet
+import argparse
+import json
+import os
+import sys
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from app.simulator import PROFILES, Simulator, SQLiteSink, create_fleet, load_fleet  # noqa: E402
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate synthetic elevator data')
+    parser.add_argument('--output', required=True, help='SQLite file to write (created if missing)')
+    parser.add_argument('--elevators', type=int, default=20, help='fleet size when the file has no elevators')
+    parser.add_argument('--days', type=float, default=30)
+    parser.add_argument('--start', help='ISO date, default: --days before today')
+    parser.add_argument('--profile', choices=sorted(PROFILES), default='office')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--seconds-per-floor', type=float, default=1.5)
+    parser.add_argument('--no-rebuild', action='store_true', help='skip rebuilding ml_training_data, rollups and sketches')
+    args = parser.parse_args(argv)
+
+    if args.start:
+        start = datetime.fromisoformat(args.start)
+    else:
+        start = datetime.combine(datetime.now().date(), datetime.min.time()) - timedelta(days=args.days)
+    end = start + timedelta(days=args.days)
+
+    sink = SQLiteSink(args.output, rebuild=not args.no_rebuild)
+    conn = sink.service.get_connection()
+    fleet = load_fleet(conn) or create_fleet(conn, args.elevators, seed=args.seed)
+    conn.close()
+    simulator = Simulator(fleet, PROFILES[args.profile], seed=args.seed, seconds_per_floor=args.seconds_per_floor)
+    result = simulator.run(start, end, sink)
+    result.update(output=args.output, elevators=len(fleet), start=start.isoformat(), end=end.isoformat())
+    print(json.dumps(result, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,142 @@
+import heapq
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+from app import rules
+from app.columnar import np, require_numpy
+from app.simulator.profiles import DemandProfile, ElevatorSpec
+
+#Discrete event simulation: one heap of timestamped events, a small state machine per car.
+#Arrivals are sampled one simulated hour at a time for the whole fleet (Poisson counts, uniform
+#offsets, origin/destination/passengers in one vectorized draw), so Python only runs per event.
+#Every car goes resting -> moving -> occupied -> resting, the states record_elevator_state accepts
+
+CALL, PICKUP, READY = 0, 1, 2
+
+
+class _Car:
+    __slots__ = ('spec', 'floor', 'busy', 'pending')
+
+    def __init__(self, spec: ElevatorSpec):
+        self.spec = spec
+        self.floor = spec.lobby_floor
+        self.busy = False
+        self.pending = deque()  #calls waiting for the car: (floor, destination, passengers)
+
+
+class Simulator:
+    def __init__(self, fleet: List[ElevatorSpec], profile: DemandProfile = None, seed: int = 0,
+                 seconds_per_floor: float = 1.5, door_seconds: float = 8.0):
+        require_numpy()
+        if not fleet:
+            raise ValueError("Fleet is empty")
+        self.fleet = list(fleet)
+        self.profile = profile or DemandProfile()
+        self.seconds_per_floor = seconds_per_floor
+        self.door_seconds = door_seconds
+        self.rng = np.random.default_rng(seed)
+        self._min = np.array([spec.min_floor for spec in self.fleet], dtype=np.int64)
+        self._max = np.array([spec.max_floor for spec in self.fleet], dtype=np.int64)
+        self._lobby = np.array([spec.lobby_floor for spec in self.fleet], dtype=np.int64)
+        self._capacity = np.array([spec.max_capacity for spec in self.fleet], dtype=np.int64)
+
+    #Calls of one simulated hour for every car, sorted by time: (seconds, car, floor, destination, passengers)
+    def _sample_hour(self, offset: float, hour_start: datetime):
+        day_of_week, hour_of_day, _ = rules.time_features(hour_start)
+        rate = self.profile.rate(day_of_week, hour_of_day)
+        counts = self.rng.poisson(rate, len(self.fleet))
+        total = int(counts.sum())
+        if total == 0:
+            return []
+        cars = np.repeat(np.arange(len(self.fleet)), counts)
+        seconds = offset + self.rng.uniform(0, 3600, total)
+        low, high, lobby = self._min[cars], self._max[cars], self._lobby[cars]
+        from_lobby = self.rng.random(total) < self.profile.origin_lobby_share(day_of_week, hour_of_day)
+        origin = np.where(from_lobby, lobby, self.rng.integers(low, high + 1))
+        #from the lobby: any other floor, from upstairs: mostly back down to the lobby
+        anywhere = self.rng.integers(low, high + 1)
+        to_lobby = (~from_lobby) & (self.rng.random(total) < self.profile.lobby_destination_share)
+        destination = np.where(to_lobby, lobby, anywhere)
+        destination = np.where(destination == origin, np.where(origin == lobby, high, lobby), destination)
+        passengers = 1 + self.rng.binomial(np.maximum(self._capacity[cars] - 1, 0), 0.15)
+        order = np.argsort(seconds, kind='stable')
+        return zip(seconds[order].tolist(), cars[order].tolist(), origin[order].tolist(),
+                   destination[order].tolist(), passengers[order].tolist())
+
+    def run(self, start: datetime, end: datetime, sink) -> Dict:
+        if end <= start:
+            raise ValueError("end must be after start")
+        started = time.perf_counter()
+        cars = [_Car(spec) for spec in self.fleet]
+        heap = []
+        sequence = 0
+        counts = {'demands': 0, 'states': 0, 'queued_calls': 0}
+        spf, door = self.seconds_per_floor, self.door_seconds
+
+        def at(seconds: float) -> datetime:
+            return start + timedelta(seconds=seconds)
+
+        def state(car: _Car, seconds: float, floor: int, name: str, passengers: int = 0, previous_floor: int = None):
+            sink.state(car.spec.elevator_id, floor, name, passengers, previous_floor, at(seconds))
+            counts['states'] += 1
+
+        def dispatch(car: _Car, seconds: float, floor: int, destination: int, passengers: int):
+            nonlocal sequence
+            car.busy = True
+            travel = 0.0
+            if floor != car.floor:
+                state(car, seconds, floor, 'moving', previous_floor=car.floor)
+                travel = abs(floor - car.floor) * spf
+            sequence += 1
+            heapq.heappush(heap, (seconds + travel, sequence, PICKUP, car, floor, destination, passengers))
+
+        for car in cars:
+            state(car, 0.0, car.floor, 'resting')
+
+        horizon = (end - start).total_seconds()
+        hour_start = start
+        offset = 0.0
+        while offset < horizon:
+            block_end = min(offset + 3600.0, horizon)
+            for seconds, index, floor, destination, passengers in self._sample_hour(offset, hour_start):
+                if seconds >= block_end:
+                    continue
+                sequence += 1
+                heapq.heappush(heap, (seconds, sequence, CALL, cars[index], floor, destination, passengers))
+            while heap and heap[0][0] < block_end:
+                seconds, _, kind, car, floor, destination, passengers = heapq.heappop(heap)
+                if kind == CALL:
+                    sink.demand(car.spec.elevator_id, floor, at(seconds))
+                    counts['demands'] += 1
+                    if car.busy:
+                        car.pending.append((floor, destination, passengers))
+                        counts['queued_calls'] += 1
+                    else:
+                        dispatch(car, seconds, floor, destination, passengers)
+                elif kind == PICKUP:
+                    car.floor = floor
+                    state(car, seconds, floor, 'occupied', passengers)
+                    sequence += 1
+                    heapq.heappush(heap, (seconds + door + abs(destination - floor) * spf, sequence,
+                                          READY, car, destination, None, 0))
+                else:
+                    #doors closed at the destination: next queued call, or rest here
+                    car.floor = floor
+                    if car.pending:
+                        dispatch(car, seconds, *car.pending.popleft())
+                    else:
+                        car.busy = False
+                        state(car, seconds, floor, 'resting')
+            offset += 3600.0
+            hour_start += timedelta(hours=1)
+        #rides still in progress at the end of the window are cut off
+        result = sink.close()
+        elapsed = time.perf_counter() - started
+        events = counts['demands'] + counts['states']
+        return dict(counts, **(result or {}),
+                    events=events,
+                    simulated_days=horizon / 86400,
+                    seconds=elapsed,
+                    events_per_second=events / elapsed if elapsed else 0.0)
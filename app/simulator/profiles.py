@@ -0,0 +1,93 @@
+from typing import Dict, List
+
+from app import rules
+from app.columnar import np
+
+#Demand profiles: how many calls an elevator gets per hour and where they come from.
+#Rates follow rules.is_peak_hour, so simulated peaks land where the service expects them
+
+
+class ElevatorSpec:
+    def __init__(self, elevator_id: int, building_id: int, min_floor: int, max_floor: int, max_capacity: int = 10,
+                 lobby_floor: int = None):
+        if min_floor > max_floor:
+            raise ValueError(f"Elevator {elevator_id}: min_floor above max_floor")
+        self.elevator_id = elevator_id
+        self.building_id = building_id
+        self.min_floor = min_floor
+        self.max_floor = max_floor
+        self.max_capacity = max_capacity or 10
+        self.lobby_floor = min_floor if lobby_floor is None else lobby_floor
+
+    def __repr__(self):
+        return f'ElevatorSpec({self.elevator_id}, floors={self.min_floor}..{self.max_floor})'
+
+
+#Specs from the elevators table, the same constraints record_elevator_state validates against
+def load_fleet(conn, elevator_ids: List[int] = None) -> List[ElevatorSpec]:
+    cursor = conn.cursor()
+    cursor.execute("SELECT * FROM elevators ORDER BY id")
+    fleet = []
+    for row in cursor.fetchall():
+        if elevator_ids is not None and row['id'] not in elevator_ids:
+            continue
+        capacity = row['max_capacity'] if 'max_capacity' in row.keys() else None
+        fleet.append(ElevatorSpec(row['id'], row['building_id'], row['min_floor'], row['max_floor'], capacity))
+    return fleet
+
+
+#Inserts buildings and elevators for a synthetic fleet (4 elevators per building) and returns their specs
+def create_fleet(conn, elevators: int, floor_choices=(5, 10, 20, 40, 60), seed: int = 0) -> List[ElevatorSpec]:
+    rng = np.random.default_rng(seed) if np is not None else None
+    fleet = []
+    floors = {}
+    for elevator_id in range(1, elevators + 1):
+        building_id = (elevator_id - 1) // 4 + 1
+        if building_id not in floors:
+            floors[building_id] = int(rng.choice(floor_choices)) if rng is not None else floor_choices[building_id % len(floor_choices)]
+            conn.execute("INSERT OR IGNORE INTO buildings (id, name, total_floors) VALUES (?, ?, ?)",
+                         (building_id, f'Building {building_id}', floors[building_id]))
+        conn.execute("INSERT OR IGNORE INTO elevators (id, building_id, name, min_floor, max_floor) VALUES (?, ?, ?, 1, ?)",
+                     (elevator_id, building_id, f'Elevator {elevator_id}', floors[building_id]))
+        fleet.append(ElevatorSpec(elevator_id, building_id, 1, floors[building_id]))
+    conn.commit()
+    return fleet
+
+
+class DemandProfile:
+    #calls per elevator per hour: base_rate in business hours, night_rate from 0 to 6,
+    #times peak_multiplier in peak hours and weekend_factor on weekends.
+    #lobby_share of the calls come from the lobby, morning_lobby_share before noon (people arriving)
+    def __init__(self, base_rate: float = 12.0, peak_multiplier: float = 3.0, night_rate: float = 1.0,
+                 weekend_factor: float = 0.4, lobby_share: float = 0.35, morning_lobby_share: float = 0.7,
+                 lobby_destination_share: float = 0.6):
+        self.base_rate = base_rate
+        self.peak_multiplier = peak_multiplier
+        self.night_rate = night_rate
+        self.weekend_factor = weekend_factor
+        self.lobby_share = lobby_share
+        self.morning_lobby_share = morning_lobby_share
+        self.lobby_destination_share = lobby_destination_share  #rides from upper floors that go down to the lobby
+
+    def rate(self, day_of_week: int, hour_of_day: int) -> float:
+        rate = self.night_rate if hour_of_day < 6 else self.base_rate
+        if day_of_week >= 5:
+            rate *= self.weekend_factor
+        if rules.is_peak_hour(hour_of_day, day_of_week):
+            rate *= self.peak_multiplier
+        return rate
+
+    def origin_lobby_share(self, day_of_week: int, hour_of_day: int) -> float:
+        return self.morning_lobby_share if hour_of_day < 12 else self.lobby_share
+
+    def describe(self) -> Dict:
+        return dict(self.__dict__)
+
+
+#Named presets for the CLI
+PROFILES = {
+    'office': DemandProfile(),
+    'residential': DemandProfile(base_rate=6.0, peak_multiplier=2.0, night_rate=0.5, weekend_factor=1.0,
+                                 lobby_share=0.5, morning_lobby_share=0.2),
+    'busy': DemandProfile(base_rate=40.0, peak_multiplier=2.5, night_rate=4.0, weekend_factor=0.6),
+}
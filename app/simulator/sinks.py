@@ -0,0 +1,128 @@
+from datetime import datetime
+from typing import Dict, List
+
+from app import rules, timestamps
+from app.db import DEFAULT_PRAGMAS
+from app.elevator_api import ElevatorDataService
+
+#Where simulated events go. Every sink has demand(), state() and close() -> stats
+
+
+#Keeps the events in memory, for tests and for replaying the same run into another sink
+class ListSink:
+    def __init__(self):
+        self.events = []
+
+    def demand(self, elevator_id: int, floor: int, when: datetime):
+        self.events.append(('demand', (elevator_id, floor, when)))
+
+    def state(self, elevator_id: int, floor: int, state: str, passenger_count: int, previous_floor: int, when: datetime):
+        self.events.append(('state', (elevator_id, floor, state, passenger_count, previous_floor, when)))
+
+    def close(self) -> Dict:
+        return {}
+
+
+#Goes through record_demands_batch / record_elevator_states_batch, same validation and
+#derived tables as production ingestion
+class ServiceSink:
+    def __init__(self, service, batch_size: int = 5000):
+        self.service = service
+        self.batch_size = batch_size
+        self.demands, self.states = [], []
+        self.accepted = 0
+        self.rejected = 0
+
+    def demand(self, elevator_id: int, floor: int, when: datetime):
+        self.demands.append({'elevator_id': elevator_id, 'requested_floor': floor, 'request_time': when})
+        if len(self.demands) >= self.batch_size:
+            self.flush()
+
+    def state(self, elevator_id: int, floor: int, state: str, passenger_count: int, previous_floor: int, when: datetime):
+        self.states.append({'elevator_id': elevator_id, 'floor': floor, 'state': state,
+                            'passenger_count': passenger_count, 'previous_floor': previous_floor, 'timestamp': when})
+        if len(self.states) >= self.batch_size:
+            self.flush()
+
+    #states first, so resting periods exist before the demands that close them
+    def flush(self):
+        for events, record in ((self.states, self.service.record_elevator_states_batch),
+                               (self.demands, self.service.record_demands_batch)):
+            if events:
+                result = record(events)
+                self.accepted += result['accepted']
+                self.rejected += result['rejected']
+                del events[:]
+
+    def close(self) -> Dict:
+        self.flush()
+        return {'accepted': self.accepted, 'rejected': self.rejected}
+
+
+#Plain executemany into a SQLite file, derived tables are rebuilt once at the end.
+#For 10M+ event datasets, skips per event validation (the simulator respects floor bounds already)
+class SQLiteSink:
+    #throwaway dataset files, losing one on a crash is fine
+    PRAGMAS = dict(DEFAULT_PRAGMAS, synchronous='OFF', cache_size=-200000)
+
+    def __init__(self, db_path: str, batch_size: int = 100_000, rebuild: bool = True):
+        self.service = ElevatorDataService(db_path, pragmas=self.PRAGMAS)
+        self.batch_size = batch_size
+        self.rebuild = rebuild
+        self.demands, self.states = [], []
+        self.rows = {'demands': 0, 'states': 0}
+
+    def demand(self, elevator_id: int, floor: int, when: datetime):
+        day_of_week, hour_of_day, is_peak = rules.time_features(when)
+        self.demands.append((elevator_id, floor, timestamps.to_ms(when), day_of_week, hour_of_day, is_peak))
+        if len(self.demands) >= self.batch_size:
+            self.flush()
+
+    def state(self, elevator_id: int, floor: int, state: str, passenger_count: int, previous_floor: int, when: datetime):
+        self.states.append((elevator_id, floor, state, passenger_count, timestamps.to_ms(when), previous_floor))
+        if len(self.states) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        conn = self.service.get_connection()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany("""
+                INSERT INTO demand_events (elevator_id, requested_floor, request_time, day_of_week, hour_of_day, is_peak_hour)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, self.demands)
+            conn.executemany("""
+                INSERT INTO elevator_states (elevator_id, floor, state, passenger_count, timestamp, previous_floor)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, self.states)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        self.rows['demands'] += len(self.demands)
+        self.rows['states'] += len(self.states)
+        self.demands, self.states = [], []
+
+    def close(self) -> Dict:
+        self.flush()
+        result = dict(self.rows)
+        if self.rebuild:
+            started = datetime.now()
+            result['training_samples'] = self.service.rebuild_ml_training_data()
+            result['rollup_rows'] = self.service.rebuild_demand_rollups()
+            result['sketch_rows'] = self.service.rebuild_sketches()
+            result['rebuild_seconds'] = (datetime.now() - started).total_seconds()
+        self.service.close()
+        return result
+
+
+#Feeds recorded events (e.g. ListSink.events) into another sink, in the original order
+def replay(events: List, sink) -> Dict:
+    for kind, values in events:
+        if kind == 'demand':
+            sink.demand(*values)
+        else:
+            sink.state(*values)
+    return sink.close()
@@ -0,0 +1,188 @@
+import math
+from typing import Dict, Iterable, List
+
+#Mergeable summaries kept per elevator and hour in elevator_sketches, merged on read for any window.
+#QuantileSketch is a log bucketed (DDSketch style) histogram: every quantile it returns is within
+#RELATIVE_ACCURACY of the true value, sketches of any hours merge by adding bucket counts, and a
+#value can be taken out again (a training sample replaced by a backfill). A busy hour is a few
+#dozen buckets, tens of bytes on disk.
+#FloorSet is an exact distinct count, floors are a small domain so a bitmap beats any estimator
+
+RELATIVE_ACCURACY = 0.01
+MIN_VALUE = 1e-3  #anything smaller (e.g. a demand in the same second) counts as zero
+FORMAT_VERSION = 1
+
+_GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+_LOG_GAMMA = math.log(_GAMMA)
+
+
+def _write_varint(out: bytearray, value: int):
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return
+
+
+def _read_varint(data: bytes, position: int):
+    value = shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, position
+        shift += 7
+
+
+def _zigzag(value: int) -> int:
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+
+def _unzigzag(value: int) -> int:
+    return value // 2 if value % 2 == 0 else -(value + 1) // 2
+
+
+class QuantileSketch:
+    __slots__ = ('bins', 'zero_count')
+
+    def __init__(self):
+        self.bins = {}  #bucket index -> count, values in (gamma^(i-1), gamma^i]
+        self.zero_count = 0
+
+    @property
+    def count(self) -> int:
+        return self.zero_count + sum(self.bins.values())
+
+    def add(self, value: float, count: int = 1):
+        if value < 0:
+            raise ValueError(f"Sketch values must not be negative: {value}")
+        if value < MIN_VALUE:
+            self.zero_count += count
+            return
+        index = math.ceil(math.log(value) / _LOG_GAMMA)
+        total = self.bins.get(index, 0) + count
+        if total > 0:
+            self.bins[index] = total
+        else:
+            self.bins.pop(index, None)
+
+    #Takes back a value that was added before
+    def remove(self, value: float):
+        if value < MIN_VALUE:
+            self.zero_count = max(self.zero_count - 1, 0)
+        else:
+            self.add(value, -1)
+
+    def merge(self, other: 'QuantileSketch') -> 'QuantileSketch':
+        self.zero_count += other.zero_count
+        for index, count in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+        return self
+
+    def quantile(self, q: float) -> float:
+        if not 0 <= q <= 1:
+            raise ValueError(f"Quantile must be between 0 and 1: {q}")
+        total = self.count
+        if not total:
+            return None
+        rank = q * (total - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if rank < seen:
+                #midpoint of the bucket in relative terms, at most RELATIVE_ACCURACY from any value in it
+                return 2 * _GAMMA ** index / (_GAMMA + 1)
+        return 2 * _GAMMA ** max(self.bins) / (_GAMMA + 1)
+
+    def quantiles(self, qs: Iterable[float]) -> List[float]:
+        return [self.quantile(q) for q in qs]
+
+    #version, zero count, bucket count, then (index delta, count) pairs, all varints
+    def to_bytes(self) -> bytes:
+        out = bytearray([FORMAT_VERSION])
+        _write_varint(out, self.zero_count)
+        _write_varint(out, len(self.bins))
+        previous = 0
+        for index in sorted(self.bins):
+            _write_varint(out, _zigzag(index - previous))
+            _write_varint(out, self.bins[index])
+            previous = index
+        return bytes(out)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'QuantileSketch':
+        sketch = cls()
+        if not data:
+            return sketch
+        if data[0] != FORMAT_VERSION:
+            raise ValueError(f"Unknown sketch format: {data[0]}")
+        sketch.zero_count, position = _read_varint(data, 1)
+        size, position = _read_varint(data, position)
+        index = 0
+        for _ in range(size):
+            delta, position = _read_varint(data, position)
+            count, position = _read_varint(data, position)
+            index += _unzigzag(delta)
+            sketch.bins[index] = count
+        return sketch
+
+
+class FloorSet:
+    __slots__ = ('bits',)
+
+    def __init__(self, bits: int = 0):
+        self.bits = bits  #bit zigzag(floor) set when the floor was seen, basements included
+
+    def add(self, floor: int):
+        self.bits |= 1 << _zigzag(floor)
+
+    def merge(self, other: 'FloorSet') -> 'FloorSet':
+        self.bits |= other.bits
+        return self
+
+    @property
+    def count(self) -> int:
+        return bin(self.bits).count('1')
+
+    def floors(self) -> List[int]:
+        return sorted(_unzigzag(bit) for bit in range(self.bits.bit_length()) if self.bits >> bit & 1)
+
+    def to_bytes(self) -> bytes:
+        return self.bits.to_bytes((self.bits.bit_length() + 7) // 8 or 1, 'little')
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'FloorSet':
+        return cls(int.from_bytes(data or b'', 'little'))
+
+
+#metric name -> summary type stored for it
+METRICS = {'wait_minutes': QuantileSketch, 'idle_minutes': QuantileSketch, 'floors': FloorSet}
+
+
+def load(metric: str, data: bytes):
+    return METRICS[metric].from_bytes(data)
+
+
+#Applies updates {(elevator_id, hour_bucket, metric): [(op, value), ...]} with one read-modify-write
+#per touched row, inside the caller's transaction. op is 'add' or 'remove'
+def apply_updates(cursor, updates: Dict):
+    for (elevator_id, hour_bucket, metric), operations in updates.items():
+        cursor.execute("SELECT sketch FROM elevator_sketches WHERE elevator_id = ? AND hour_bucket = ? AND metric = ?",
+                       (elevator_id, hour_bucket, metric))
+        row = cursor.fetchone()
+        summary = load(metric, row[0] if row else None)
+        for op, value in operations:
+            if op == 'add':
+                summary.add(value)
+            else:
+                summary.remove(value)
+        cursor.execute("""
+            INSERT INTO elevator_sketches (elevator_id, hour_bucket, metric, sketch) VALUES (?, ?, ?, ?)
+            ON CONFLICT (elevator_id, hour_bucket, metric) DO UPDATE SET sketch = excluded.sketch
+        """, (elevator_id, hour_bucket, metric, summary.to_bytes()))
@@ -0,0 +1,57 @@
+from datetime import datetime, timedelta
+
+#Every stored time is an integer number of milliseconds since 1970-01-01.
+#Times are wall clock (naive) datetimes everywhere in the service, they are stored as if they were
+#UTC so they come back exactly as they went in and day_of_week / hour_of_day keep their meaning.
+#Aware datetimes are converted to the server's wall clock first, like datetime.now() would give.
+#Only the edges (JSON in and out) see ISO-8601 strings
+
+EPOCH = datetime(1970, 1, 1)
+SECOND_MS = 1000
+MINUTE_MS = 60 * SECOND_MS
+HOUR_MS = 60 * MINUTE_MS
+DAY_MS = 24 * HOUR_MS
+
+
+def wall_clock(value: datetime) -> datetime:
+    if value.tzinfo is not None:
+        return value.astimezone().replace(tzinfo=None)
+    return value
+
+
+def to_ms(value) -> int:
+    if isinstance(value, bool):
+        raise ValueError(f"Invalid timestamp: {value}")
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if not isinstance(value, datetime):
+        raise ValueError(f"Invalid timestamp: {value}")
+    delta = wall_clock(value) - EPOCH
+    return (delta.days * 86400 + delta.seconds) * SECOND_MS + delta.microseconds // 1000
+
+
+def from_ms(value: int) -> datetime:
+    return EPOCH + timedelta(milliseconds=value)
+
+
+#'2025-01-15T08:00:00', with milliseconds only when there are some
+def to_iso(value: int) -> str:
+    if value is None:
+        return None
+    moment = from_ms(value)
+    return moment.isoformat(timespec='milliseconds' if value % SECOND_MS else 'seconds')
+
+
+def hour_bucket(value: int) -> int:
+    return value - value % HOUR_MS
+
+
+#Epoch ms a datetime can hold (years 1 to 9999), anything outside can't be turned back into a time
+MIN_MS = -62135596800000
+MAX_MS = 253402300799999
+
+
+def in_range(value: int) -> bool:
+    return MIN_MS <= value <= MAX_MS
@@ -0,0 +1,271 @@
+#Reproducible benchmarks for the service layer and the API.
+#   python -m bench.benchmark --scales 10k 1m --output bench_results.json
+#   python -m bench.benchmark --scales 10k --compare bench_results.json
+#Every run uses a fixed seed, so the same scale always produces the same dataset
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app.elevator_api import ElevatorDataService  # noqa: E402
+
+#events (demands + states), elevators, days of history
+SCALES = {
+    '10k': (10_000, 10, 30),
+    '100k': (100_000, 50, 60),
+    '1m': (1_000_000, 100, 180),
+    '10m': (10_000_000, 500, 365),
+}
+#History ends today, so the default analytics windows (last 7/90 days) actually hit data
+HISTORY_END = datetime.combine(datetime.now().date(), datetime.min.time())
+LOAD_BATCH = 5000
+
+
+def percentiles(samples: List[float]) -> Dict:
+    ordered = sorted(samples)
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+    return {'count': len(ordered), 'mean_ms': sum(ordered) / len(ordered) * 1000,
+            'p50_ms': pick(0.50) * 1000, 'p90_ms': pick(0.90) * 1000,
+            'p99_ms': pick(0.99) * 1000, 'max_ms': ordered[-1] * 1000}
+
+
+def timed(fn: Callable, repeat: int) -> List[float]:
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def throughput(fn: Callable, count: int) -> Dict:
+    started = time.perf_counter()
+    for i in range(count):
+        fn(i)
+    elapsed = time.perf_counter() - started
+    return {'count': count, 'seconds': elapsed, 'per_second': count / elapsed if elapsed else 0.0}
+
+
+#Buildings of 5 to 60 floors, one elevator per id
+def create_fleet(service: ElevatorDataService, elevators: int, rng: random.Random) -> Dict[int, int]:
+    conn = service.get_connection()
+    floors = {}
+    for elevator_id in range(1, elevators + 1):
+        building_id = (elevator_id - 1) // 4 + 1
+        max_floor = floors.get(building_id) or rng.choice([5, 10, 20, 40, 60])
+        floors[building_id] = max_floor
+        conn.execute("INSERT OR IGNORE INTO buildings (id, name, total_floors) VALUES (?, ?, ?)",
+                     (building_id, f'Building {building_id}', max_floor))
+        conn.execute("INSERT INTO elevators (id, building_id, name, min_floor, max_floor) VALUES (?, ?, ?, 1, ?)",
+                     (elevator_id, building_id, f'Elevator {elevator_id}', max_floor))
+    conn.commit()
+    conn.close()
+    #rows went in behind the registry's back
+    service.registry.load()
+    return {elevator_id: floors[(elevator_id - 1) // 4 + 1] for elevator_id in range(1, elevators + 1)}
+
+
+#Each elevator cycles resting -> demand -> moving -> occupied, 40% of the calls come from the lobby
+def synthetic_events(fleet: Dict[int, int], total: int, days: int, rng: random.Random):
+    per_elevator = max(1, total // (4 * len(fleet)))
+    step = timedelta(days=days) / per_elevator
+    clocks = {elevator_id: HISTORY_END - timedelta(days=days) for elevator_id in fleet}
+    floors = {elevator_id: 1 for elevator_id in fleet}
+    produced = 0
+    while produced < total:
+        for elevator_id, max_floor in fleet.items():
+            now = clocks[elevator_id] + step * rng.uniform(0.2, 1.8)
+            rest_floor = floors[elevator_id]
+            target = 1 if rng.random() < 0.4 else rng.randint(1, max_floor)
+            yield 'state', {'elevator_id': elevator_id, 'floor': rest_floor, 'state': 'resting', 'timestamp': now}
+            yield 'demand', {'elevator_id': elevator_id, 'requested_floor': target, 'request_time': now + timedelta(seconds=rng.randint(5, 900))}
+            yield 'state', {'elevator_id': elevator_id, 'floor': target, 'state': 'moving',
+                            'previous_floor': rest_floor, 'timestamp': now + timedelta(seconds=910)}
+            floors[elevator_id] = rng.randint(1, max_floor)
+            yield 'state', {'elevator_id': elevator_id, 'floor': floors[elevator_id], 'state': 'occupied',
+                            'passenger_count': rng.randint(1, 8), 'timestamp': now + timedelta(seconds=960)}
+            clocks[elevator_id] = now
+            produced += 4
+            if produced >= total:
+                return
+
+
+#Loads through the batch path so every derived table is filled like in production
+def load_history(service: ElevatorDataService, fleet: Dict[int, int], total: int, days: int, rng: random.Random) -> Dict:
+    started = time.perf_counter()
+    pending = {'demand': [], 'state': []}
+    def flush(kind):
+        if kind == 'demand':
+            service.record_demands_batch(pending[kind])
+        else:
+            service.record_elevator_states_batch(pending[kind])
+        pending[kind] = []
+    for kind, event in synthetic_events(fleet, total, days, rng):
+        pending[kind].append(event)
+        #states first, so resting periods exist before the demands that close them
+        if len(pending['state']) >= LOAD_BATCH:
+            flush('state')
+        if len(pending['demand']) >= LOAD_BATCH:
+            flush('state')
+            flush('demand')
+    flush('state')
+    flush('demand')
+    elapsed = time.perf_counter() - started
+    return {'events': total, 'seconds': elapsed, 'per_second': total / elapsed if elapsed else 0.0}
+
+
+def bench_ingest(service: ElevatorDataService, fleet: Dict[int, int], count: int, rng: random.Random) -> Dict:
+    elevator_ids = list(fleet)
+    base = HISTORY_END + timedelta(days=1)
+    results = {
+        'record_demand': throughput(lambda i: service.record_demand(
+            rng.choice(elevator_ids), rng.randint(1, 5), base + timedelta(seconds=i)), count),
+        'record_elevator_state': throughput(lambda i: service.record_elevator_state(
+            rng.choice(elevator_ids), rng.randint(1, 5), rng.choice(['resting', 'moving', 'occupied']),
+            timestamp=base + timedelta(seconds=i)), count),
+    }
+    batch = [{'elevator_id': rng.choice(elevator_ids), 'requested_floor': rng.randint(1, 5),
+              'request_time': base + timedelta(seconds=i)} for i in range(500)]
+    batches = max(1, count // 500)
+    batch_run = throughput(lambda i: service.record_demands_batch(batch), batches)
+    results['record_demands_batch'] = dict(batch_run, events_per_second=batch_run['per_second'] * len(batch))
+    return results
+
+
+def bench_queries(service: ElevatorDataService, fleet: Dict[int, int], days: int, repeat: int, rng: random.Random) -> Dict:
+    elevator_ids = list(fleet)
+    def training_window():
+        start = HISTORY_END - timedelta(days=rng.randint(1, days))
+        service.get_ml_training_data(rng.choice(elevator_ids), start, start + timedelta(days=1))
+    return {
+        'get_ml_training_data_1day': percentiles(timed(training_window, repeat)),
+        'get_ml_training_data_elevator': percentiles(timed(lambda: service.get_ml_training_data(rng.choice(elevator_ids)), max(1, repeat // 10))),
+        'get_demand_analytics_7d': percentiles(timed(lambda: service.get_demand_analytics(rng.choice(elevator_ids), 7), repeat)),
+        'get_demand_analytics_90d': percentiles(timed(lambda: service.get_demand_analytics(rng.choice(elevator_ids), 90), repeat)),
+    }
+
+
+#Full request cycle through the Flask test client, routing + JSON included
+def bench_endpoints(service: ElevatorDataService, fleet: Dict[int, int], count: int, rng: random.Random) -> Dict:
+    from app import elevator_api
+    original = elevator_api.service
+    elevator_api.service = service
+    elevator_ids = list(fleet)
+    try:
+        with elevator_api.app.test_client() as client:
+            return {
+                'POST /elevators/<id>/demand': throughput(lambda i: client.post(
+                    f'/elevators/{rng.choice(elevator_ids)}/demand', json={'requested_floor': 2}), count),
+                'POST /elevators/<id>/state': throughput(lambda i: client.post(
+                    f'/elevators/{rng.choice(elevator_ids)}/state', json={'floor': 2, 'state': 'moving'}), count),
+                'GET /elevators/<id>/analytics': throughput(lambda i: client.get(
+                    f'/elevators/{rng.choice(elevator_ids)}/analytics?days=7'), count),
+                'GET /training-data?limit=100': throughput(lambda i: client.get(
+                    f'/training-data?elevator_id={rng.choice(elevator_ids)}&limit=100'), count),
+            }
+    finally:
+        elevator_api.service = original
+
+
+def run_scale(name: str, events: int, elevators: int, days: int, workdir: str, samples: int, seed: int) -> Dict:
+    rng = random.Random(seed)
+    db_path = os.path.join(workdir, f'bench_{name}.db')
+    service = ElevatorDataService(db_path)
+    try:
+        fleet = create_fleet(service, elevators, rng)
+        result = {'events': events, 'elevators': elevators, 'days': days,
+                  'load': load_history(service, fleet, events, days, rng)}
+        result['queries'] = bench_queries(service, fleet, days, samples, rng)
+        result['ingest'] = bench_ingest(service, fleet, samples, rng)
+        result['endpoints'] = bench_endpoints(service, fleet, samples, rng)
+        result['db_size_bytes'] = sum(os.path.getsize(path) for path in (db_path, db_path + '-wal') if os.path.exists(path))
+        return result
+    finally:
+        service.close()
+
+
+#Flattens results to {metric path: (value, higher_is_better)}
+def headline_metrics(results: Dict) -> Dict:
+    metrics = {}
+    for scale, data in results['scales'].items():
+        metrics[f'{scale}.load.per_second'] = (data['load']['per_second'], True)
+        for name, value in data['ingest'].items():
+            metrics[f'{scale}.ingest.{name}'] = (value['per_second'], True)
+        for name, value in data['queries'].items():
+            metrics[f'{scale}.queries.{name}.p90_ms'] = (value['p90_ms'], False)
+        for name, value in data['endpoints'].items():
+            metrics[f'{scale}.endpoints.{name}'] = (value['per_second'], True)
+    return metrics
+
+
+def compare(current: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    regressions = []
+    before = headline_metrics(baseline)
+    for key, (value, higher_is_better) in headline_metrics(current).items():
+        if key not in before or not before[key][0]:
+            continue
+        ratio = value / before[key][0]
+        worse = ratio < 1 - tolerance if higher_is_better else ratio > 1 + tolerance
+        if worse:
+            regressions.append(f'{key}: {before[key][0]:.3f} -> {value:.3f} ({ratio:.2f}x)')
+    return regressions
+
+
+def run(scales: List[str], samples: int = 200, seed: int = 2025, workdir: str = None) -> Dict:
+    cleanup = workdir is None
+    workdir = workdir or tempfile.mkdtemp(prefix='elevator-bench-')
+    try:
+        results = {'meta': {'started_at': datetime.now().isoformat(), 'python': platform.python_version(),
+                            'sqlite': sqlite3.sqlite_version, 'platform': platform.platform(),
+                            'samples': samples, 'seed': seed},
+                   'scales': {}}
+        for name in scales:
+            events, elevators, days = SCALES[name] if name in SCALES else (int(name), 4, 30)
+            print(f'[{name}] {events} events, {elevators} elevators, {days} days', file=sys.stderr)
+            results['scales'][name] = run_scale(name, events, elevators, days, workdir, samples, seed)
+        return results
+    finally:
+        if cleanup:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Elevator service benchmarks')
+    parser.add_argument('--scales', nargs='+', default=['10k'], help=f'{", ".join(SCALES)} or a raw event count')
+    parser.add_argument('--samples', type=int, default=200, help='calls per latency/throughput measurement')
+    parser.add_argument('--seed', type=int, default=2025)
+    parser.add_argument('--workdir', help='where benchmark databases go (temp dir by default, removed after)')
+    parser.add_argument('--output', help='write JSON results here instead of stdout')
+    parser.add_argument('--compare', help='baseline JSON, exit 1 when a headline metric regresses')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative regression')
+    args = parser.parse_args(argv)
+
+    results = run(args.scales, args.samples, args.seed, args.workdir)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f'REGRESSION {line}', file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
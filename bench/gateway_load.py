@@ -0,0 +1,191 @@
+#Load generator for the binary gateway listener (app/gateway.py).
+#   python -m bench.gateway_load --connect tcp://127.0.0.1:2026 --elevators 1-100 --events 1000000
+#   python -m bench.gateway_load --self-test --events 200000      (temp database, listener in this process)
+#   python -m bench.gateway_load --decode-only --events 1000000   (decoder alone, no socket, no database)
+#Events follow bench.benchmark's mix: each elevator cycles resting -> demand -> moving -> occupied.
+#Frames are built up front with NumPy, so the numbers are the listener's, not the generator's
+import argparse
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app import timestamps  # noqa: E402
+from app.columnar import np, require_numpy  # noqa: E402
+from app.gateway import (ACK_STRUCT, DEMAND, FRAME_HEADER, NO_FLOOR, RECORD_DTYPE, STATE,  # noqa: E402
+                         GatewayListener, decode_frame, parse_address)
+
+STATE_CODES = {'resting': 0, 'moving': 1, 'occupied': 2}
+
+
+def parse_range(value: str) -> range:
+    low, _, high = value.partition('-')
+    return range(int(low), int(high or low) + 1)
+
+
+#events records, 4 per cycle. Elevators take turns in round robin, each one starts a new cycle every
+#cycle_seconds, so its own timeline never overlaps
+def make_records(events: int, elevator_ids: range, floors: range, start: datetime, cycle_seconds: int = 1000,
+                 seed: int = 2025):
+    require_numpy()
+    rng = np.random.default_rng(seed)
+    cycles = -(-events // 4)
+    index = np.arange(cycles)
+    elevator = np.array(elevator_ids, dtype=np.uint32)[index % len(elevator_ids)]
+    rest_floor = rng.integers(floors.start, floors.stop, cycles)
+    target = np.where(rng.random(cycles) < 0.4, floors.start, rng.integers(floors.start, floors.stop, cycles))
+    after = rng.integers(floors.start, floors.stop, cycles)
+    base = timestamps.to_ms(start) + index // len(elevator_ids) * cycle_seconds * 1000 + index % len(elevator_ids)
+
+    records = np.zeros((cycles, 4), dtype=RECORD_DTYPE)
+    records['elevator_id'] = elevator[:, None]
+    records['kind'] = [STATE, DEMAND, STATE, STATE]
+    records['state'] = [STATE_CODES['resting'], 0, STATE_CODES['moving'], STATE_CODES['occupied']]
+    records['floor'] = np.stack([rest_floor, target, target, after], axis=1)
+    records['previous_floor'] = np.stack([np.full(cycles, NO_FLOOR), np.full(cycles, NO_FLOOR), rest_floor, target], axis=1)
+    records['passenger_count'][:, 3] = rng.integers(1, 9, cycles)
+    records['timestamp'] = base[:, None] + np.array([0, 0, 910_000, 960_000])
+    records['timestamp'][:, 1] += rng.integers(5, 900, cycles) * 1000
+    return records.reshape(-1)[:events]
+
+
+def make_frames(records, frame_records: int) -> List[bytes]:
+    return [FRAME_HEADER.pack(chunk.nbytes) + chunk.tobytes()
+            for chunk in (records[i:i + frame_records] for i in range(0, len(records), frame_records))]
+
+
+def connect(address: str) -> socket.socket:
+    kind, args = parse_address(address)
+    if kind == 'unix':
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(args[0])
+        return sock
+    sock = socket.create_connection(args)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+def _read_exactly(sock: socket.socket, size: int) -> bytes:
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("listener closed the connection")
+        data += chunk
+    return data
+
+
+#Sends the frames pipelined, acks are read on a second thread so neither side blocks the other
+def _send(address: str, frames: List[bytes], totals: Dict, lock: threading.Lock):
+    sock = connect(address)
+    counts = [0, 0]
+    def read_acks():
+        for _ in frames:
+            accepted, rejected = ACK_STRUCT.unpack(_read_exactly(sock, ACK_STRUCT.size))
+            counts[0] += accepted
+            counts[1] += rejected
+    reader = threading.Thread(target=read_acks)
+    reader.start()
+    try:
+        for frame in frames:
+            sock.sendall(frame)
+        reader.join()
+    finally:
+        sock.close()
+    with lock:
+        totals['accepted'] += counts[0]
+        totals['rejected'] += counts[1]
+
+
+#Seconds from the first byte sent until every frame is acknowledged (committed)
+def run_load(address: str, records, frame_records: int = 5000, connections: int = 1) -> Dict:
+    frames = make_frames(records, frame_records)
+    totals = {'accepted': 0, 'rejected': 0}
+    lock = threading.Lock()
+    threads = [threading.Thread(target=_send, args=(address, frames[i::connections], totals, lock))
+               for i in range(connections)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    return dict(totals, events=len(records), frames=len(frames), connections=connections, seconds=round(elapsed, 3),
+                events_per_second=round(len(records) / elapsed) if elapsed else 0)
+
+
+#Decoding and validation only, the part of the listener that runs per event in Python
+def run_decode(records, frame_records: int, floors: range) -> Dict:
+    bounds = {'min_floor': floors.start, 'max_floor': floors.stop - 1}
+    payloads = [frame[FRAME_HEADER.size:] for frame in make_frames(records, frame_records)]
+    started = time.perf_counter()
+    decoded = 0
+    for payload in payloads:
+        demands, states, _ = decode_frame(payload, lambda ids: {elevator_id: bounds for elevator_id in ids})
+        decoded += len(demands) + len(states)
+    elapsed = time.perf_counter() - started
+    return {'events': len(records), 'decoded': decoded, 'seconds': round(elapsed, 3),
+            'events_per_second': round(len(records) / elapsed) if elapsed else 0}
+
+
+#Temp database with a fleet, listener on a free local port in this process
+def run_self_test(events: int, elevators: int, frame_records: int, connections: int) -> Dict:
+    from app.elevator_api import ElevatorDataService
+    workdir = tempfile.mkdtemp(prefix='elevator-gateway-')
+    service = ElevatorDataService(os.path.join(workdir, 'gateway.db'))
+    listener = None
+    try:
+        service.create_building('Load test', 10, building_id=1)
+        for elevator_id in range(1, elevators + 1):
+            service.create_elevator(1, f'Elevator {elevator_id}', 1, 10, elevator_id=elevator_id)
+        listener = GatewayListener(service, ['tcp://127.0.0.1:0']).start()
+        host, port = listener.sockets[0][:2]
+        start = datetime.combine(datetime.now().date(), datetime.min.time()) - timedelta(days=30)
+        records = make_records(events, range(1, elevators + 1), range(1, 11), start)
+        result = run_load(f'tcp://{host}:{port}', records, frame_records, connections)
+        result['training_samples'] = service.count_ml_training_data()
+        return result
+    finally:
+        if listener is not None:
+            listener.stop()
+        service.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load generator for the binary gateway listener')
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument('--connect', help='tcp://host:port or unix:///path of a running listener')
+    mode.add_argument('--self-test', action='store_true', help='temp database and listener in this process')
+    mode.add_argument('--decode-only', action='store_true', help='decoder throughput, no socket or database')
+    parser.add_argument('--events', type=int, default=100_000)
+    parser.add_argument('--elevators', default='1-20', help='elevator id range, e.g. 1-100 (--self-test: the fleet size is the top)')
+    parser.add_argument('--floors', default='1-10', help='floor range used for every elevator')
+    parser.add_argument('--frame-records', type=int, default=5000)
+    parser.add_argument('--connections', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=2025)
+    args = parser.parse_args(argv)
+
+    elevator_ids, floors = parse_range(args.elevators), parse_range(args.floors)
+    if args.self_test:
+        result = run_self_test(args.events, elevator_ids.stop - 1, args.frame_records, args.connections)
+    else:
+        start = datetime.combine(datetime.now().date(), datetime.min.time())
+        records = make_records(args.events, elevator_ids, floors, start, seed=args.seed)
+        if args.decode_only:
+            result = run_decode(records, args.frame_records, floors)
+        else:
+            result = run_load(args.connect, records, args.frame_records, args.connections)
+    print(json.dumps(result, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
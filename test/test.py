@@ -3,14 +3,20 @@ import tempfile
 import pytest
 
 import os
+import threading
 from datetime import datetime, timedelta
 from unittest.mock import patch
 
+import asyncio
+import io
 import json
 
 import sys
 sys.path.append('.')
+from app import elevator_api, metrics, optimizer, timestamps
+from app.cache import WriteVersions
 from app.elevator_api import ElevatorDataService, app
+from app.ingest_queue import IngestQueue, QueueClosedError, QueueFullError
 #Creates a temp DB
 class TestElevatorDataService:
     @pytest.fixture
@@ -87,7 +93,7 @@ class TestElevatorDataService:
         
         service = ElevatorDataService(db_path)
         yield service
-       
+        service.close()
         os.unlink(db_path)
 #Tests if "peak hours" works    
     def test_peak_hour_detection(self, service):
@@ -184,6 +190,570 @@ class TestElevatorDataService:
         assert len(training_data) == 1
         assert training_data[0]['next_demand_floor'] == 8
 
+    #Batch inserts, one transaction for many elevators, errors per item
+    def test_record_demands_batch(self, service):
+        conn = service.get_connection()
+        conn.execute("INSERT INTO elevators (id, building_id, name, min_floor, max_floor) VALUES (2, 1, 'Second', 1, 10)")
+        conn.commit()
+        conn.close()
+        result = service.record_demands_batch([
+            {'elevator_id': 1, 'requested_floor': 5, 'request_time': '2025-01-15T08:30:00'},
+            {'elevator_id': 1, 'requested_floor': 'five'},
+            {'elevator_id': 2, 'requested_floor': 3, 'request_time': '2025-01-15T10:00:00'},
+            {'elevator_id': 9, 'requested_floor': 3},
+            {'elevator_id': 1, 'requested_floor': 11}])
+        assert result['accepted'] == 2
+        assert result['rejected'] == 3
+        ok, bad, other, unknown, out_of_bounds = result['results']
+        assert ok['is_peak_hour'] == True
+        assert 'must be an integer' in bad['error']
+        assert unknown['error'] == 'Elevator 9 not found'
+        assert 'out of bounds' in out_of_bounds['error']
+        assert other['demand_id'] == ok['demand_id'] + 1
+        #ids must match what was stored
+        conn = service.get_connection()
+        row = conn.execute("SELECT requested_floor FROM demand_events WHERE id = ?", (other['demand_id'],)).fetchone()
+        conn.close()
+        assert row[0] == 3
+
+    def test_record_states_batch_validation(self, service):
+        result = service.record_elevator_states_batch([
+            {'elevator_id': 1, 'floor': 3, 'state': 'resting'},
+            {'elevator_id': 1, 'floor': 15, 'state': 'resting'},
+            {'elevator_id': 1, 'floor': 3, 'state': 'flying'},
+            {'elevator_id': 99, 'floor': 3, 'state': 'moving'}])
+        assert result['accepted'] == 1
+        errors = [r['error'] for r in result['results'] if 'error' in r]
+        assert 'out of bounds' in errors[0]
+        assert 'Invalid state' in errors[1]
+        assert 'not found' in errors[2]
+        assert 'state_id' in result['results'][0]
+
+    #Same connection is reused per thread, configured for WAL
+    def test_connection_pool_reuse(self, service):
+        conn = service.get_connection()
+        conn.close()
+        assert service.get_connection() is conn
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+        assert conn.execute("PRAGMA busy_timeout").fetchone()[0] == 5000
+
+        other = []
+        thread = threading.Thread(target=lambda: other.append(service.get_connection()))
+        thread.start()
+        thread.join()
+        assert other[0] is not conn
+        #half done transactions are rolled back when the connection goes back
+        conn.execute("INSERT INTO demand_events (elevator_id, requested_floor, request_time, day_of_week, hour_of_day) VALUES (1, 2, '2025-01-01', 2, 1)")
+        conn.close()
+        assert conn.execute("SELECT COUNT(*) FROM demand_events").fetchone()[0] == 0
+
+    #Incremental samples must match a full rebuild from history
+    def test_training_data_incremental_matches_rebuild(self, service):
+        start = datetime(2025, 1, 13, 7, 0)
+        for i in range(30):
+            if i % 3 == 0:
+                service.record_elevator_state(1, i % 10 + 1, 'resting', timestamp=start + timedelta(minutes=i))
+            else:
+                service.record_demand(1, (i * 7) % 10 + 1, start + timedelta(minutes=i))
+        #a resting state that is backfilled after its next demand was stored
+        service.record_elevator_state(1, 2, 'resting', timestamp=start + timedelta(minutes=4, seconds=30))
+        incremental = service.get_ml_training_data(elevator_id=1)
+        service.rebuild_ml_training_data()
+        rebuilt = service.get_ml_training_data(elevator_id=1)
+        assert len(incremental) == 11
+        assert incremental == rebuilt
+        backfilled = [r for r in rebuilt if r['rest_start_time'] == '2025-01-13T07:04:30']
+        assert backfilled[0]['next_demand_time'] == '2025-01-13T07:05:00'
+        assert backfilled[0]['minutes_until_demand'] == 0.5
+
+    #Keyset pages cover everything exactly once
+    def test_training_data_keyset_paging(self, service):
+        start = datetime(2025, 1, 13, 7, 0)
+        for i in range(7):
+            service.record_elevator_state(1, 3, 'resting', timestamp=start + timedelta(minutes=2 * i))
+            service.record_demand(1, 5, start + timedelta(minutes=2 * i + 1))
+        pages, after = [], None
+        while True:
+            after, rows = service.open_training_page(elevator_id=1, after=after, limit=3)
+            pages.append(list(rows))
+            if after is None:
+                break
+        assert [len(page) for page in pages] == [3, 3, 1]
+        #the cursor is the key of the last row returned
+        cursor, rows = service.open_training_page(elevator_id=1, limit=2)
+        last = list(rows)[-1]
+        assert elevator_api.decode_training_cursor(cursor)[:2] == [timestamps.to_ms(last['rest_start_time']), 1]
+        assert [r for page in pages for r in page] == service.get_ml_training_data(elevator_id=1)
+        assert service.count_ml_training_data(elevator_id=1) == 7
+        with pytest.raises(ValueError, match="Invalid cursor"):
+            service.get_ml_training_data(after='not-a-cursor')
+
+    #Change feed: new and recomputed samples after a watermark, consumer offsets survive a restart
+    def test_training_changes_feed(self, service):
+        start = datetime(2025, 1, 13, 7, 0)
+        for i in range(5):
+            service.record_elevator_state(1, 3, 'resting', timestamp=start + timedelta(minutes=2 * i))
+            service.record_demand(1, 5, start + timedelta(minutes=2 * i + 1))
+        first = service.get_training_changes('0', limit=3)
+        assert [row['seq'] for row in first['data']] == [1, 2, 3]
+        assert first['has_more'] and first['next_watermark'] == '3'
+        rest = service.get_training_changes(first['next_watermark'], limit=3)
+        assert len(rest['data']) == 2 and not rest['has_more']
+        assert service.get_training_changes(rest['next_watermark'])['data'] == []
+
+        #a backfilled rest takes over the first demand, the sample it replaces comes back with a new seq
+        service.record_elevator_state(1, 8, 'resting', timestamp=start + timedelta(seconds=30))
+        changes = service.get_training_changes(rest['next_watermark'])
+        assert [row['rest_start_time'] for row in changes['data']] == ['2025-01-13T07:00:30']
+        assert changes['data'][0]['seq'] == 6
+        assert service.get_training_changes('0', elevator_id=2) == {'data': [], 'next_watermark': '6', 'has_more': False}
+
+        service.commit_consumer_offset('trainer', changes['next_watermark'])
+        reopened = ElevatorDataService(service.db_path)
+        assert reopened.get_consumer_offset('trainer')['watermark'] == '6'
+        assert [consumer['name'] for consumer in reopened.list_consumers()] == ['trainer']
+        reopened.close()
+        assert service.delete_consumer('trainer') and service.get_consumer_offset('trainer') is None
+        with pytest.raises(ValueError, match="Invalid watermark"):
+            service.get_training_changes('abc')
+
+    #Heartbeats past the raw window collapse into intervals, training data keeps matching a rebuild,
+    #then intervals become hourly time per state
+    def test_state_compaction_tiers(self, service):
+        from app.compaction import RetentionPolicy, StateCompactor
+        start = datetime(2025, 1, 13, 7, 0)
+        for minute in (0, 1, 2):
+            service.record_elevator_state(1, 3, 'resting', timestamp=start + timedelta(minutes=minute))
+        service.record_demand(1, 5, start + timedelta(minutes=2, seconds=30))
+        service.record_elevator_state(1, 5, 'moving', timestamp=start + timedelta(minutes=3), previous_floor=3)
+        for minute in (5, 6):
+            service.record_elevator_state(1, 5, 'resting', timestamp=start + timedelta(minutes=minute))
+        service.record_demand(1, 1, start + timedelta(minutes=7))
+        assert service.count_ml_training_data() == 5
+
+        compactor = StateCompactor(service, RetentionPolicy(raw_days=7, interval_days=14), chunk_size=2, pause=0)
+        result = compactor.run_once(now=start + timedelta(days=10))
+        assert (result['raw_rows_compacted'], result['intervals_created']) == (6, 3)
+        conn = service.get_connection()
+        assert conn.execute("SELECT COUNT(*) FROM elevator_states").fetchone()[0] == 0
+        assert [tuple(row) for row in conn.execute("SELECT state, floor, report_count FROM elevator_state_intervals ORDER BY start_time")] \
+            == [('resting', 3, 3), ('moving', 5, 1), ('resting', 5, 2)]
+        conn.close()
+        compacted = service.get_ml_training_data()
+        assert [row['rest_start_time'] for row in compacted] == ['2025-01-13T07:00:00', '2025-01-13T07:05:00']
+        service.rebuild_ml_training_data()
+        assert service.get_ml_training_data() == compacted
+        conn = service.get_connection()
+        sketches = dict(((row[0], row[1]), row[2]) for row in conn.execute("SELECT hour_bucket, metric, sketch FROM elevator_sketches"))
+        conn.close()
+        service.rebuild_sketches()
+        conn = service.get_connection()
+        assert dict(((row[0], row[1]), row[2]) for row in conn.execute("SELECT hour_bucket, metric, sketch FROM elevator_sketches")) == sketches
+        conn.close()
+
+        result = compactor.run_once(now=start + timedelta(days=20))
+        assert result['intervals_rolled_up'] == 3
+        conn = service.get_connection()
+        hourly = {(row['state'], row['floor']): (row['duration_ms'], row['report_count'])
+                  for row in conn.execute("SELECT * FROM elevator_state_hourly")}
+        conn.close()
+        assert hourly == {('resting', 3): (3 * 60000, 3), ('moving', 5): (2 * 60000, 1), ('resting', 5): (60000, 2)}
+
+        assert compactor.vacuum()['full'] == []  #test schema predates auto_vacuum, only a full VACUUM converts it
+        assert compactor.vacuum(full=True)['full'] == [service.db_path]
+        conn = service.get_connection()
+        assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+        conn.close()
+
+    #Sketch quantiles stay within the relative error of exact ones, also after merging and removing
+    def test_quantile_sketch_accuracy(self):
+        import random
+        from app.sketches import RELATIVE_ACCURACY, FloorSet, QuantileSketch
+        rng = random.Random(7)
+        values = [rng.expovariate(1 / 12) for _ in range(5000)] + [0.0] * 50
+        parts = [QuantileSketch() for _ in range(4)]
+        for i, value in enumerate(values):
+            parts[i % 4].add(value)
+        merged = QuantileSketch.from_bytes(parts[0].to_bytes())
+        for part in parts[1:]:
+            merged.merge(QuantileSketch.from_bytes(part.to_bytes()))
+        merged.add(999.0)
+        merged.remove(999.0)
+        exact = sorted(values)
+        assert merged.count == len(values)
+        for q in (0.0, 0.5, 0.95, 0.99, 1.0):
+            expected = exact[int(q * (len(exact) - 1))]
+            assert abs(merged.quantile(q) - expected) <= RELATIVE_ACCURACY * expected + 1e-9
+        assert len(merged.to_bytes()) < 2000
+        floors = FloorSet()
+        for floor in (-2, 0, 3, 3, 40):
+            floors.add(floor)
+        assert FloorSet.from_bytes(floors.to_bytes()).floors() == [-2, 0, 3, 40]
+
+    #Sketches kept on every write match a rebuild and give the exact percentiles of few samples
+    def test_demand_percentiles(self, service):
+        start = datetime.now().replace(minute=0, second=0, microsecond=0) - timedelta(days=1)
+        for i, wait in enumerate((1, 2, 4, 8)):
+            rest = start + timedelta(minutes=20 * i)
+            service.record_elevator_state(1, 2, 'resting', timestamp=rest)
+            service.record_demand(1, 3 + i, rest + timedelta(minutes=wait))
+            service.record_elevator_state(1, 3 + i, 'moving', timestamp=rest + timedelta(minutes=wait), previous_floor=2)
+        service.record_elevator_states_batch([{'elevator_id': 1, 'floor': 9, 'state': 'resting', 'timestamp': (start + timedelta(hours=2)).isoformat()},
+                                              {'elevator_id': 1, 'floor': 9, 'state': 'occupied', 'timestamp': (start + timedelta(hours=2, minutes=10)).isoformat()}])
+        result = service.get_demand_percentiles(1, days=7)
+        assert result['wait_minutes']['count'] == 4
+        assert result['wait_minutes']['quantiles']['p50'] == pytest.approx(2, rel=0.01)
+        assert result['wait_minutes']['quantiles']['p99'] == pytest.approx(4, rel=0.01)  #lower of the two closest ranks
+        assert result['idle_minutes']['count'] == 5
+        assert result['idle_minutes']['quantiles']['p99'] == pytest.approx(8, rel=0.01)
+        assert result['distinct_floors'] == 4
+
+        service.rebuild_sketches()
+        assert service.get_demand_percentiles(1, days=7) == result
+        by_hour = service.get_demand_percentiles(1, days=7, quantiles=[0.5], group_by='hour_of_day')
+        assert [group['hour_of_day'] for group in by_hour['groups']] == [start.hour, (start.hour + 1) % 24, (start.hour + 2) % 24]
+        assert sum(group['wait_minutes']['count'] for group in by_hour['groups']) == 4
+        with pytest.raises(ValueError):
+            service.get_demand_percentiles(1, group_by='floor')
+
+    #Columnar export gives one typed array per feature
+    def test_training_arrays_export(self, service, tmp_path):
+        np = pytest.importorskip('numpy')
+        start = datetime(2025, 1, 13, 8, 0)
+        for i in range(5):
+            service.record_elevator_state(1, i + 1, 'resting', timestamp=start + timedelta(minutes=2 * i))
+            service.record_demand(1, 10 - i, start + timedelta(minutes=2 * i + 1))
+        arrays = service.get_training_arrays(elevator_id=1, chunk_size=2)
+        assert arrays['current_resting_floor'].dtype == np.int16
+        assert arrays['current_resting_floor'].tolist() == [1, 2, 3, 4, 5]
+        assert arrays['distance_to_demand'].tolist() == [9, 7, 5, 3, 1]
+        assert arrays['is_peak_hour'].all()
+        assert arrays['rest_start_time'][0] == np.datetime64('2025-01-13T08:00')
+
+        from app import columnar
+        info = columnar.write_npy_dir(arrays, str(tmp_path))
+        assert info['rows'] == 5
+        mapped = np.load(tmp_path / 'minutes_until_demand.npy', mmap_mode='r')
+        assert mapped.tolist() == [1.0] * 5
+
+    #Rollups are kept in step with single and batch inserts and match a rebuild
+    def test_demand_rollups(self, service):
+        service.create_building('Tower', 10, building_id=1)
+        service.create_elevator(1, 'Second', 1, 10, elevator_id=2)
+        now = datetime.now()
+        service.record_demand(1, 4, now - timedelta(hours=3))
+        service.record_demands_batch([{'elevator_id': 1, 'requested_floor': 4, 'request_time': (now - timedelta(hours=3)).isoformat()},
+                                      {'elevator_id': 1, 'requested_floor': 6, 'request_time': (now - timedelta(minutes=5)).isoformat()},
+                                      {'elevator_id': 2, 'requested_floor': 6, 'request_time': now.isoformat()}])
+        analytics = service.get_demand_analytics(1, days=1)
+        assert analytics['floor_popularity'] == [{'requested_floor': 4, 'demand_count': 2}, {'requested_floor': 6, 'demand_count': 1}]
+        assert sum(p['total_demands'] for p in analytics['peak_hour_analysis']) == 3
+
+        conn = service.get_connection()
+        before = conn.execute("SELECT * FROM demand_hourly_rollups ORDER BY 1, 2, 3").fetchall()
+        service.rebuild_demand_rollups()
+        after = conn.execute("SELECT * FROM demand_hourly_rollups ORDER BY 1, 2, 3").fetchall()
+        conn.close()
+        assert [tuple(r) for r in before] == [tuple(r) for r in after]
+
+        heatmap = service.get_demand_heatmap(1, days=1)
+        assert heatmap['floors'] == [4, 6]
+        assert heatmap['counts'][0][(now - timedelta(hours=3)).hour] == 2
+        compare = service.compare_elevators([1, 2], days=1)
+        assert [(e['elevator_id'], e['total_demands'], e['top_floor']) for e in compare['elevators']] == [(1, 3, 4), (2, 1, 6)]
+
+    #Window start in the middle of an hour only counts events after it
+    def test_demand_analytics_partial_hour(self, service):
+        service.record_demand(1, 2, datetime.now() - timedelta(days=1, minutes=-30))
+        service.record_demand(1, 3, datetime.now() - timedelta(days=1, minutes=30))
+        analytics = service.get_demand_analytics(1, days=1)
+        assert analytics['floor_popularity'] == [{'requested_floor': 2, 'demand_count': 1}]
+
+    #Online model picks the weighted median floor of the current bucket
+    def test_recommended_resting_floor(self, service):
+        monday_8am = datetime(2025, 1, 13, 8, 10)
+        assert service.recommend_resting_floor(1, monday_8am)['source'] == 'none'
+        for floor in [1, 1, 1, 2, 9]:
+            service.record_demand(1, floor, monday_8am - timedelta(minutes=floor))
+        service.record_demands_batch([{'elevator_id': 1, 'requested_floor': 7, 'request_time': '2025-01-13T22:00:00'}] * 10)
+        result = service.recommend_resting_floor(1, monday_8am)
+        assert result['source'] == 'hour'
+        assert result['recommended_floor'] == 1
+        assert result['expected_distance'] == pytest.approx((1 + 8) / 5, rel=1e-2)
+        #late evening bucket is driven by the batch
+        assert service.recommend_resting_floor(1, datetime(2025, 1, 13, 22, 30))['recommended_floor'] == 7
+        #a fresh service warms the same model from the rollups
+        warmed = ElevatorDataService(service.db_path)
+        warmed.predictor.warm_days = 100000
+        conn = warmed.get_connection()
+        warmed.predictor.warm(conn)
+        conn.close()
+        assert warmed.recommend_resting_floor(1, monday_8am)['recommended_floor'] == 1
+        warmed.close()
+        #far away times neither overflow nor divide by a decayed-to-zero scale
+        far_future = service.recommend_resting_floor(1, datetime(9999, 1, 4, 8, 10))
+        assert far_future['effective_demands'] == 0 and far_future['recommended_floor'] is not None
+        assert service.recommend_resting_floor(1, datetime(1970, 1, 5, 8, 10))['source'] == 'hour'
+        #a mistyped future year is not learned from and leaves the model as it was
+        service.record_demand(1, 9, datetime(2099, 1, 12, 8, 10))
+        assert service.predictor.skipped_future == 1
+        assert service.recommend_resting_floor(1, monday_8am) == result
+
+    #Optimizer scores every floor per bucket and compares with where the elevator really rested
+    def test_epoch_ms_migration(self, tmp_path):
+        #database written before the migration: datetime text and no user_version
+        path = str(tmp_path / 'legacy.db')
+        conn = sqlite3.connect(path)
+        conn.executescript("""
+            CREATE TABLE elevators (id INTEGER PRIMARY KEY, building_id INTEGER NOT NULL, name VARCHAR(50) NOT NULL,
+                min_floor INTEGER NOT NULL DEFAULT 1, max_floor INTEGER NOT NULL);
+            CREATE TABLE demand_events (id INTEGER PRIMARY KEY, elevator_id INTEGER NOT NULL, requested_floor INTEGER NOT NULL,
+                request_time TIMESTAMP NOT NULL, day_of_week INTEGER NOT NULL, hour_of_day INTEGER NOT NULL,
+                is_peak_hour BOOLEAN NOT NULL DEFAULT FALSE);
+            CREATE TABLE elevator_states (id INTEGER PRIMARY KEY, elevator_id INTEGER NOT NULL, floor INTEGER NOT NULL,
+                state VARCHAR(20) NOT NULL, passenger_count INTEGER DEFAULT 0, timestamp TIMESTAMP NOT NULL, previous_floor INTEGER);
+            CREATE INDEX ind_demand_events_elevator_time ON demand_events(elevator_id, request_time);
+            INSERT INTO elevators VALUES (1, 1, 'Main', 1, 10);
+            INSERT INTO elevator_states (elevator_id, floor, state, timestamp) VALUES (1, 3, 'resting', '2025-01-13 07:00:00');
+            INSERT INTO demand_events (elevator_id, requested_floor, request_time, day_of_week, hour_of_day, is_peak_hour)
+                VALUES (1, 8, '2025-01-13 07:01:30.250000', 0, 7, 1);
+        """)
+        conn.commit()
+        conn.close()
+
+        service = ElevatorDataService(path)
+        conn = service.get_connection()
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == elevator_api.SCHEMA_VERSION
+        assert conn.execute("SELECT typeof(request_time), request_time FROM demand_events").fetchone()[:] == ('integer', 1736751690250)
+        assert conn.execute("SELECT typeof(timestamp) FROM elevator_states").fetchone()[0] == 'integer'
+        plan = ' '.join(row[3] for row in conn.execute(
+            "EXPLAIN QUERY PLAN SELECT id FROM demand_events WHERE elevator_id = 1 AND request_time > 0"))
+        assert 'ind_demand_events_elevator_time' in plan
+        conn.close()
+        [sample] = service.get_ml_training_data()
+        assert sample['rest_start_time'] == '2025-01-13T07:00:00'
+        assert sample['next_demand_time'] == '2025-01-13T07:01:30.250'
+        assert sample['minutes_until_demand'] == 1.5 + 0.25 / 60
+        service.close()
+
+    #Up to date files skip every migration step, importing the API module opens nothing
+    def test_migrations_only_run_when_pending(self, service, tmp_path):
+        conn = service.get_connection()
+        conn.execute("PRAGMA user_version = 1")
+        conn.close()
+        assert service.migrate(1) == [elevator_api.DERIVED_TABLES_VERSION, elevator_api.SCHEMA_VERSION]
+        with patch.object(ElevatorDataService, 'migrate', side_effect=AssertionError('migrated again')):
+            ElevatorDataService(service.db_path).close()
+
+        import subprocess
+        code = ("import os, sys; sys.path.insert(0, sys.argv[1]); from app import elevator_api; "
+                "assert not elevator_api.service.opened; assert not os.path.exists(elevator_api.DATABASE)")
+        subprocess.run([sys.executable, '-c', code, os.getcwd()], cwd=tmp_path, check=True)
+        #nor do the env configured background workers, they start with the service
+        code += ("; assert elevator_api.ingest_queue is None and elevator_api.gateway is None"
+                 "; elevator_api.warm_up(); assert elevator_api.ingest_queue and elevator_api.gateway.sockets"
+                 "; elevator_api.create_app(); assert elevator_api.ingest_queue is None and elevator_api.gateway is None")
+        env = dict(os.environ, ELEVATOR_INGEST_MODE='async', ELEVATOR_GATEWAY='tcp://127.0.0.1:0')
+        subprocess.run([sys.executable, '-c', code, os.getcwd()], cwd=tmp_path, env=env, check=True)
+
+    #CRUD keeps the in-memory registry current, ingest validates from it without reading elevators
+    def test_elevator_registry(self, service):
+        building = service.create_building('Annex', 12, building_id=5)
+        elevator = service.create_elevator(building['id'], 'Freight', -2, 12, max_capacity=20)
+        assert service.get_building(building['id'])['elevator_ids'] == [elevator['id']]
+        assert service.registry.get(elevator['id'])['min_floor'] == -2
+        with pytest.raises(ValueError, match='not found'):
+            service.create_elevator(99, 'Nowhere', 1, 5)
+        with pytest.raises(ValueError, match='min_floor'):
+            service.update_elevator(elevator['id'], {'min_floor': 13})
+        service.update_elevator(elevator['id'], {'max_floor': 8})
+        with pytest.raises(ValueError, match='out of bounds'):
+            service.record_demand(elevator['id'], 10)
+        with pytest.raises(ValueError, match='Elevator 77 not found'):
+            service.record_demand(77, 1)
+
+        #no query against elevators on the hot paths
+        statements = []
+        conn = service.get_connection()
+        conn.set_trace_callback(statements.append)
+        service.record_demand(elevator['id'], -1, datetime(2025, 1, 13, 8, 0))
+        service.record_elevator_state(elevator['id'], 3, 'resting', timestamp=datetime(2025, 1, 13, 8, 5))
+        service.record_elevator_states_batch([{'elevator_id': elevator['id'], 'floor': 4, 'state': 'moving_up'},
+                                              {'elevator_id': 1, 'floor': 2, 'state': 'resting'}])
+        conn.set_trace_callback(None)
+        conn.close()
+        assert statements and not [sql for sql in statements if 'FROM elevators' in sql]
+
+        #changes made by another process show up once the registry version is rechecked
+        conn = service.get_connection()
+        conn.execute("UPDATE elevators SET max_floor = 20 WHERE id = ?", (elevator['id'],))
+        conn.execute("UPDATE registry_version SET version = version + 1")
+        conn.commit()
+        conn.close()
+        assert service.registry.get(elevator['id'])['max_floor'] == 8
+        service.registry.recheck = 0
+        assert service.registry.get(elevator['id'])['max_floor'] == 20
+
+        with pytest.raises(ValueError, match='recorded events'):
+            service.delete_elevator(elevator['id'])
+        with pytest.raises(ValueError, match='still has elevators'):
+            service.delete_building(building['id'])
+        empty = service.create_elevator(building['id'], 'Spare', 1, 5)
+        assert service.delete_elevator(empty['id']) and service.registry.get(empty['id']) is None
+        assert not service.delete_elevator(empty['id'])
+
+        #unknown ids are looked up once per registry version
+        service.registry.recheck = 60
+        lookups = []
+        original_get = service.registry.pool.get
+        with patch.object(service.registry.pool, 'get', lambda: lookups.append(1) or original_get()):
+            for _ in range(3):
+                with pytest.raises(ValueError, match='Elevator 78 not found'):
+                    service.record_demand(78, 1)
+            assert service.registry.bounds([78, elevator['id']]).keys() == {elevator['id']}
+        assert len(lookups) == 1
+        conn = service.get_connection()
+        conn.execute("INSERT INTO elevators (id, building_id, name, min_floor, max_floor) VALUES (78, ?, 'Late', 1, 5)",
+                     (building['id'],))
+        conn.execute("UPDATE registry_version SET version = version + 1")
+        conn.commit()
+        conn.close()
+        service.registry.recheck = 0
+        assert service.registry.get(78)['name'] == 'Late'
+
+    def test_gateway_listener(self, service):
+        import socket
+        from app import gateway
+        monday = timestamps.to_ms(datetime(2025, 1, 13, 8, 0))
+        records = [(1, gateway.STATE, elevator_api.VALID_STATES.index('resting'), 3, gateway.NO_FLOOR, 0, monday),
+                   (1, gateway.DEMAND, 0, 1, gateway.NO_FLOOR, 0, monday + 60_000),
+                   (1, gateway.STATE, elevator_api.VALID_STATES.index('moving'), 1, 3, 0, monday + 90_000),
+                   (1, gateway.DEMAND, 0, 11, gateway.NO_FLOOR, 0, monday),  #out of bounds
+                   (42, gateway.DEMAND, 0, 1, gateway.NO_FLOOR, 0, monday),  #unknown elevator
+                   (1, gateway.DEMAND, 0, 1, gateway.NO_FLOOR, 0, 2 ** 62)]  #no datetime can hold it
+        payload = gateway.encode_records(records)
+        decoded = gateway._decode_struct(payload, service.registry.bounds)
+        assert decoded[0] == [(1, 1, monday + 60_000, 0, 8, True)]
+        assert decoded[1][1] == (1, 1, 'moving', 0, monday + 90_000, 3) and decoded[2] == 3
+        if gateway.np is not None:
+            assert gateway._decode_numpy(payload, service.registry.bounds) == decoded
+        with pytest.raises(ValueError, match='whole number'):
+            gateway.decode_frame(payload[:-1], service.registry.bounds)
+
+        listener = gateway.GatewayListener(service, ['tcp://127.0.0.1:0']).start()
+        try:
+            sock = socket.create_connection(listener.sockets[0][:2], timeout=10)
+            sock.sendall(gateway.encode_frame(payload) + gateway.encode_frame(b''))
+            acks = b''
+            while len(acks) < 2 * gateway.ACK_STRUCT.size:
+                acks += sock.recv(64)
+            assert list(gateway.ACK_STRUCT.iter_unpack(acks)) == [(3, 3), (0, 0)]
+            #not a whole number of records, the listener hangs up
+            sock.sendall(gateway.FRAME_HEADER.pack(7) + b'x' * 7)
+            assert sock.recv(64) == b''
+            sock.close()
+            stats = listener.metrics()
+            assert (stats['frames'], stats['accepted'], stats['rejected'], stats['protocol_errors']) == (2, 3, 3, 1)
+        finally:
+            listener.stop()
+        assert service.count_ml_training_data() == 1
+        conn = service.get_connection()
+        rows = conn.execute("SELECT state, previous_floor FROM elevator_states ORDER BY timestamp").fetchall()
+        conn.close()
+        assert [tuple(row) for row in rows] == [('resting', None), ('moving', 3)]
+
+        #a frame whose demands fail to store leaves none of its states behind
+        def fail(*args):
+            raise sqlite3.OperationalError('disk I/O error')
+        service._after_demand_batch = fail
+        listener = gateway.GatewayListener(service)
+        with pytest.raises(sqlite3.OperationalError):
+            listener.store_frame(payload)
+        conn = service.get_connection()
+        assert conn.execute("SELECT COUNT(*) FROM elevator_states").fetchone()[0] == 2
+        conn.close()
+
+        #once committed a frame is acknowledged as stored, even when the in-memory updates after it fail
+        del service._after_demand_batch
+        service.hot.add = fail
+        assert listener.store_frame(gateway.encode_records(records[1:2])) == (1, 0)
+        listener.stop()
+
+    def test_hot_store(self, service):
+        from app.hotstore import HotStore
+        #room for 3 demands: the oldest is overwritten and the window says so
+        store = HotStore(elevator_api.VALID_STATES, window_hours=1, budget_bytes=2 * 3 * 21)
+        now = timestamps.to_ms(datetime(2025, 1, 13, 8, 0))
+        store.add('demand', [{'demand_id': i, 'elevator_id': 1, 'requested_floor': floor, 'is_peak_hour': True,
+                              'timestamp': timestamps.to_iso(now - (4 - i) * 60_000)} for i, floor in enumerate([5, 2, 2, 7])],
+                  now_ms=now)
+        result = store.demand_analytics(1, 1, now_ms=now)
+        assert result['floor_popularity'] == [{'requested_floor': 2, 'demand_count': 2},
+                                              {'requested_floor': 7, 'demand_count': 1}]
+        assert result['peak_hour_analysis'] == [{'is_peak_hour': 1, 'avg_hour': 7.0, 'total_demands': 3}]
+        assert not result['complete'] and store.demand_analytics(1, 0.04, now_ms=now)['complete']
+        assert [demand['demand_id'] for demand in store.current(1, 2)['recent_demands']] == [3, 2]
+        with pytest.raises(ValueError, match='at most 1'):
+            store.demand_analytics(1, 2, now_ms=now)
+
+        long_ago = datetime.now() - timedelta(days=2)
+        service.record_elevator_state(1, 4, 'resting', timestamp=long_ago)
+        service.record_elevator_state(1, 4, 'moving', timestamp=datetime.now() - timedelta(minutes=3))
+        service.record_demands_batch([{'elevator_id': 1, 'requested_floor': 9},
+                                      {'elevator_id': 1, 'requested_floor': 9}])
+        service.record_elevator_state(1, 9, 'occupied', passenger_count=2, previous_floor=4)
+        current = service.get_current(1)
+        assert (current['current_state']['floor'], current['current_state']['state']) == (9, 'occupied')
+        assert [state['state'] for state in current['recent_states']] == ['occupied', 'moving']
+        assert service.get_recent_demand_analytics(1, 1)['floor_popularity'] == [{'requested_floor': 9, 'demand_count': 2}]
+        assert service.get_current(42) is None
+
+        #a new process warms up from the database, an elevator resting for days still has its state
+        conn = service.get_connection()
+        conn.execute("INSERT INTO elevators (id, building_id, name, min_floor, max_floor) VALUES (2, 1, 'Second', 1, 10)")
+        conn.commit()
+        conn.close()
+        service.record_elevator_state(2, 6, 'resting', timestamp=long_ago)
+        reopened = ElevatorDataService(service.db_path)
+        try:
+            assert reopened.get_current(1) == service.get_current(1)
+            assert reopened.get_current(2)['current_state']['floor'] == 6
+            assert reopened.get_hot_metrics()['demands'] == 2
+        finally:
+            reopened.close()
+
+    def test_resting_floor_optimizer(self, service):
+        pytest.importorskip('numpy')
+        monday = datetime(2025, 1, 13, 8, 0)
+        for i, target in enumerate([1, 1, 2, 1]):
+            service.record_elevator_state(1, 5, 'resting', timestamp=monday + timedelta(minutes=10 * i))
+            service.record_demand(1, target, monday + timedelta(minutes=10 * i + 1))
+        #a busy call, not the first after a rest, doesn't count
+        service.record_demand(1, 10, monday + timedelta(minutes=35))
+        result = service.optimize_resting_floors(1, datetime(2025, 1, 1), datetime(2025, 2, 1),
+            what_if={'floor': 1, 'days_of_week': [0, 1, 2, 3, 4], 'hours': [7, 8]})
+        bucket = result['buckets'][0]
+        assert (bucket['day_of_week'], bucket['hour_of_day'], bucket['calls']) == (0, 8, 4)
+        assert bucket['best_floor'] == 1
+        assert bucket['best_expected_distance'] == 0.25
+        assert bucket['actual_expected_distance'] == 3.75
+        assert bucket['expected_distance_by_floor'][:3] == [0.25, 0.75, 1.75]
+        assert result['what_if'] == {'floor': 1, 'calls': 4.0, 'policy_travel': 1.0, 'idle_calls': 4.0,
+                                     'idle_policy_travel': 1.0, 'actual_travel': 15.0,
+                                     'saved_travel': 14.0, 'saved_wait_seconds': 21.0}
+        #counting busy calls too changes the policy's total travel but not what it is compared on
+        conn = service.get_connection()
+        try:
+            history = optimizer.load_history(conn, 1, datetime(2025, 1, 1), datetime(2025, 2, 1))
+        finally:
+            conn.close()
+        every_call = optimizer.optimize(history, 1, 10, idle_only=False)
+        compared = optimizer.what_if(every_call, 1, [8])
+        assert (compared['calls'], compared['policy_travel']) == (5.0, 10.0)
+        assert compared['saved_travel'] == 14.0
+        totals = optimizer.summarize(every_call)['totals']
+        assert (totals['calls'], totals['idle_calls'], totals['saved_travel']) == (5, 4, 14.0)
+
 
 
 class TestAPIEndpoints:
@@ -232,6 +802,7 @@ class TestAPIEndpoints:
     def test_training_data_endpoint(self, mock_service, client):
         mock_service.get_ml_training_data.return_value = [{'current_resting_floor': 3,
                 'next_demand_floor': 7, 'distance_to_demand': 4, 'is_peak_hour': 1,'minutes_until_demand': 5.2}]
+        mock_service.versions = WriteVersions()
         response = client.get('/training-data?elevator_id=1')
         
         assert response.status_code == 200
@@ -239,6 +810,173 @@ class TestAPIEndpoints:
         assert data['count'] == 1
         assert len(data['data']) == 1
         assert data['data'][0]['distance_to_demand'] == 4
+    #Repeat reads come from the cache, re-polls with the ETag get 304, writes invalidate per elevator
+    @patch('app.elevator_api.service')
+    def test_analytics_cache_and_etag(self, mock_service, client, monkeypatch):
+        from app.cache import ResponseCache
+        monkeypatch.setattr(elevator_api, 'response_cache', ResponseCache(ttl=3600))
+        mock_service.versions = WriteVersions()
+        mock_service.get_demand_analytics.return_value = {'elevator_id': 1, 'floor_popularity': []}
+        first = client.get('/elevators/1/analytics?days=7')
+        etag = first.headers['ETag']
+        assert first.status_code == 200 and 'Last-Modified' in first.headers
+        assert client.get('/elevators/1/analytics?days=7').headers['ETag'] == etag
+        assert mock_service.get_demand_analytics.call_count == 1
+        response = client.get('/elevators/1/analytics?days=7', headers={'If-None-Match': etag})
+        assert response.status_code == 304 and response.data == b''
+
+        mock_service.versions.bump([2])
+        assert client.get('/elevators/1/analytics?days=7', headers={'If-None-Match': etag}).status_code == 304
+        mock_service.versions.bump([1])
+        response = client.get('/elevators/1/analytics?days=7', headers={'If-None-Match': etag})
+        assert response.status_code == 200 and response.headers['ETag'] != etag
+        assert mock_service.get_demand_analytics.call_count == 2
+        stats = client.get('/cache/metrics').get_json()
+        assert (stats['hits'], stats['misses'], stats['not_modified']) == (1, 2, 2)
+    #writes from other processes never bump the in-memory versions, the ttl window bounds how long they go unseen
+    def test_etags_expire_without_local_writes(self, monkeypatch):
+        from app import cache
+        response_cache = cache.ResponseCache(ttl=30)
+        versions = WriteVersions()
+        monkeypatch.setattr(cache.time, 'time', lambda: 1000.0)
+        etag, modified = response_cache.validators(versions, ('training-data', None))
+        monkeypatch.setattr(cache.time, 'time', lambda: 1019.0)
+        assert response_cache.validators(versions, ('training-data', None)) == (etag, modified)
+        monkeypatch.setattr(cache.time, 'time', lambda: 1021.0)
+        later, later_modified = response_cache.validators(versions, ('training-data', None))
+        assert later != etag and later_modified >= modified
+        assert not response_cache.not_modified(later, later_modified, if_none_match=f'"{etag}"')
+
+        #If-Modified-Since has whole seconds: a write at 1030.7 is newer than a client's "1030"
+        from email.utils import formatdate
+        response_cache = cache.ResponseCache(ttl=0)
+        monkeypatch.setattr(cache.time, 'time', lambda: 1030.7)
+        versions = WriteVersions()
+        versions.bump([1])
+        monkeypatch.setattr(cache.time, 'time', lambda: 1030.9)
+        etag, modified = response_cache.validators(versions, ('analytics', 1), 1)
+        assert modified == 1030.7 and not response_cache.not_modified(etag, modified, if_modified_since=formatdate(1030, usegmt=True))
+        #once that second is over the date is rounded up, so an unchanged result still gets its 304
+        monkeypatch.setattr(cache.time, 'time', lambda: 1032.0)
+        etag, modified = response_cache.validators(versions, ('analytics', 1), 1)
+        assert modified == 1031.0 and response_cache.not_modified(etag, modified, if_modified_since=formatdate(1031, usegmt=True))
+    @patch('app.elevator_api.service')
+    def test_percentiles_endpoint(self, mock_service, client):
+        mock_service.versions = WriteVersions()
+        mock_service.get_demand_percentiles.return_value = {'elevator_id': 1, 'wait_minutes': {'count': 0}}
+        response = client.get('/elevators/1/analytics/percentiles?days=30&quantiles=0.5,0.9&group_by=hour_of_day')
+        assert response.status_code == 200 and 'ETag' in response.headers
+        mock_service.get_demand_percentiles.assert_called_once_with(1, 30, (0.5, 0.9), 'hour_of_day')
+        assert client.get('/elevators/1/analytics/percentiles?quantiles=abc').status_code == 400
+    @patch('app.elevator_api.service')
+    def test_registry_endpoints(self, mock_service, client):
+        mock_service.create_building.return_value = {'id': 3, 'name': 'Annex', 'total_floors': 12, 'elevator_ids': []}
+        response = client.post('/buildings', json={'name': 'Annex', 'total_floors': 12})
+        assert response.status_code == 201
+        mock_service.create_building.assert_called_with('Annex', 12, None)
+        mock_service.create_elevator.side_effect = ValueError('Building 9 not found')
+        response = client.post('/elevators', json={'building_id': 9, 'name': 'A', 'max_floor': 5})
+        assert response.status_code == 400
+        assert response.get_json()['error'] == 'Building 9 not found'
+        mock_service.update_elevator.return_value = None
+        assert client.patch('/elevators/5', json={'max_floor': 8}).status_code == 404
+        mock_service.update_elevator.assert_called_with(5, {'max_floor': 8})
+        mock_service.list_elevators.return_value = [{'id': 1}]
+        assert client.get('/elevators?building_id=3').get_json() == {'elevators': [{'id': 1}]}
+        mock_service.list_elevators.assert_called_with(3)
+        mock_service.delete_building.return_value = True
+        assert client.delete('/buildings/3').status_code == 204
+
+    @patch('app.elevator_api.service')
+    def test_hot_store_endpoints(self, mock_service, client):
+        mock_service.get_current.return_value = None
+        assert client.get('/elevators/7/current?limit=3').status_code == 404
+        mock_service.get_current.assert_called_with(7, 3)
+        mock_service.get_recent_demand_analytics.side_effect = ValueError('hours must be above 0 and at most 6')
+        response = client.get('/elevators/1/analytics?hours=12')
+        assert response.status_code == 400
+        mock_service.get_recent_demand_analytics.assert_called_with(1, 12.0)
+        mock_service.get_demand_analytics.assert_not_called()
+
+    @patch('app.elevator_api.service')
+    def test_demand_batch_endpoint(self, mock_service, client):
+        mock_service.record_demands_batch.return_value = {'accepted': 1, 'rejected': 1,
+            'results': [{'index': 0, 'demand_id': 1}, {'index': 1, 'error': 'requested_floor is required'}]}
+        response = client.post('/elevators/demand/batch', json=[{'elevator_id': 1, 'requested_floor': 2}, {'elevator_id': 1}])
+        assert response.status_code == 207
+        #Empty batch is rejected before touching the service
+        response = client.post('/elevators/state/batch', json=[])
+        assert response.status_code == 400
+    @patch('app.elevator_api.service')
+    def test_training_data_streaming(self, mock_service, client):
+        rows = [{'elevator_id': 1, 'current_resting_floor': 3, 'next_demand_floor': 7}, {'elevator_id': 1, 'current_resting_floor': 2, 'next_demand_floor': 1}]
+        mock_service.open_training_page.return_value = ('abc', iter(rows))
+        response = client.get('/training-data?elevator_id=1&format=ndjson&limit=2')
+        assert response.status_code == 200
+        assert response.headers['X-Next-Cursor'] == 'abc'
+        lines = response.data.decode().splitlines()
+        assert [json.loads(line) for line in lines] == rows
+
+        mock_service.open_training_page.return_value = (None, iter(rows))
+        response = client.get('/training-data?format=csv')
+        lines = response.data.decode().splitlines()
+        assert lines[0].startswith('elevator_id,current_resting_floor,rest_start_time')
+        assert len(lines) == 3
+    @patch('app.elevator_api.service')
+    def test_training_changes_endpoint(self, mock_service, client):
+        mock_service.get_training_changes.return_value = {'data': [{'seq': 4, 'elevator_id': 1}], 'next_watermark': '4', 'has_more': False}
+        mock_service.get_consumer_offset.return_value = {'name': 'trainer', 'watermark': '3', 'updated_at': '2025-01-15T08:30:00'}
+        response = client.get('/training-data/changes?consumer=trainer&limit=10')
+        assert response.status_code == 200
+        assert json.loads(response.data)['next_watermark'] == '4'
+        mock_service.get_training_changes.assert_called_with('3', 10, None)
+        client.get('/training-data/changes?since=2&consumer=trainer')
+        mock_service.get_training_changes.assert_called_with('2', 1000, None)
+
+        mock_service.commit_consumer_offset.return_value = {'name': 'trainer', 'watermark': '4', 'updated_at': '2025-01-15T08:31:00'}
+        response = client.put('/training-data/consumers/trainer', json={'watermark': '4'})
+        assert response.status_code == 200
+        mock_service.commit_consumer_offset.assert_called_with('trainer', '4')
+        assert client.put('/training-data/consumers/trainer', json={}).status_code == 400
+        mock_service.delete_consumer.return_value = False
+        assert client.delete('/training-data/consumers/nobody').status_code == 404
+    @patch('app.elevator_api.service')
+    def test_training_columns_endpoint(self, mock_service, client):
+        np = pytest.importorskip('numpy')
+        mock_service.get_training_arrays.return_value = {'next_demand_floor': np.array([7, 1], dtype='int16')}
+        response = client.get('/training-data/columns?elevator_id=1')
+        assert response.status_code == 200
+        loaded = np.load(io.BytesIO(response.data))
+        assert loaded['next_demand_floor'].tolist() == [7, 1]
+    #Prometheus metrics: per route latency, per SQL statement timings, off switch
+    def test_metrics_endpoint(self, client, monkeypatch):
+        client.get('/health')
+        client.get('/elevators/1/analytics?days=1')
+        text = client.get('/metrics').data.decode()
+        assert 'elevator_http_requests_total{route="/health",method="GET",status="200"}' in text
+        assert 'elevator_http_request_duration_seconds_bucket{route="/elevators/<int:elevator_id>/analytics",method="GET",le="+Inf"}' in text
+        assert 'elevator_service_call_duration_seconds_count{method="get_demand_analytics"}' in text
+        assert 'elevator_sql_duration_seconds_count{statement="SELECT demand_hourly_rollups"}' in text
+        assert 'elevator_db_file_bytes{file="db"}' in text
+        monkeypatch.setattr(metrics, 'ENABLED', False)
+        assert client.get('/metrics').status_code == 404
+
+    def test_sql_rows_counted_for_every_fetch_style(self):
+        conn = sqlite3.connect(':memory:')
+        conn.execute("CREATE TABLE fetch_probe (value INTEGER)")
+        conn.executemany("INSERT INTO fetch_probe VALUES (?)", [(i,) for i in range(5)])
+        cursor = conn.cursor(metrics.InstrumentedCursor)
+        label = ('SELECT fetch_probe',)
+        before = metrics.sql_rows._values.get(label, 0)
+        cursor.execute("SELECT value FROM fetch_probe")
+        assert cursor.fetchone() == (0,)
+        assert len(cursor.fetchmany(2)) == 2
+        assert [row for row in cursor] == [(3,), (4,)]
+        assert cursor.fetchone() is None
+        cursor.execute("SELECT value FROM fetch_probe")
+        assert len(cursor.fetchall()) == 5
+        assert metrics.sql_rows._values[label] - before == 10
+        conn.close()
 #health check endpoint    
     def test_health_check(self, client):
         response = client.get('/health')
@@ -246,7 +984,578 @@ class TestAPIEndpoints:
         data = json.loads(response.data)
         assert data['status'] == 'healthy'
         assert 'timestamp' in data
+#Write-behind ingestion queue
+class TestIngestQueue:
+    @pytest.fixture
+    def service(self):
+        db_fd, db_path = tempfile.mkstemp()
+        os.close(db_fd)
+        service = ElevatorDataService(db_path)
+        conn = service.get_connection()
+        conn.execute("INSERT INTO elevators (id, building_id, name, min_floor, max_floor) VALUES (1, 1, 'Test', 1, 10)")
+        conn.commit()
+        conn.close()
+        yield service
+        service.close()
+        os.unlink(db_path)
+
+    def test_events_are_group_committed_on_stop(self, service):
+        queue = IngestQueue(service, batch_size=50, flush_interval=10).start()
+        result = queue.submit_states([{'elevator_id': 1, 'floor': 3, 'state': 'resting', 'timestamp': '2025-01-15T08:00:00'},
+                                      {'elevator_id': 1, 'floor': 30, 'state': 'resting'}])
+        assert result['accepted'] == 1
+        assert 'out of bounds' in result['results'][1]['error']
+        for i in range(5):
+            queue.submit_demands([{'elevator_id': 1, 'requested_floor': 7, 'request_time': f'2025-01-15T08:0{i + 1}:00'}])
+        queue.stop()
+        metrics = queue.metrics()
+        assert metrics['written'] == 6
+        assert metrics['committed_through'] == 6
+        assert metrics['queue_depth'] == 0
+        #arrival order kept, so the resting state got its training sample
+        assert len(service.get_ml_training_data(elevator_id=1)) == 1
+        with pytest.raises(QueueClosedError):
+            queue.submit_demands([{'elevator_id': 1, 'requested_floor': 2}])
+
+    #a locked database is retried, then requeued; only real errors lose events, and they are counted
+    def test_flush_survives_locked_database(self, service, monkeypatch):
+        from app import ingest_queue
+        record = service.record_demands_batch
+        failures = [sqlite3.OperationalError('database is locked')] * 3 + [sqlite3.IntegrityError('broken')]
+        def flaky(events):
+            if failures:
+                raise failures.pop(0)
+            return record(events)
+        monkeypatch.setattr(service, 'record_demands_batch', flaky)
+        queue = IngestQueue(service, batch_size=100, flush_interval=10, retries=1, retry_delay=0.001).start()
+        queue.submit_demands([{'elevator_id': 1, 'requested_floor': floor} for floor in (2, 3)])
+        queue.stop()
+        stats = queue.metrics()
+        assert (stats['retries'], stats['requeued'], stats['lost'], stats['written']) == (2, 2, 2, 0)
+        assert stats['queue_depth'] == 0
+        assert 'elevator_ingest_events_lost_total{kind="demand",reason="error"}' in metrics.REGISTRY.render()
+
+        queue = IngestQueue(service, batch_size=100, flush_interval=10, retries=3, retry_delay=0.001).start()
+        failures.extend([sqlite3.OperationalError('database is locked')] * 2)
+        queue.submit_demands([{'elevator_id': 1, 'requested_floor': floor} for floor in (4, 5)])
+        queue.stop()
+        assert (queue.metrics()['retries'], queue.metrics()['written'], queue.metrics()['committed_through']) == (2, 2, 2)
+        assert ingest_queue.is_transient(sqlite3.OperationalError('database is locked'))
+
+        #locked for good: shutdown gives up after a few requeues and counts what is left as lost
+        def locked(events):
+            raise sqlite3.OperationalError('database is locked')
+        monkeypatch.setattr(service, 'record_demands_batch', locked)
+        queue = IngestQueue(service, batch_size=100, flush_interval=10, retries=1, retry_delay=0.001, shutdown_requeues=2).start()
+        queue.submit_demands([{'elevator_id': 1, 'requested_floor': floor} for floor in (6, 7)])
+        queue.stop(timeout=10)
+        stats = queue.metrics()
+        assert not stats['running'] and (stats['requeued'], stats['lost'], stats['queue_depth']) == (4, 2, 0)
+        assert 'elevator_ingest_events_lost_total{kind="demand",reason="locked"}' in metrics.REGISTRY.render()
+
+    def test_backpressure_when_full(self, service):
+        queue = IngestQueue(service, max_size=3, batch_size=100, flush_interval=10).start()
+        queue.submit_demands([{'elevator_id': 1, 'requested_floor': 2}] * 3)
+        with pytest.raises(QueueFullError):
+            queue.submit_demands([{'elevator_id': 1, 'requested_floor': 2}])
+        assert queue.metrics()['rejected_full'] == 1
+        queue.stop()
+
+    def test_async_endpoints(self, service, monkeypatch):
+        monkeypatch.setattr(elevator_api, 'service', service)
+        elevator_api.enable_async_ingest(max_size=1, flush_interval=10)
+        try:
+            with app.test_client() as client:
+                response = client.post('/elevators/1/demand', json={'requested_floor': 4})
+                assert response.status_code == 202
+                assert response.get_json()['status'] == 'queued'
+                response = client.post('/elevators/1/demand', json={'requested_floor': 5})
+                assert response.status_code == 429
+                assert client.get('/ingest/metrics').get_json()['queue_depth'] == 1
+        finally:
+            elevator_api.disable_async_ingest()
+        conn = service.get_connection()
+        assert conn.execute("SELECT COUNT(*) FROM demand_events").fetchone()[0] == 1
+        conn.close()
+class TestASGI:
+    @pytest.fixture
+    def service(self, monkeypatch):
+        db_fd, db_path = tempfile.mkstemp()
+        os.close(db_fd)
+        service = ElevatorDataService(db_path)
+        conn = service.get_connection()
+        conn.execute("INSERT INTO elevators (id, building_id, name, min_floor, max_floor) VALUES (1, 1, 'Test', 1, 10)")
+        conn.commit()
+        conn.close()
+        monkeypatch.setattr(elevator_api, 'service', service)
+        yield service
+        service.close()
+        os.unlink(db_path)
+
+    #Drives the ASGI app like a server would, returns (status, headers, body). The client stays
+    #connected until the response is complete
+    @staticmethod
+    async def call(application, method, path, body=None, query='', headers=None, raw=None):
+        payload = raw if raw is not None else json.dumps(body).encode() if body is not None else b''
+        scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query.encode(),
+                 'headers': [(b'content-type', b'application/json')] + (headers or []), 'http_version': '1.1'}
+        messages = [{'type': 'http.request', 'body': payload, 'more_body': False}]
+        sent = []
+        async def receive():
+            if messages:
+                return messages.pop(0)
+            await asyncio.Event().wait()
+        async def send(message):
+            sent.append(message)
+        await application(scope, receive, send)
+        start = sent[0]
+        return start['status'], dict(start['headers']), b''.join(message.get('body', b'') for message in sent[1:])
+
+    def test_routes_match_flask(self, service):
+        from app.asgi import AsyncElevatorAPI
+        application = AsyncElevatorAPI(db_threads=2)
+        async def scenario():
+            status, _, body = await self.call(application, 'POST', '/elevators/1/state',
+                                              {'floor': 3, 'state': 'resting'})
+            assert status == 201
+            status, _, body = await self.call(application, 'POST', '/elevators/1/demand', {})
+            assert status == 400 and json.loads(body)['error'] == 'requested_floor is required'
+            status, _, body = await self.call(application, 'POST', '/elevators/1/state', {'floor': 99, 'state': 'resting'})
+            assert status == 400 and 'out of bounds' in json.loads(body)['error']
+            status, _, body = await self.call(application, 'POST', '/elevators/1/demand', {'requested_floor': 7})
+            assert status == 201 and json.loads(body)['requested_floor'] == 7
+            status, headers, body = await self.call(application, 'GET', '/elevators/1/analytics', query='days=3650')
+            assert status == 200
+            status, _, body = await self.call(application, 'GET', '/elevators/1/analytics', query='days=3650',
+                                              headers=[(b'if-none-match', headers[b'etag'])])
+            assert status == 304 and body == b''
+            status, _, body = await self.call(application, 'GET', '/elevators/1/analytics', query='hours=1')
+            assert json.loads(body)['source'] == 'memory'
+            status, _, body = await self.call(application, 'GET', '/elevators/1/current', query='limit=1')
+            assert json.loads(body)['current_state']['floor'] == 3 and len(json.loads(body)['recent_demands']) == 1
+            status, _, body = await self.call(application, 'GET', '/elevators/99/current')
+            assert status == 404
+            status, _, body = await self.call(application, 'GET', '/health')
+            assert json.loads(body)['status'] == 'healthy'
+            #streaming formats and other routes are served by the Flask app
+            status, headers, body = await self.call(application, 'GET', '/training-data', query='format=ndjson&count=true')
+            assert status == 200 and headers[b'x-total-count'] == b'1'
+            assert len(body.decode().strip().splitlines()) == 1
+            status, _, body = await self.call(application, 'GET', '/ingest/metrics')
+            assert json.loads(body) == {'mode': 'sync'}
+        asyncio.run(scenario())
+        application.shutdown()
+
+    #Both servers give the same answer for the same bad request
+    def test_same_errors_as_flask(self, service):
+        from app.asgi import AsyncElevatorAPI
+        application = AsyncElevatorAPI(db_threads=2)
+        client = elevator_api.app.test_client()
+        cases = [('POST', '/elevators/1/demand', b'not json', ''), ('POST', '/elevators/1/state', b'[1, 2]', ''),
+                 ('POST', '/elevators/1/state', b'{"floor": 3}', ''), ('GET', '/training-data', b'', 'limit=0'),
+                 ('GET', '/training-data', b'', 'format=xml'), ('GET', '/elevators/1/analytics', b'', 'hours=100')]
+        async def scenario():
+            return [await self.call(application, method, path, raw=body, query=query) for method, path, body, query in cases]
+        results = asyncio.run(scenario())
+        application.shutdown()
+        for (method, path, body, query), (status, _, asgi_body) in zip(cases, results):
+            response = client.open(path, method=method, data=body, query_string=query, content_type='application/json')
+            assert (status, json.loads(asgi_body)) == (response.status_code, response.get_json())
+            assert status == 400
+
+    #A client that goes away stops the DB thread producing the rest of a stream
+    def test_stream_stops_on_disconnect(self, service):
+        from app.asgi import AsyncElevatorAPI
+        chunks = []
+        def wsgi_app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'application/x-ndjson')])
+            for i in range(10000):
+                chunks.append(i)
+                yield b'{}\n'
+        application = AsyncElevatorAPI(wsgi_app=wsgi_app, db_threads=2)
+        async def scenario():
+            sent, gone = [], asyncio.Event()
+            messages = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+            async def receive():
+                if messages:
+                    return messages.pop(0)
+                await gone.wait()
+                return {'type': 'http.disconnect'}
+            async def send(message):
+                sent.append(message)
+                if len(sent) == 3:
+                    gone.set()
+                await asyncio.sleep(0)
+            scope = {'type': 'http', 'method': 'GET', 'path': '/training-data', 'query_string': b'format=ndjson', 'headers': []}
+            await application(scope, receive, send)
+            return sent
+        sent = asyncio.run(scenario())
+        application.shutdown()
+        assert len(chunks) < 10000
+        assert all(message.get('more_body') for message in sent[1:])
+
+    #Streams from Flask run in their own pool, a stuck one leaves the DB threads to the native routes
+    def test_slow_stream_keeps_db_threads(self, service):
+        from app.asgi import AsyncElevatorAPI
+        release = threading.Event()
+        def wsgi_app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'application/x-ndjson')])
+            yield b'{}\n'
+            release.wait(10)
+            yield b'{}\n'
+        application = AsyncElevatorAPI(wsgi_app=wsgi_app, db_threads=1)
+        async def scenario():
+            stream = asyncio.ensure_future(self.call(application, 'GET', '/training-data', query='format=ndjson'))
+            await asyncio.sleep(0.05)
+            status, _, _ = await asyncio.wait_for(self.call(application, 'GET', '/elevators/1/current'), 5)
+            release.set()
+            return status, await stream
+        status, (stream_status, _, body) = asyncio.run(scenario())
+        application.shutdown()
+        assert status == 200 and stream_status == 200 and body == b'{}\n{}\n'
+
+    def test_many_concurrent_requests(self, service):
+        from app.asgi import AsyncElevatorAPI
+        application = AsyncElevatorAPI(db_threads=4)
+        async def scenario():
+            calls = [self.call(application, 'POST', '/elevators/1/demand', {'requested_floor': i % 10 + 1}) for i in range(300)]
+            calls += [self.call(application, 'GET', '/training-data', query='limit=5') for _ in range(100)]
+            return await asyncio.gather(*calls)
+        results = asyncio.run(scenario())
+        application.shutdown()
+        assert [status for status, _, _ in results[:300]] == [201] * 300
+        assert all(status == 200 and 'next_cursor' in json.loads(body) for status, _, body in results[300:])
+        conn = service.get_connection()
+        assert conn.execute("SELECT COUNT(*) FROM demand_events").fetchone()[0] == 300
+        conn.close()
+
+    #Open streams wait on the loop, events from the service arrive as SSE frames
+    def test_event_stream(self, service, monkeypatch):
+        from app.asgi import AsyncElevatorAPI
+        from app.events import EventHub
+        monkeypatch.setattr(elevator_api, 'hub', EventHub())
+        service.hub = elevator_api.hub
+        application = AsyncElevatorAPI(db_threads=2)
+        async def scenario():
+            sent, gone = [], asyncio.Event()
+            messages = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+            async def receive():
+                if messages:
+                    return messages.pop(0)
+                await gone.wait()
+                return {'type': 'http.disconnect'}
+            async def send(message):
+                sent.append(message)
+            scope = {'type': 'http', 'method': 'GET', 'path': '/stream', 'query_string': b'elevator_id=1&types=demand', 'headers': []}
+            stream = asyncio.ensure_future(application(scope, receive, send))
+            while elevator_api.hub.subscriber_count == 0:
+                await asyncio.sleep(0.01)
+            await self.call(application, 'POST', '/elevators/1/state', {'floor': 3, 'state': 'resting'})
+            await self.call(application, 'POST', '/elevators/1/demand', {'requested_floor': 7})
+            while len(sent) < 3:
+                await asyncio.sleep(0.01)
+            gone.set()
+            await stream
+            return sent
+        sent = asyncio.run(scenario())
+        application.shutdown()
+        assert sent[0]['headers'][0] == (b'content-type', b'text/event-stream')
+        frame = sent[2]['body'].decode()
+        assert frame.startswith('id: ') and 'event: demand' in frame
+        assert json.loads(frame.split('data: ')[1])['requested_floor'] == 7
+        assert elevator_api.hub.subscriber_count == 0
+
+class TestEventStream:
+    #Filters, bounded buffers that cut slow consumers off, and resume tokens
+    def test_hub_delivery_drop_and_resume(self):
+        from app.events import EventHub
+        hub = EventHub(history_size=5)
+        fleet, _, _ = hub.subscribe()
+        only_two, _, _ = hub.subscribe(elevator_ids=[2], kinds=['state'])
+        slow, _, _ = hub.subscribe(max_buffer=2)
+        for i in range(3):
+            hub.publish('demand', 1, {'elevator_id': 1, 'requested_floor': i})
+        last = hub.publish('state', 2, {'elevator_id': 2, 'floor': 4})  #id 4
+        assert [event.data for event in fleet.get(0)][-1] == {'elevator_id': 2, 'floor': 4}
+        assert [event.kind for event in only_two.get(0)] == ['state']
+        assert slow.dropped and slow.closed and len(slow.get(0)) == 2
+        assert hub.subscriber_count == 2 and hub.metrics()['dropped_subscribers'] == 1
+
+        _, replayed, complete = hub.subscribe(resume=f'{hub.epoch}-2')
+        assert [event.id for event in replayed] == [3, 4] and complete
+        for i in range(5):
+            hub.publish('demand', 1, {'elevator_id': 1})
+        _, replayed, complete = hub.subscribe(resume=last.token)
+        assert complete and len(replayed) == 5
+        _, replayed, complete = hub.subscribe(resume=f'{hub.epoch}-2')
+        assert not complete and len(replayed) == 5
+        _, replayed, complete = hub.subscribe(resume='oldrun-4')
+        assert (replayed, complete) == ([], False)
+
+        #concurrent publishers: every subscription still sees ids in order
+        ordered, _, _ = hub.subscribe(max_buffer=10000)
+        def publish():
+            for i in range(500):
+                hub.publish('demand', 1, {'elevator_id': 1})
+        threads = [threading.Thread(target=publish) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        ids = [event.id for event in ordered.get(0)]
+        assert len(ids) == 2000 and ids == sorted(ids)
+
+    #The Flask route replays from Last-Event-ID, then keeps the connection open for live events
+    @patch('app.elevator_api.service')
+    def test_stream_endpoint(self, mock_service, monkeypatch):
+        from app.events import EventHub
+        monkeypatch.setattr(elevator_api, 'hub', EventHub())
+        first = elevator_api.hub.publish('demand', 1, {'elevator_id': 1, 'requested_floor': 3})
+        elevator_api.hub.publish('demand', 2, {'elevator_id': 2, 'requested_floor': 4})
+        elevator_api.hub.publish('state', 3, {'elevator_id': 3, 'floor': 5})
+        mock_service.get_building_elevator_ids.return_value = [2, 3]
+        with app.test_client() as client:
+            response = client.get('/stream?building_id=7', headers={'Last-Event-ID': first.token})
+            assert response.mimetype == 'text/event-stream'
+            frames = (frame.decode() for frame in response.response)
+            assert next(frames).startswith('retry:')
+            assert 'event: demand' in next(frames) and 'event: state' in next(frames)
+            response.close()
+            assert client.get('/stream?types=arrivals').status_code == 400
+        mock_service.get_building_elevator_ids.assert_called_with(7)
+        assert elevator_api.hub.subscriber_count == 0
+
+class TestSharding:
+    @pytest.fixture
+    def sharded(self, tmp_path):
+        from app.sharding import ShardedElevatorDataService
+        service = ShardedElevatorDataService(str(tmp_path / 'shards'))
+        for building_id in (1, 2):
+            service.add_building(building_id, f'Building {building_id}', 10)
+            for n in (1, 2):
+                service.add_elevator(building_id * 10 + n, building_id, f'E{n}', 1, 10)
+        yield service
+        service.close()
+
+    def test_events_go_to_their_building(self, sharded, tmp_path):
+        start = datetime(2025, 1, 13, 7, 0)
+        result = sharded.record_elevator_states_batch(
+            [{'elevator_id': elevator_id, 'floor': 1, 'state': 'resting', 'timestamp': (start + timedelta(minutes=i)).isoformat()}
+             for i, elevator_id in enumerate([11, 21, 12, 22])] + [{'elevator_id': 99, 'floor': 1, 'state': 'resting'}])
+        assert result['accepted'] == 4
+        assert result['results'][4] == {'index': 4, 'error': 'Elevator 99 not found'}
+        assert [item['index'] for item in result['results']] == [0, 1, 2, 3, 4]
+        result = sharded.record_demands_batch([{'elevator_id': elevator_id, 'requested_floor': 5,
+                                               'request_time': (start + timedelta(minutes=10 + i)).isoformat()}
+                                              for i, elevator_id in enumerate([22, 11, 21, 12])])
+        assert result['accepted'] == 4
+        sharded.record_demand(11, 3, start + timedelta(hours=1))
+
+        assert sorted(name for name in os.listdir(tmp_path / 'shards') if name.endswith('.db')) == ['building_1.db', 'building_2.db', 'catalog.db']
+        conn = sharded.shard_for(21).get_connection()
+        assert {row[0] for row in conn.execute("SELECT elevator_id FROM demand_events")} == {21, 22}
+        conn.close()
+        assert sharded.get_demand_analytics(11, days=3650)['floor_popularity'][0]['demand_count'] == 1
+
+    def test_registry_changes_reach_the_shard(self, sharded):
+        elevator = sharded.create_elevator(2, 'E3', -1, 6)
+        assert sharded.get_building(2)['elevator_ids'] == [21, 22, elevator['id']]
+        shard = sharded.shard_for(elevator['id'])
+        assert shard.get_elevator(elevator['id'])['min_floor'] == -1
+        sharded.update_elevator(elevator['id'], {'max_floor': 4})
+        assert shard.registry.get(elevator['id'])['max_floor'] == 4
+        result = sharded.record_demands_batch([{'elevator_id': elevator['id'], 'requested_floor': 5}])
+        assert 'out of bounds' in result['results'][0]['error']
+        with pytest.raises(ValueError, match='another building'):
+            sharded.update_elevator(elevator['id'], {'building_id': 1})
+        sharded.record_demand(elevator['id'], -1)
+        with pytest.raises(ValueError, match='recorded events'):
+            sharded.delete_elevator(elevator['id'])
+        assert sharded.delete_elevator(12)
+        assert sharded.get_elevator(12) is None and shard.get_elevator(12) is None
+        assert sharded.get_building(1)['elevator_ids'] == [11]
+
+    def test_fleet_reads_merge_shards_in_time_order(self, sharded):
+        start = datetime(2025, 1, 13, 7, 0)
+        for i in range(12):
+            elevator_id = [11, 21, 12, 22][i % 4]
+            sharded.record_elevator_state(elevator_id, 2, 'resting', timestamp=start + timedelta(minutes=i))
+            sharded.record_demand(elevator_id, 4, start + timedelta(minutes=i, seconds=30))
+        rows = sharded.get_ml_training_data()
+        assert len(rows) == 12 == sharded.count_ml_training_data()
+        assert [row['rest_start_time'] for row in rows] == sorted(row['rest_start_time'] for row in rows)
+        assert [row['elevator_id'] for row in rows[:4]] == [11, 21, 12, 22]
+        assert list(sharded.iter_ml_training_data(limit=5)) == rows[:5]
+
+        paged, after = [], None
+        while True:
+            after, page = sharded.open_training_page(after=after, limit=5)
+            paged += list(page)
+            if after is None:
+                break
+        assert paged == rows
+        arrays = sharded.get_training_arrays()
+        assert arrays['elevator_id'].tolist() == [row['elevator_id'] for row in rows]
+        assert sharded.get_ml_training_data(elevator_id=21) == [row for row in rows if row['elevator_id'] == 21]
+        compared = sharded.compare_elevators([22, 11], days=3650)
+        assert [item['elevator_id'] for item in compared['elevators']] == [22, 11]
+        assert sharded.rebuild_ml_training_data() == 12
+
+    #Watermarks keep one position per building, pages take rows from every shard in turn
+    def test_change_feed_across_shards(self, sharded):
+        start = datetime(2025, 1, 13, 7, 0)
+        for i in range(6):
+            elevator_id = [11, 21][i % 2]
+            sharded.record_elevator_state(elevator_id, 2, 'resting', timestamp=start + timedelta(minutes=i))
+            sharded.record_demand(elevator_id, 4, start + timedelta(minutes=i, seconds=30))
+        page = sharded.get_training_changes('0', limit=4)
+        assert [row['elevator_id'] for row in page['data']] == [11, 21, 11, 21]
+        assert page['next_watermark'] == '1:2,2:2' and page['has_more']
+        page = sharded.get_training_changes(page['next_watermark'], limit=4)
+        assert len(page['data']) == 2 and not page['has_more']
+        assert page['next_watermark'] == '1:3,2:3'
+        sharded.commit_consumer_offset('trainer', page['next_watermark'])
+        assert sharded.get_consumer_offset('trainer')['watermark'] == '1:3,2:3'
+        with pytest.raises(ValueError, match="Invalid watermark"):
+            sharded.commit_consumer_offset('trainer', '7')
+
+class TestSimulator:
+    @pytest.fixture
+    def service(self):
+        db_fd, db_path = tempfile.mkstemp()
+        os.close(db_fd)
+        service = ElevatorDataService(db_path)
+        conn = service.get_connection()
+        conn.execute("INSERT INTO elevators (id, building_id, name, max_capacity, min_floor, max_floor) VALUES (1, 1, 'Test', 6, 1, 10)")
+        conn.execute("INSERT INTO elevators (id, building_id, name, max_capacity, min_floor, max_floor) VALUES (2, 1, 'Test', 6, -2, 4)")
+        conn.commit()
+        conn.close()
+        yield service
+        service.close()
+        os.unlink(db_path)
+
+    def test_events_respect_fleet_and_state_machine(self, service):
+        from app.simulator import ListSink, Simulator, load_fleet
+        conn = service.get_connection()
+        fleet = load_fleet(conn)
+        conn.close()
+        sink = ListSink()
+        start = datetime(2025, 1, 13)
+        result = Simulator(fleet, seed=7).run(start, start + timedelta(days=2), sink)
+        assert result['demands'] > 0 and result['states'] > result['demands']
+        bounds = {spec.elevator_id: (spec.min_floor, spec.max_floor) for spec in fleet}
+        last_state = {}
+        for kind, values in sink.events:
+            floor = values[1]
+            assert bounds[values[0]][0] <= floor <= bounds[values[0]][1]
+            if kind == 'state':
+                assert values[2] in ('resting', 'moving', 'occupied')
+                assert values[3] <= 6
+                #a car that left for a call picks it up before anything else
+                if last_state.get(values[0]) == 'moving':
+                    assert values[2] == 'occupied'
+                last_state[values[0]] = values[2]
+        #same seed, same events
+        again = ListSink()
+        Simulator(fleet, seed=7).run(start, start + timedelta(days=2), again)
+        assert again.events == sink.events
+
+    def test_peak_hours_get_more_calls(self, service):
+        from app.simulator import DemandProfile, ListSink, Simulator, load_fleet
+        conn = service.get_connection()
+        fleet = load_fleet(conn)
+        conn.close()
+        sink = ListSink()
+        start = datetime(2025, 1, 13)  #Monday
+        Simulator(fleet, DemandProfile(base_rate=10, peak_multiplier=4), seed=1).run(start, start + timedelta(days=5), sink)
+        calls = [values[2] for kind, values in sink.events if kind == 'demand']
+        peak = sum(1 for when in calls if service.is_peak_hour(when.hour, when.weekday()))
+        business = sum(1 for when in calls if 9 <= when.hour < 17)
+        assert peak / 4 > business / 8  #per hour, 4 peak hours vs 8 regular ones
+
+    def test_service_and_sqlite_sinks_agree(self, service, tmp_path):
+        from app.simulator import ListSink, ServiceSink, Simulator, SQLiteSink, load_fleet, replay
+        conn = service.get_connection()
+        fleet = load_fleet(conn)
+        conn.close()
+        recorded = ListSink()
+        start = datetime(2025, 1, 13)
+        Simulator(fleet, seed=3).run(start, start + timedelta(days=1), recorded)
+        result = replay(recorded.events, ServiceSink(service, batch_size=200))
+        assert result['rejected'] == 0
+        assert result['accepted'] == len(recorded.events)
+
+        path = str(tmp_path / 'sim.db')
+        direct = ElevatorDataService(path)
+        conn = direct.get_connection()
+        conn.execute("INSERT INTO elevators (id, building_id, name, max_capacity, min_floor, max_floor) VALUES (1, 1, 'Test', 6, 1, 10)")
+        conn.execute("INSERT INTO elevators (id, building_id, name, max_capacity, min_floor, max_floor) VALUES (2, 1, 'Test', 6, -2, 4)")
+        conn.commit()
+        conn.close()
+        direct.close()
+        result = replay(recorded.events, SQLiteSink(path, batch_size=300))
+        assert result['training_samples'] > 0
+        direct = ElevatorDataService(path)
+        def samples(data_service):
+            return sorted(tuple(row[column] for column in elevator_api.TRAINING_COLUMNS)
+                          for row in data_service.get_ml_training_data())
+        #ids differ between the two paths, the training rows don't
+        assert samples(direct) == samples(service)
+        assert direct.get_demand_analytics(1, days=3650) == service.get_demand_analytics(1, days=3650)
+        assert result['sketch_rows'] > 0
+        assert direct.get_demand_percentiles(1, days=3650) == service.get_demand_percentiles(1, days=3650)
+        direct.close()
 #Tests data integrity
+class TestBulkImport:
+    @pytest.fixture
+    def db_path(self, tmp_path):
+        db_path = str(tmp_path / 'import.db')
+        service = ElevatorDataService(db_path)
+        conn = service.get_connection()
+        conn.execute("INSERT INTO elevators (id, building_id, name, max_capacity, min_floor, max_floor) VALUES (1, 1, 'Test', 6, 1, 10)")
+        conn.commit()
+        conn.close()
+        service.close()
+        return db_path
+
+    #Parsed in a pool, written once, resumed from the stored offsets, indexes back at the end
+    def test_import_matches_service_and_resumes(self, db_path, tmp_path):
+        from app.importer import BulkImporter
+        start = datetime(2025, 1, 13, 8, 0)
+        states = tmp_path / 'states.csv'
+        states.write_text('elevator_id,floor,state,passenger_count,previous_floor,timestamp\n' + ''.join(
+            f'1,{i + 1},resting,0,,{(start + timedelta(minutes=2 * i)).isoformat()}\n' for i in range(6)) +
+            '1,99,resting,0,,2025-01-13T09:00:00\n')
+        demands = tmp_path / 'demands.ndjson'
+        demands.write_text(''.join(json.dumps({'type': 'demand', 'elevator_id': 1, 'requested_floor': 10 - i,
+            'request_time': timestamps.to_ms(start + timedelta(minutes=2 * i + 1))}) + '\n' for i in range(6)) + '{"type": "demand"}\n'
+            '{"type": "demand", "elevator_id": 1, "requested_floor": 2, "request_time": 99999999999999999}\n')
+
+        importer = BulkImporter(db_path, workers=2, chunk_rows=2, commit_rows=3, out=None)
+        result = importer.run([str(states)], kind='state')
+        result = importer.run([str(demands)])
+        importer.close()
+        assert (result['demands'], result['states'], result['rejected']) == (6, 6, 3)
+        assert 'elevator_id is required' in ' '.join(result['errors']) and 'request_time out of range' in ' '.join(result['errors'])
+        assert result['training_samples'] == 6 and 'ind_demand_events_elevator_time' in result['indexes']
+
+        service = ElevatorDataService(db_path)
+        rows = service.get_ml_training_data()
+        assert [row['distance_to_demand'] for row in rows] == [9, 7, 5, 3, 1, 1]
+        assert rows[0]['is_peak_hour'] and rows[0]['day_of_week'] == 0
+        conn = service.get_connection()
+        assert conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'ind_elevator_states_elevator_time'").fetchone()[0] == 1
+        conn.close()
+        service.close()
+
+        #finished files are skipped, appended lines are picked up from the stored offset
+        with open(demands, 'a') as handle:
+            handle.write(json.dumps({'type': 'demand', 'elevator_id': 1, 'requested_floor': 5, 'request_time': '2025-01-13T09:30:00'}) + '\n')
+        importer = BulkImporter(db_path, workers=1, out=None)
+        result = importer.run([str(states), str(demands)], rebuild=False)
+        importer.close()
+        assert (result['skipped_files'], result['demands'], result['states']) == (1, 1, 0)
+
 class TestDataIntegrity:
     @pytest.fixture
     def service(self):
@@ -316,6 +1625,7 @@ class TestDataIntegrity:
             
             service = ElevatorDataService(db_path)
             yield service
+            service.close()
         finally:#Cleanup temp DB
             if os.path.exists(db_path):
                 os.unlink(db_path)
@@ -344,5 +1654,16 @@ class TestDataIntegrity:
         
         assert count == 4
 
+#Benchmark suite smoke test, tiny scale so it stays fast
+def test_benchmark_smoke():
+    from bench import benchmark
+    results = benchmark.run(['400'], samples=5)
+    scale = results['scales']['400']
+    assert scale['load']['events'] == 400
+    assert scale['queries']['get_demand_analytics_7d']['count'] == 5
+    assert scale['ingest']['record_demand']['per_second'] > 0
+    assert benchmark.compare(results, results, 0.2) == []
+
+
 if __name__ == '__main__':
-    pytest.main(['-v', __file__])#-v to show verbose output
\ No newline at end of file
+    pytest.main(['-v', __file__])#-v to show verbose output